@@ -1,6 +1,7 @@
 from flask import Flask
 
 import logging
+import time
 
 logging.basicConfig(format="%(levelname)s: %(message)s")
 logger = logging.getLogger()
@@ -9,10 +10,18 @@ logger.setLevel(logging.INFO)
 # Path to store knowledge base vector db
 store_path = "vector_store/"
 
+# Seconds spent in each startup stage, filled in by create_app() and by
+# helper.warm_up()
+startup_timings = {}
+
 
 def create_app():
+    start = time.perf_counter()
     app = Flask(__name__)
 
+    from app import metrics
+    metrics.init_app(app)
+
     # Register blueprints here
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
@@ -23,4 +32,8 @@ def create_app():
     from app.documents import bp as docs_bp
     app.register_blueprint(docs_bp)
 
+    from app.jobs import bp as jobs_bp
+    app.register_blueprint(jobs_bp)
+
+    startup_timings["create_app"] = time.perf_counter() - start
     return app
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe least-recently-used cache with hit/miss counters
+
+    Entries are evicted once more than `maxsize` entries are held or,
+    when `max_bytes` is set, once the summed `sizeof` of all entries
+    exceeds it. When `ttl` is set, entries also expire that many seconds
+    after they were put.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of entries to keep
+    max_bytes: int
+        Optional upper bound on the summed size of cached values
+    sizeof: callable
+        Returns the size in bytes of a cached value. Required for
+        `max_bytes` to have an effect
+    ttl: float
+        Optional number of seconds entries are kept for
+    """
+
+    def __init__(self, maxsize=16, max_bytes=None, sizeof=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data and self.ttl is not None and \
+                    self._expires[key] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.sizeof else 0
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            self._bytes += size
+            self._evict()
+
+    def invalidate(self, key):
+        """
+        Drops `key` and every entry whose key is nested under it, so
+        invalidating a knowledge base path also drops its sub paths.
+        Tuple keys are matched on their first item
+        """
+        with self._lock:
+            prefix = key.rstrip("/") + "/"
+            for cached_key in list(self._data):
+                path = cached_key[0] if isinstance(cached_key, tuple) \
+                    else cached_key
+                if path == key or str(path).startswith(prefix):
+                    self._remove(cached_key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            Hit/miss counters and current occupancy of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0,
+                    "entries": len(self._data), "bytes": self._bytes}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _remove(self, key):
+        del self._data[key]
+        self._bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
+
+    def _evict(self):
+        while self._data and (
+                len(self._data) > self.maxsize or
+                (self.max_bytes is not None and self._bytes > self.max_bytes
+                 and len(self._data) > 1)):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
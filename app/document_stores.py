@@ -0,0 +1,322 @@
+import abc
+import fnmatch
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import uuid
+from app import logger
+
+# Files of a disk document store:
+#
+#   catalog.sqlite          name, SHA-256 of the UTF-8 content, size in
+#                           bytes and content file of every document
+#   objects/<ab>/<abcd...>  UTF-8 content of a document, stored once per
+#                           distinct content hash
+CATALOG = "catalog.sqlite"
+OBJECTS = "objects"
+
+# Bytes copied at a time when storing and hashing a document
+BLOCK_SIZE = 1 << 20
+
+
+class DocumentStore(abc.ABC):
+    """
+    Documents stored by name. Contents are UTF-8 text and are read as
+    streams, so a document never has to fit in memory. Subclasses
+    implement `open`, `info`, `put`, `delete` and `names`
+    """
+
+    @abc.abstractmethod
+    def open(self, name: str):
+        """
+        Returns
+        -------
+        io.TextIOBase
+            Text stream of a document
+
+        Raises
+        ------
+        KeyError
+            When the document is not in the store
+        """
+
+    @abc.abstractmethod
+    def info(self, name: str):
+        """
+        Returns
+        -------
+        dict
+            `name`, content `hash` and `size` in bytes of a document, None
+            when it is not in the store
+        """
+
+    @abc.abstractmethod
+    def put(self, name: str, content):
+        """
+        Stores a document, replacing any document of the same name
+
+        Parameters
+        ----------
+        name: str
+            Document name
+        content: str, bytes or file object
+            Text of the document, file objects are read block by block
+
+        Returns
+        -------
+        dict
+            Info of the stored document
+        """
+
+    @abc.abstractmethod
+    def delete(self, name: str):
+        """Removes a document, raises KeyError when it is not stored"""
+
+    @abc.abstractmethod
+    def names(self):
+        """Names of every stored document, sorted"""
+
+    def infos(self):
+        """Info of every stored document, sorted by name"""
+        return [self.info(name) for name in self.names()]
+
+    def get(self, name: str, default=None):
+        """Whole text of a document, `default` when it is not stored"""
+        try:
+            stream = self.open(name)
+        except KeyError:
+            return default
+        with stream:
+            return stream.read()
+
+    def __contains__(self, name: str):
+        return self.info(name) is not None
+
+    def __len__(self):
+        return len(self.names())
+
+    def register_directory(self, directory: str, pattern: str = "*",
+                           root: str = None):
+        """
+        Stores every file of a directory matching `pattern`, named after
+        its file name. Subdirectories are not visited. When `root` is
+        given, files resolving outside it, e.g. through symlinks, are
+        skipped
+
+        Returns
+        -------
+        list
+            Info of each stored document
+        """
+        logger.info(f"register_directory(): {(directory, pattern, root)}")
+        stored = []
+        for file_name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file_name)
+            if not os.path.isfile(path) or \
+                    not fnmatch.fnmatch(file_name, pattern):
+                continue
+            if root is not None and not is_within(path, root):
+                logger.info(f"register_directory(): skipping {path}, "
+                            f"it resolves outside {root}")
+                continue
+            with open(path, "rb") as f:
+                stored.append(self.put(file_name, f))
+        return stored
+
+
+def is_within(path: str, root: str):
+    """Whether `path`, with symlinks resolved, is `root` or inside it"""
+    root = os.path.realpath(root)
+    return os.path.commonpath([os.path.realpath(path), root]) == root
+
+
+def _blocks(content):
+    """Yields the UTF-8 bytes of a document's content block by block"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    if isinstance(content, bytes):
+        for start in range(0, len(content), BLOCK_SIZE):
+            yield content[start:start + BLOCK_SIZE]
+        return
+    while True:
+        block = content.read(BLOCK_SIZE)
+        if not block:
+            return
+        yield block.encode("utf-8") if isinstance(block, str) else block
+
+
+class MemoryDocumentStore(DocumentStore):
+    """
+    Document store kept in a dict of texts by name
+
+    Parameters
+    ----------
+    documents: dict
+        Texts by document name. Used in place, so later changes to the
+        dict show in the store
+    """
+
+    def __init__(self, documents: dict = None):
+        self.documents = {} if documents is None else documents
+
+    def open(self, name: str):
+        return io.StringIO(self.documents[name])
+
+    def info(self, name: str):
+        text = self.documents.get(name)
+        if text is None:
+            return None
+        content = text.encode("utf-8")
+        return {"name": name, "hash": hashlib.sha256(content).hexdigest(),
+                "size": len(content)}
+
+    def put(self, name: str, content):
+        self.documents[name] = b"".join(_blocks(content)).decode("utf-8")
+        return self.info(name)
+
+    def delete(self, name: str):
+        del self.documents[name]
+
+    def names(self):
+        return sorted(self.documents)
+
+
+class DiskDocumentStore(DocumentStore):
+    """
+    Document store on disk. A SQLite catalog maps names to content hashes
+    and sizes, and contents are stored as files named after their hash,
+    so documents with the same text share one file. Several processes can
+    share a store
+
+    Parameters
+    ----------
+    path: str
+        Directory holding the store, created on first write
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.path, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.path, CATALOG),
+                                   timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS documents ("
+                         "name TEXT PRIMARY KEY, hash TEXT NOT NULL, "
+                         "size INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS documents_hash "
+                         "ON documents (hash)")
+            self._local.conn = conn
+        return conn
+
+    def _object_path(self, key: str):
+        return os.path.join(self.path, OBJECTS, key[:2], key)
+
+    def open(self, name: str):
+        row = self._connection().execute(
+            "SELECT hash FROM documents WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        return open(self._object_path(row[0]), encoding="utf-8",
+                    errors="replace")
+
+    def info(self, name: str):
+        row = self._connection().execute(
+            "SELECT name, hash, size FROM documents WHERE name = ?",
+            (name,)).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "hash": row[1], "size": row[2]}
+
+    def put(self, name: str, content):
+        objects = os.path.join(self.path, OBJECTS)
+        os.makedirs(objects, exist_ok=True)
+        temporary = os.path.join(objects, f".{uuid.uuid4().hex}.tmp")
+        digest, size = hashlib.sha256(), 0
+        try:
+            with open(temporary, "wb") as f:
+                for block in _blocks(content):
+                    digest.update(block)
+                    size += len(block)
+                    f.write(block)
+            key = digest.hexdigest()
+            os.makedirs(os.path.dirname(self._object_path(key)),
+                        exist_ok=True)
+            # The content file is moved in with the catalog locked, so a
+            # concurrent delete cannot release it before it is referenced
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                os.replace(temporary, self._object_path(key))
+                previous = conn.execute(
+                    "SELECT hash FROM documents WHERE name = ?",
+                    (name,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                    (name, key, size))
+                if previous is not None and previous[0] != key:
+                    self._release(conn, previous[0])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return {"name": name, "hash": key, "size": size}
+
+    def delete(self, name: str):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT hash FROM documents WHERE name = ?",
+                               (name,)).fetchone()
+            if row is None:
+                raise KeyError(name)
+            conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+            self._release(conn, row[0])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _release(self, conn, key: str):
+        """Removes a content file no document refers to any more"""
+        if conn.execute("SELECT 1 FROM documents WHERE hash = ? LIMIT 1",
+                        (key,)).fetchone() is None:
+            try:
+                os.remove(self._object_path(key))
+            except FileNotFoundError:
+                pass
+
+    def names(self):
+        return [name for name, in self._connection().execute(
+            "SELECT name FROM documents ORDER BY name")]
+
+    def infos(self):
+        return [{"name": name, "hash": key, "size": size}
+                for name, key, size in self._connection().execute(
+                    "SELECT name, hash, size FROM documents ORDER BY name")]
+
+    def __len__(self):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+def open_document_store(path: str = None, documents: dict = None):
+    """
+    Returns
+    -------
+    DocumentStore
+        Disk document store at `path` when given, memory document store
+        over `documents` otherwise
+    """
+    if path:
+        return DiskDocumentStore(path)
+    return MemoryDocumentStore(documents)
@@ -1,5 +1,7 @@
+import json
 from app.documents import bp
-from app import helper, logger, store_path
+from app import helper, logger, metrics, storage, store_path
+from app.job_queue import job_queue
 from flask import request
 
 
@@ -9,13 +11,49 @@ def add_document():
     logger.info(f"add_document(): {request_data}")
     knowledge_base = request_data.get("knowledge_base")
     document = request_data.get("document")
+    near_duplicate_distance = request_data.get("near_duplicate_distance")
     try:
-        helper.add_document_to_knowledge_base(document,
-                                              store_path+knowledge_base)
+        if request_data.get("async"):
+            job = job_queue.submit(
+                "add_document", store_path+knowledge_base,
+                helper.add_document_to_knowledge_base, document,
+                store_path+knowledge_base,
+                near_duplicate_distance=near_duplicate_distance)
+            return {"job_id": job.id}, 202
+        duplicates = helper.add_document_to_knowledge_base(
+            document, store_path+knowledge_base,
+            near_duplicate_distance=near_duplicate_distance)
     except Exception:
         return {"error": "Cannot add document to knowledge base, "
                 "check request data"}, 400
-    return {"message": "Document added to knowledge base"}, 200
+    return {"message": "Document added to knowledge base",
+            "duplicates": duplicates}, 200
+
+
+@bp.post('/documents')
+def add_documents():
+    request_data = request.get_json()
+    logger.info(f"add_documents(): {request_data}")
+    knowledge_base = request_data.get("knowledge_base")
+    documents = request_data.get("documents")
+    near_duplicate_distance = request_data.get("near_duplicate_distance")
+    try:
+        batch_size = int(request_data.get("batch_size", 64))
+        if request_data.get("async"):
+            job = job_queue.submit(
+                "add_documents", store_path+knowledge_base,
+                helper.add_documents_to_knowledge_base, documents,
+                store_path+knowledge_base, batch_size=batch_size,
+                near_duplicate_distance=near_duplicate_distance,
+                track_progress=True)
+            return {"job_id": job.id}, 202
+        report = helper.add_documents_to_knowledge_base(
+            documents, store_path+knowledge_base, batch_size=batch_size,
+            near_duplicate_distance=near_duplicate_distance)
+    except Exception:
+        return {"error": "Cannot add documents to knowledge base, "
+                "check request data"}, 400
+    return report, 200
 
 
 @bp.delete('/document')
@@ -25,6 +63,12 @@ def delete_document():
     knowledge_base = request_data.get("knowledge_base")
     document = request_data.get("document")
     try:
+        if request_data.get("async"):
+            job = job_queue.submit("delete_document",
+                                   store_path+knowledge_base,
+                                   helper.delete_document_from_knowledge_base,
+                                   document, store_path+knowledge_base)
+            return {"job_id": job.id}, 202
         helper.delete_document_from_knowledge_base(document,
                                                    store_path+knowledge_base)
     except Exception:
@@ -37,16 +81,150 @@ def get_similar_documents():
     logger.info(f"get_similar_documents(): {request.args}")
     query_doc = request.args.get('query_doc')
     knowledge_base = request.args.get('knowledge_base')
+    nprobe = request.args.get('nprobe', type=int)
+    ef_search = request.args.get('ef_search', type=int)
+    k = request.args.get('k', default=4, type=int)
+    max_distance = request.args.get('max_distance', type=float)
+    rerank = request.args.get('rerank', type=int)
+    include_content = _is_true(request.args.get('include_content', 'true'))
     try:
-        similar_docs = helper.find_similar_document(query_doc,
-                                                    store_path+knowledge_base)
+        where = json.loads(request.args.get('filter', '{}'))
+        if request.args.get('source'):
+            where["source"] = request.args.get('source')
+        similar_docs = helper.find_similar_document(
+            query_doc, store_path+knowledge_base, nprobe=nprobe,
+            ef_search=ef_search, k=k, max_distance=max_distance,
+            where=where, rerank=rerank)
     except Exception:
         return {"error": "Cannot get similar documents, "
                 "check query params"}, 400
+    return {"documents": serialize_documents(similar_docs,
+                                             include_content)}, 200
+
+
+@bp.get('/documents/federated')
+def get_similar_documents_federated():
+    logger.info(f"get_similar_documents_federated(): {request.args}")
+    query_doc = request.args.get('query_doc')
+    names = [name for value in request.args.getlist('knowledge_bases')
+             for name in value.split(',') if name]
+    if request.args.get('prefix') is not None:
+        names += storage.list_knowledge_bases(store_path,
+                                              request.args.get('prefix'))
+    k = request.args.get('k', default=4, type=int)
+    budget_ms = request.args.get('budget_ms', type=float)
+    include_content = _is_true(request.args.get('include_content', 'true'))
+    try:
+        where = json.loads(request.args.get('filter', '{}'))
+        if request.args.get('source'):
+            where["source"] = request.args.get('source')
+        hits, knowledge_bases = helper.find_similar_document_federated(
+            query_doc, [store_path+name for name in names], k=k,
+            nprobe=request.args.get('nprobe', type=int),
+            ef_search=request.args.get('ef_search', type=int),
+            max_distance=request.args.get('max_distance', type=float),
+            where=where, rerank=request.args.get('rerank', type=int),
+            budget=None if budget_ms is None else budget_ms / 1000)
+    except Exception:
+        return {"error": "Cannot get similar documents, "
+                "check query params"}, 400
+    documents = serialize_documents([(doc, score) for _, doc, score in hits],
+                                    include_content)
+    for document, (knowledge_base, _, _) in zip(documents, hits):
+        document["knowledge_base"] = knowledge_base[len(store_path):]
+    return {"documents": documents,
+            "knowledge_bases": {knowledge_base[len(store_path):]: outcome
+                                for knowledge_base, outcome
+                                in knowledge_bases.items()}}, 200
+
+
+@bp.post('/documents/search')
+def search_similar_documents():
+    request_data = request.get_json()
+    logger.info(f"search_similar_documents(): {request_data}")
+    knowledge_base = request_data.get("knowledge_base")
+    query_docs = request_data.get("query_docs")
+    try:
+        k = int(request_data.get("k", 4))
+        max_distance = request_data.get("max_distance")
+        where = dict(request_data.get("filter") or {})
+        if request_data.get("source"):
+            where["source"] = request_data.get("source")
+        similar_docs = helper.find_similar_documents(
+            query_docs, store_path+knowledge_base, k=k,
+            nprobe=request_data.get("nprobe"),
+            ef_search=request_data.get("ef_search"),
+            max_distance=None if max_distance is None
+            else float(max_distance),
+            where=where, rerank=request_data.get("rerank"))
+    except Exception:
+        return {"error": "Cannot get similar documents, "
+                "check request data"}, 400
+    include_content = request_data.get("include_content", True)
     response = []
-    for docs in similar_docs:
-        doc, score = docs
-        response.append({"document": doc.metadata["source"],
-                         "content": doc.page_content, "score": str(score)})
+    for query_doc, docs in zip(query_docs, similar_docs):
+        response.append({"query_doc": query_doc,
+                         "documents": serialize_documents(docs,
+                                                          include_content)})
+    return {"results": response}, 200
+
+
+@bp.get('/document_store')
+def list_stored_documents():
+    logger.info("list_stored_documents()")
+    return {"documents": helper.list_documents()}, 200
+
+
+@bp.put('/document_store/<name>')
+def store_document(name):
+    logger.info(f"store_document(): {name}")
+    try:
+        stored = helper.store_document(name, request.stream)
+    except Exception:
+        return {"error": "Cannot store document, check request data"}, 400
+    return stored, 200
+
+
+@bp.post('/document_store/register')
+def register_documents():
+    request_data = request.get_json()
+    logger.info(f"register_documents(): {request_data}")
+    directory = request_data.get("directory")
+    pattern = request_data.get("pattern", "*")
+    if helper.document_import_root is None:
+        return {"error": "Registering directories is disabled, "
+                "set DOCUMENT_IMPORT_ROOT"}, 403
+    try:
+        stored = helper.register_documents(
+            directory, pattern, root=helper.document_import_root)
+    except Exception:
+        return {"error": "Cannot register documents, "
+                "check request data"}, 400
+    return {"documents": stored, "count": len(stored)}, 200
+
+
+@bp.delete('/document_store/<name>')
+def delete_stored_document(name):
+    logger.info(f"delete_stored_document(): {name}")
+    try:
+        helper.delete_stored_document(name)
+    except Exception:
+        return {"error": "Cannot delete document, check request data"}, 400
+    return {"message": "Document deleted from document store"}, 200
+
+
+def serialize_documents(similar_docs, include_content=True):
+    with metrics.stage("serialize"):
+        response = []
+        for docs in similar_docs:
+            doc, score = docs
+            serialized = {"document": doc.metadata["source"],
+                          "score": str(score)}
+            if include_content:
+                serialized["content"] = doc.page_content
+            response.append(serialized)
+        return response
+
 
-    return {"documents": response}, 200
+def _is_true(value: str):
+    return value.lower() not in ("false", "0", "no")
@@ -0,0 +1,376 @@
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from app import logger
+
+
+def text_hash(text: str):
+    """SHA-256 hex digest of a text, used as its cache key"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache stored in a SQLite file.
+    Vectors are keyed by (model name, hash of text) and the least recently
+    used ones are evicted once more than `max_entries` are stored. The
+    time a vector was last used is only rewritten once it is older than
+    `touch_interval`, and the number of stored vectors is kept in memory
+    and only counted again every `recount_interval` puts, to pick up
+    vectors stored by other processes
+
+    Parameters
+    ----------
+    path: str
+        SQLite file holding the cache
+    max_entries: int
+        Maximum number of vectors to keep
+    touch_interval: float
+        Seconds under which a hit does not update the vector's last use
+    recount_interval: int
+        Number of puts between two counts of the stored vectors
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000,
+                 touch_interval: float = 60, recount_interval: int = 100):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.recount_interval = recount_interval
+        self.hits = 0
+        self.misses = 0
+        self._count = None
+        self._puts = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings ("
+                         "model TEXT NOT NULL, hash TEXT NOT NULL, "
+                         "vector BLOB NOT NULL, last_used REAL NOT NULL, "
+                         "PRIMARY KEY (model, hash))")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used "
+                         "ON embeddings (last_used)")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, model: str, hashes: list):
+        """
+        Looks up cached vectors
+
+        Parameters
+        ----------
+        model: str
+            Name of the model that produced the vectors
+        hashes: list
+            Text hashes to look up
+
+        Returns
+        -------
+        dict
+            Cached vectors by hash, missing hashes are left out
+        """
+        found = {}
+        conn = self._connection()
+        unique = list(dict.fromkeys(hashes))
+        now = time.time()
+        stale = []
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(unique), 500):
+            batch = unique[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT hash, vector, last_used FROM embeddings "
+                f"WHERE model = ? AND hash IN ({marks})",
+                [model, *batch]).fetchall()
+            for key, blob, last_used in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                if now - last_used >= self.touch_interval:
+                    stale.append(key)
+        if stale:
+            with conn:
+                for start in range(0, len(stale), 500):
+                    batch = stale[start:start + 500]
+                    marks = ",".join("?" * len(batch))
+                    conn.execute(
+                        f"UPDATE embeddings SET last_used = ? WHERE model = ? "
+                        f"AND hash IN ({marks})", [now, model, *batch])
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(unique) - len(found)
+        return found
+
+    def put_many(self, model: str, vectors: dict):
+        """
+        Stores vectors and evicts the least recently used ones when the
+        cache is over its size bound
+
+        Parameters
+        ----------
+        model: str
+            Name of the model that produced the vectors
+        vectors: dict
+            Vectors by text hash
+        """
+        if not vectors:
+            return
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            # A vector stored meanwhile is the same one, so it is kept
+            inserted = conn.executemany(
+                "INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)",
+                [(model, key, np.asarray(vector, dtype=np.float32).tobytes(),
+                  now) for key, vector in vectors.items()]).rowcount
+            with self._lock:
+                self._puts += 1
+                recount = self._count is None or \
+                    self._puts % self.recount_interval == 0
+                if not recount:
+                    self._count += inserted
+                    count = self._count
+            if recount:
+                count = conn.execute(
+                    "SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid "
+                    "FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+                count, recount = self.max_entries, True
+            if recount:
+                with self._lock:
+                    self._count = count
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            Hit/miss counters of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Embedding model that is only built, by calling `factory`, the first
+    time a text has to be embedded
+
+    Parameters
+    ----------
+    factory: callable
+        Returns the embedding model
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.load_seconds = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        """
+        Returns
+        -------
+        Embeddings
+            The embedding model, built on first call
+        """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = self.factory()
+                    self.load_seconds = time.perf_counter() - start
+                    logger.info(f"LazyEmbeddings.load(): model loaded in "
+                                f"{self.load_seconds:.2f}s")
+        return self._model
+
+    def embed_documents(self, texts: list):
+        return self.load().embed_documents(texts)
+
+    def embed_query(self, text: str):
+        return self.load().embed_query(text)
+
+
+class _BatchRequest:
+    """Texts of one `BatchingEmbeddings` call waiting to be embedded"""
+
+    def __init__(self, texts: list):
+        self.texts = texts
+        self.enqueued = time.monotonic()
+        self.vectors = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings that combine the texts of concurrent calls into one model
+    call. Calls are queued and a single worker thread embeds them, waiting
+    up to `max_wait` seconds after the oldest queued call for more texts
+    until `max_batch_size` texts are queued. A call with more texts than
+    `max_batch_size` is embedded on its own
+
+    Parameters
+    ----------
+    model: Embeddings
+        Model every batch is embedded with
+    max_batch_size: int
+        Number of texts after which a batch is embedded without waiting
+    max_wait: float
+        Seconds a call waits for other calls to join its batch
+    """
+
+    def __init__(self, model: Embeddings, max_batch_size: int = 64,
+                 max_wait: float = 0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._worker = None
+
+    def load(self):
+        """Loads the underlying model"""
+        return self.model.load()
+
+    def embed_documents(self, texts: list):
+        if not texts:
+            return []
+        request = _BatchRequest(list(texts))
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+            self._pending.append(request)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vectors
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            Number of model calls and of texts embedded by them
+        """
+        with self._condition:
+            return {"batches": self.batches, "texts": self.texts,
+                    "mean_batch_size":
+                        self.texts / self.batches if self.batches else 0.0}
+
+    def _next_batch(self):
+        """Waits for queued calls and takes the next batch of them"""
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            deadline = self._pending[0].enqueued + self.max_wait
+            while sum(len(request.texts) for request in self._pending) < \
+                    self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = [self._pending.popleft()]
+            size = len(batch[0].texts)
+            while self._pending and \
+                    size + len(self._pending[0].texts) <= self.max_batch_size:
+                size += len(self._pending[0].texts)
+                batch.append(self._pending.popleft())
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            # Calls made at the same time often embed the same query text
+            unique = list(dict.fromkeys(
+                text for request in batch for text in request.texts))
+            try:
+                vectors = dict(zip(unique,
+                                   self.model.embed_documents(unique)))
+            except Exception as e:
+                logger.error(f"BatchingEmbeddings: embedding failed: {e}")
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            with self._condition:
+                self.batches += 1
+                self.texts += len(unique)
+            for request in batch:
+                request.vectors = [vectors[text] for text in request.texts]
+                request.done.set()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that look vectors up in an `EmbeddingCache` before calling
+    the underlying model, so identical text is only ever embedded once
+
+    Parameters
+    ----------
+    model: Embeddings
+        Model used for texts missing from the cache
+    model_name: str
+        Name of the model, part of the cache key
+    cache: EmbeddingCache
+        Cache to read from and write to
+    """
+
+    def __init__(self, model: Embeddings, model_name: str,
+                 cache: EmbeddingCache):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts: list):
+        hashes = [text_hash(text) for text in texts]
+        try:
+            found = self.cache.get_many(self.model_name, hashes)
+        except sqlite3.Error as e:
+            logger.error(f"CachedEmbeddings: cache lookup failed: {e}")
+            found = {}
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.model.embed_documents(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            try:
+                self.cache.put_many(self.model_name, computed)
+            except sqlite3.Error as e:
+                logger.error(f"CachedEmbeddings: cache write failed: {e}")
+            found.update(computed)
+        return [found[key] for key in hashes]
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
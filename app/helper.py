@@ -1,11 +1,21 @@
+import itertools
+import json
 import shutil
-import pandas as pd
+import threading
+import time
+import uuid
+import numpy as np
 import os
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import FAISS
-from langchain.embeddings import SentenceTransformerEmbeddings
-from langchain.schema.document import Document
-from app import logger
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from app import (document_stores, logger, metrics, startup_timings,
+                 store_path, storage)
+from app.cache import LRUCache
+from app.job_queue import job_queue
+
+# langchain, FAISS and the embedding model are slow to import and load, so
+# they are imported inside the functions that need them and the model is
+# only loaded on first use. Call warm_up() to pay that cost up front
 
 
 documents_store = {
@@ -17,12 +27,492 @@ documents_store = {
     "greetings.pdf": "A warmth hello from your great pub. We serve or beer cold"
 }
 
-# Create embedding
-embeddings = SentenceTransformerEmbeddings(
-    model_name="sentence-transformers/all-MiniLM-L12-v2")
+# Store documents are read from. Set DOCUMENT_STORE_PATH to keep them on
+# disk, the sample `documents_store` above is served from memory otherwise
+document_store = document_stores.open_document_store(
+    os.environ.get("DOCUMENT_STORE_PATH"), documents_store)
+
+# Directory `POST /document_store/register` may read files from, the
+# route is disabled when unset
+document_import_root = os.environ.get("DOCUMENT_IMPORT_ROOT")
+
+model_name = "sentence-transformers/all-MiniLM-L12-v2"
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+
+@contextmanager
+def _timed(stage: str):
+    """Records the duration of a startup stage in `startup_timings`"""
+    start = time.perf_counter()
+    yield
+    startup_timings[stage] = time.perf_counter() - start
+
+
+def _load_model():
+    with _timed("import_sentence_transformers"):
+        from langchain.embeddings import SentenceTransformerEmbeddings
+        import sentence_transformers  # noqa: F401
+    with _timed("load_model"):
+        return SentenceTransformerEmbeddings(model_name=model_name)
+
+
+def get_embeddings():
+    """
+    Returns the shared embeddings, creating them on first use. Vectors are
+    looked up in a persistent cache keyed by (model name, text hash)
+    before the model is called, and the model is only loaded once a text
+    missing from the cache has to be embedded. Texts missing from the
+    cache in concurrent requests are embedded together in micro-batches
+
+    Returns
+    -------
+    CachedEmbeddings
+        Embeddings used for ingest and queries
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                with _timed("open_embedding_cache"):
+                    from app.embeddings import (BatchingEmbeddings,
+                                                CachedEmbeddings,
+                                                EmbeddingCache,
+                                                LazyEmbeddings)
+                    cache = EmbeddingCache(
+                        os.path.join(store_path, "embedding_cache.sqlite"),
+                        max_entries=int(os.environ.get(
+                            "EMBEDDING_CACHE_SIZE", 100000)))
+                model = BatchingEmbeddings(
+                    LazyEmbeddings(_load_model),
+                    max_batch_size=int(os.environ.get(
+                        "EMBEDDING_BATCH_SIZE", 64)),
+                    max_wait=float(os.environ.get(
+                        "EMBEDDING_BATCH_WAIT_MS", 5)) / 1000)
+                _embeddings = CachedEmbeddings(model, model_name, cache)
+    return _embeddings
+
+
+def warm_up():
+    """
+    Imports langchain and FAISS and loads the embedding model so the first
+    request does not pay for them
+
+    Returns
+    -------
+    dict
+        Seconds spent in each startup stage
+    """
+    logger.info("warm_up()")
+    with _timed("import_langchain"):
+        from app import segments  # noqa: F401
+        from langchain.text_splitter import CharacterTextSplitter  # noqa
+    get_embeddings().model.load()
+    return dict(startup_timings)
+
+
+def _loaded_size(loaded):
+    """Approximate private memory held by the segments of a cached entry"""
+    return sum(segment.memory_bytes() for segment in loaded[2].values())
+
+
+# Loaded knowledge bases, keyed by knowledge base path, each with the
+# identity of the manifest file it was loaded from, the manifest and its
+# opened segments by segment id, with their deleted vectors left out.
+# Bounded by knowledge base count and, optionally, by the approximate
+# memory the segments hold outside the page cache
+knowledge_base_cache = LRUCache(
+    maxsize=int(os.environ.get("KB_CACHE_SIZE", 16)),
+    max_bytes=int(os.environ["KB_CACHE_MAX_BYTES"])
+    if os.environ.get("KB_CACHE_MAX_BYTES") else None,
+    sizeof=_loaded_size)
+
+# Number of delta segments a knowledge base can hold before adds fold them
+# into its base segment
+max_delta_segments = int(os.environ.get("KB_MAX_DELTA_SEGMENTS", 8))
+
+# Compaction job queued or running for each knowledge base, keyed by
+# knowledge base path, so writes queue at most one more
+compaction_jobs = {}
+_compaction_lock = threading.Lock()
+
+# Share of the stored vectors of a knowledge base that deletes can leave
+# behind as tombstones before they are purged by compaction
+max_deleted_ratio = float(os.environ.get("KB_MAX_DELETED_RATIO", 0.5))
+
+# Results of single document queries, keyed by knowledge base version,
+# query text hash and search parameters, so a write to a knowledge base
+# makes its cached results unreachable
+result_cache = LRUCache(
+    maxsize=int(os.environ.get("KB_RESULT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ["KB_RESULT_CACHE_TTL_SECONDS"])
+    if os.environ.get("KB_RESULT_CACHE_TTL_SECONDS") else None)
+
+# Number of knowledge bases a federated search searches at the same time
+federated_search_workers = int(os.environ.get("KB_SEARCH_WORKERS", 8))
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+# Documents are split into chunks on blank lines
+CHUNK_SEPARATOR = "\n\n"
+
+# Default distance under which an added chunk counts as a near-duplicate of
+# a stored one and is dropped. Unset disables near-duplicate detection
+default_near_duplicate_distance = float(
+    os.environ["KB_NEAR_DUPLICATE_DISTANCE"]) \
+    if os.environ.get("KB_NEAR_DUPLICATE_DISTANCE") else None
+
+
+def load_knowledge_base(knowledge_base: str):
+    """
+    Opens the segments of a knowledge base, reusing the ones kept in
+    `knowledge_base_cache`. The cached entry is reloaded once a write
+    replaced the manifest, and segments never change once written, so
+    the segments the write kept are reused, with the vectors of deleted
+    documents left out. Vectors and indexes are
+    memory-mapped, so opening a segment reads neither them nor its chunks
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to load
+
+    Returns
+    -------
+    list
+        Segment of each segment id, base segment first
+    """
+    return _load_knowledge_base(knowledge_base)[1]
+
+
+def _load_knowledge_base(knowledge_base: str):
+    """
+    Manifest and segments of a knowledge base, see load_knowledge_base.
+    The manifest is only parsed again once a write replaced it, and must
+    not be modified
+    """
+    from app.segments import Segment
+
+    with metrics.stage("load"):
+        key = os.path.normpath(knowledge_base)
+        identity, manifest = storage.cached_manifest(knowledge_base)
+        cached = knowledge_base_cache.get(key)
+        if cached is not None and cached[0] == identity:
+            return cached[1], list(cached[2].values())
+        opened = cached[2] if cached is not None else {}
+        tombstones = cached[1]["tombstones"] if cached is not None else {}
+        segments = {}
+        for segment_id in manifest["segments"]:
+            segment = opened.get(segment_id)
+            if segment is None:
+                segment = Segment(storage.segment_path(knowledge_base,
+                                                       segment_id))
+            elif tombstones.get(segment_id) == \
+                    manifest["tombstones"].get(segment_id):
+                segments[segment_id] = segment
+                continue
+            segments[segment_id] = segment.with_deleted(
+                storage.read_tombstones(knowledge_base, segment_id,
+                                        manifest))
+        knowledge_base_cache.put(key, (identity, manifest, segments))
+    return manifest, list(segments.values())
+
+
+def invalidate_knowledge_base(knowledge_base: str):
+    """
+    Drops the query results of a knowledge base from `result_cache` after
+    a write. Its `knowledge_base_cache` entry is kept, the next query
+    reloads it from the new manifest and reuses its unchanged segments
+    """
+    result_cache.invalidate(os.path.normpath(knowledge_base))
+
+
+def _check_filter(where: dict):
+    """Raises ValueError unless `where` maps metadata keys to scalars"""
+    if not isinstance(where, dict):
+        raise ValueError("Filter must map metadata keys to values")
+    for key, value in where.items():
+        if not isinstance(key, str) or '"' in key:
+            raise ValueError(f"Invalid filter key {key!r}")
+        if not isinstance(value, (str, int, float, bool)):
+            raise ValueError(f"Filter value of {key} must be a scalar")
+
+
+def search_knowledge_base(knowledge_base: str, vectors, k: int = 4,
+                          nprobe: int = None, ef_search: int = None,
+                          max_distance: float = None, where: dict = None,
+                          rerank: int = None):
+    """
+    Searches every segment of a knowledge base and merges the hits. The
+    filter restricts the search inside each segment, so every query gets
+    up to `k` matching hits without over-fetching. Only the chunks of the
+    merged top-k hits are read from the docstores
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to search
+    vectors: np.ndarray
+        Query vectors, one row per query
+    k: int
+        Number of hits to return per query
+    nprobe: int
+        Number of inverted lists visited in IVF segments, defaults to the
+        knowledge base setting
+    ef_search: int
+        Size of the candidate list explored in HNSW segments, defaults to
+        the knowledge base setting
+    max_distance: float
+        Drop hits further than this squared L2 distance
+    where: dict
+        Only return chunks whose metadata has every key set to its value,
+        e.g. {"source": "beer.pdf"}
+    rerank: int
+        Re-score `rerank` times `k` candidates of each indexed segment
+        against the full-precision vectors, defaults to the knowledge base
+        setting. 0 disables re-ranking
+
+    Returns
+    -------
+    list
+        Top-k (document, distance) hits of every query, closest first
+    """
+    if k < 1:
+        raise ValueError("k must be a positive int")
+    if rerank is not None and rerank < 0:
+        raise ValueError("rerank must be a non-negative int")
+    if where:
+        _check_filter(where)
+    manifest, segments = _load_knowledge_base(knowledge_base)
+    if rerank is None:
+        rerank = manifest["index"].get("rerank")
+    with metrics.stage("search"):
+        results = []
+        for position, segment in enumerate(segments):
+            faiss_ids = segment.matching_ids(where) if where else None
+            if faiss_ids is not None and not len(faiss_ids):
+                continue
+            scores, indices = segment.search(vectors, k, nprobe, ef_search,
+                                             faiss_ids=faiss_ids,
+                                             rerank=rerank)
+            results.append(_hits(position, scores, indices, max_distance))
+        merged = storage.merge_results(results, k) or [[] for _ in vectors]
+        hit_ids = {}
+        for hits in merged:
+            for (position, faiss_id), _ in hits:
+                hit_ids.setdefault(position, []).append(faiss_id)
+        documents = {position: segments[position].get_documents(faiss_ids)
+                     for position, faiss_ids in hit_ids.items()}
+        return [[(documents[position][faiss_id], score)
+                 for (position, faiss_id), score in hits] for hits in merged]
+
+
+def _hits(position: int, scores, indices, max_distance: float = None):
+    """
+    Hits of a segment search, as ((segment position, FAISS id), distance)
+    per query, leaving out missing and too distant ones
+    """
+    return [[((position, int(i)), float(score))
+             for score, i in zip(row_scores, row_indices) if i != -1 and
+             (max_distance is None or score <= max_distance)]
+            for row_scores, row_indices in zip(scores, indices)]
+
+
+def _write_segment(knowledge_base: str, vectors, chunks: list, index=None):
+    """
+    Writes vectors and their chunks as a new, unpublished segment
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base the segment belongs to
+    vectors: np.ndarray
+        Full vectors of the segment
+    chunks: list
+        Chunk id and chunk of each vector
+    index: faiss.Index
+        Approximate index over `vectors`, None for a flat segment
+
+    Returns
+    -------
+    tuple
+        Id of the new segment and names of the documents it holds
+    """
+    from app import segments
+
+    segment_id = storage.new_segment_id()
+    with metrics.stage("save"):
+        segments.write_segment(storage.segment_path(knowledge_base,
+                                                    segment_id),
+                               vectors, chunks, index=index)
+    names = list(dict.fromkeys(segments.document_name(doc)
+                               for _, doc in chunks))
+    return segment_id, names
+
+
+def _target_index(manifest: dict):
+    """
+    Index configuration the base segment should be built with, flat until
+    the knowledge base holds enough vectors to train its configured index.
+    Once the base segment is built with it, the configured index is kept
+    whatever the number of vectors, so deletes around the threshold do not
+    switch the base between flat and trained indexes. Quantized flat
+    indexes are built from the first compaction on
+    """
+    from app import indexes
+
+    config = manifest["index"]
+    if manifest["base_index"] != indexes.index_name(config) and \
+            storage.live_vectors(manifest) < indexes.min_train_vectors(config):
+        return {"type": "flat"}
+    return config
+
+
+def _build_base_index(config: dict, vectors, manifest: dict, base):
+    """
+    Index of the base segment over `vectors`. Once the base segment has
+    the configured index, a base too small to train it again is filled
+    into a copy of its trained index
+
+    Parameters
+    ----------
+    config: dict
+        Index configuration to build
+    vectors: np.ndarray
+        Vectors of the new base segment
+    manifest: dict
+        Manifest the current `base` segment is published in
+    base: Segment
+        Current base segment
+    """
+    from app import indexes
+
+    if manifest["base_index"] == indexes.index_name(config) and \
+            base.index is not None and \
+            len(vectors) < indexes.min_train_vectors(config):
+        index = base.writable_index()
+        index.reset()
+        index.add(vectors)
+        return index
+    return indexes.build_index(config, vectors)
+
+
+def compact_knowledge_base(knowledge_base: str):
+    """
+    Folds the delta segments of a knowledge base into its base segment,
+    building the base with the knowledge base's index type once it holds
+    enough vectors to train it. Deleted vectors are purged. The merged
+    segment is built from a snapshot without holding the write lock, so
+    writes go on meanwhile: segments added since are kept as deltas and
+    documents deleted since are deleted from the merged segment
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to compact
+    """
+    from app import indexes, segments
+
+    logger.info(f"compact_knowledge_base(): {knowledge_base}")
+    with storage.compaction_lock(knowledge_base):
+        snapshot, loaded = _load_knowledge_base(knowledge_base)
+        segment_ids = snapshot["segments"]
+        config = _target_index(snapshot)
+        name = indexes.index_name(config)
+        if not segment_ids or (len(segment_ids) == 1 and
+                               snapshot["base_index"] == name and
+                               not snapshot["tombstones"]):
+            return
+        vectors = np.vstack([segment.live_vectors() for segment in loaded])
+        index = None
+        if name != "flat":
+            index = _build_base_index(config, vectors, snapshot, loaded[0])
+        segment_id = storage.new_segment_id()
+        path = storage.staging_path(knowledge_base, segment_id)
+        with metrics.stage("save"):
+            segments.write_segment(
+                path, vectors, itertools.chain.from_iterable(
+                    segment.iter_chunks() for segment in loaded),
+                index=index)
+        with storage.write_lock(knowledge_base):
+            manifest = storage.read_manifest(knowledge_base) \
+                if storage.exists(knowledge_base) else None
+            deleted = _deleted_since(knowledge_base, manifest, snapshot,
+                                     loaded) if manifest else None
+            if manifest is None or len(deleted) == len(vectors):
+                # Everything merged was deleted since the snapshot
+                shutil.rmtree(path, ignore_errors=True)
+                return
+            storage.adopt_staged_segment(knowledge_base, segment_id)
+            tombstones = {
+                key: tombstones for key, tombstones
+                in manifest["tombstones"].items() if key not in segment_ids}
+            if len(deleted):
+                tombstones[segment_id] = {
+                    "file": storage.write_tombstones(
+                        knowledge_base, segment_id, deleted),
+                    "count": len(deleted)}
+            retired = [key for key in manifest["segments"]
+                       if key in segment_ids]
+            manifest["segments"] = [segment_id] + [
+                key for key in manifest["segments"]
+                if key not in segment_ids]
+            manifest["vector_counts"][segment_id] = len(vectors)
+            manifest["tombstones"] = tombstones
+            manifest["base_index"] = name
+            storage.publish_manifest(knowledge_base, manifest,
+                                     retired=retired)
+            invalidate_knowledge_base(knowledge_base)
 
 
-def create_knowledge_base(doc_name: str, knowledge_base: str):
+def _deleted_since(knowledge_base: str, manifest: dict, snapshot: dict,
+                   loaded: list):
+    """
+    FAISS ids, in the segment merging the `loaded` segments, of the
+    vectors deleted from them since the `snapshot` manifest. Compactions
+    run one at a time, so a merged segment missing from the current
+    `manifest` was emptied by deletes
+    """
+    deleted, offset = [], 0
+    for segment_id, segment in zip(snapshot["segments"], loaded):
+        live = np.setdiff1d(np.arange(segment.ntotal), segment.deleted)
+        if segment_id in manifest["segments"]:
+            since = np.searchsorted(live, np.setdiff1d(
+                storage.read_tombstones(knowledge_base, segment_id,
+                                        manifest), segment.deleted))
+        else:
+            since = np.arange(len(live))
+        deleted.append(offset + since)
+        offset += len(live)
+    return np.concatenate(deleted)
+
+
+def schedule_compaction(knowledge_base: str):
+    """
+    Queues a compaction of a knowledge base on `job_queue`, unless one is
+    already waiting to run
+
+    Returns
+    -------
+    Job
+        The compaction job of the knowledge base
+    """
+    key = os.path.normpath(knowledge_base)
+    with _compaction_lock:
+        for path, job in list(compaction_jobs.items()):
+            if job.finished_at is not None:
+                del compaction_jobs[path]
+        job = compaction_jobs.get(key)
+        if job is None or job.state != "queued":
+            job = job_queue.submit("compact_knowledge_base", knowledge_base,
+                                   compact_knowledge_base, knowledge_base)
+            compaction_jobs[key] = job
+        return job
+
+
+def create_knowledge_base(doc_name: str, knowledge_base: str,
+                          index: dict = None):
     """
     Creates a new knowledge base if it doesn't exist.
     Raise exception if knowledge base already exist
@@ -33,14 +523,41 @@ def create_knowledge_base(doc_name: str, knowledge_base: str):
         document name to be added to knowledge base when created
     knowledge_base: str
         Name of knowledge base to create
+    index: dict
+        Index `type` of the knowledge base, one of "flat", "ivf", "hnsw"
+        or "ivfpq", and its settings. Defaults to flat. "quantization",
+        "fp16" or "int8", stores the index vectors in 2 or 1 bytes per
+        dimension and "rerank" sets the default re-ranking factor of
+        searches
+
+    Returns
+    -------
+    dict
+        Number of `exact` and `near` duplicate chunks of the document
+        skipped
     """
-    logger.info(f"create_knowledge_base(): {(doc_name, knowledge_base)}")
+    from app import indexes
 
-    if os.path.exists(knowledge_base):
-        logger.error("knowledge base already exists, update knowledge base")
+    logger.info(f"create_knowledge_base(): "
+                f"{(doc_name, knowledge_base, index)}")
+
+    try:
+        index = indexes.index_config(index)
+    except ValueError as e:
+        logger.error(f"create_knowledge_base(): {e}")
         raise Exception
-    logger.info("Creating new knowledge base... and adding document")
-    add_document_to_knowledge_base(doc_name, knowledge_base)
+    with storage.write_lock(knowledge_base):
+        if storage.exists(knowledge_base):
+            logger.error("knowledge base already exists, update knowledge "
+                         "base")
+            raise Exception
+        logger.info("Creating new knowledge base... and adding document")
+        duplicates = add_document_to_knowledge_base(doc_name, knowledge_base,
+                                                    index=index)
+    # Compactions take the write lock last, so the configured index is
+    # built once it is released
+    compact_knowledge_base(knowledge_base)
+    return duplicates
 
 
 def delete_knowledge_base(knowledge_base: str):
@@ -54,17 +571,25 @@ def delete_knowledge_base(knowledge_base: str):
         Name of knowledge base to be deleted
     """
     logger.info(f"delete_knowledge_base(): {(knowledge_base)}")
-    try:
-        shutil.rmtree(knowledge_base)
-    except OSError as e:
-        logger.error("Error: %s - %s." % (e.filename, e.strerror))
-        raise OSError
+    with storage.write_lock(knowledge_base):
+        try:
+            shutil.rmtree(knowledge_base)
+        except OSError as e:
+            logger.error("Error: %s - %s." % (e.filename, e.strerror))
+            raise OSError
+        finally:
+            knowledge_base_cache.invalidate(os.path.normpath(knowledge_base))
+            invalidate_knowledge_base(knowledge_base)
 
 
-def add_document_to_knowledge_base(doc_name: str, knowledge_base: str):
+def add_document_to_knowledge_base(doc_name: str, knowledge_base: str,
+                                   index: dict = None,
+                                   near_duplicate_distance: float = None):
     """
     Adds document to an existing knowledge base. Creates
-    knowledge base if it does not exist
+    knowledge base if it does not exist. Chunks already in the knowledge
+    base are skipped. The document is chunked, embedded and written as it
+    is read, see `iter_document_chunks`
 
     Parameters
     ----------
@@ -72,22 +597,25 @@ def add_document_to_knowledge_base(doc_name: str, knowledge_base: str):
         document name to be added to knowledge base
     knowledge_base: str
         Name of knowledge base to add document to
+    index: dict
+        Index configuration used if the knowledge base is created
+    near_duplicate_distance: float
+        Also skip chunks within this distance of a stored chunk, defaults
+        to `default_near_duplicate_distance`
+
+    Returns
+    -------
+    dict
+        Number of `exact` and `near` duplicate chunks skipped
     """
     logger.info(f"add_document_to_knowledge_base(): "
                 f"{(doc_name, knowledge_base)}")
-    doc = documents_store.get(doc_name)
-    if not doc:
-        logger.error('Document not in document store')
-        raise Exception
-
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-    metadata = {'source': doc_name}
-    docs = [Document(page_content=x, metadata=metadata)
-            for x in text_splitter.split_text(doc)]
+    chunks = iter_document_chunks(doc_name)
 
     if os.path.exists(knowledge_base):
         try:
-            update_knowledge_base(docs, knowledge_base)
+            result = _ingest(chunks, knowledge_base,
+                             near_duplicate_distance=near_duplicate_distance)
         except Exception:
             logger.error("add_document_to_knowledge_base(): "
                          "Cannot add document to knowledge base")
@@ -95,28 +623,546 @@ def add_document_to_knowledge_base(doc_name: str, knowledge_base: str):
     else:
         logger.info("add_document_to_knowledge_base(): Knowledge base does "
                     "not exist, creating knowledge base")
-        db = FAISS.from_documents(docs, embeddings)
-        db.save_local(knowledge_base)
+        result = _ingest(chunks, knowledge_base, index=index,
+                         near_duplicate_distance=near_duplicate_distance)
+    return result["duplicates"]
+
+
+def open_document(doc_name: str):
+    """
+    Opens a document from the document store for reading
+
+    Parameters
+    ----------
+    doc_name: str
+        Name of document to open
+
+    Returns
+    -------
+    io.TextIOBase
+        Text stream of the document
+    """
+    try:
+        return document_store.open(doc_name)
+    except KeyError:
+        logger.error('Document not in document store')
+        raise Exception
+
+
+def store_document(doc_name: str, content):
+    """
+    Stores a document in the document store, replacing any document of
+    the same name
+
+    Parameters
+    ----------
+    doc_name: str
+        Name of document to store
+    content: str, bytes or file object
+        Text of the document, file objects are streamed to the store
+
+    Returns
+    -------
+    dict
+        Name, content hash and size in bytes of the stored document
+    """
+    logger.info(f"store_document(): {doc_name}")
+    if not doc_name:
+        logger.error('Document name is required')
+        raise Exception
+    return document_store.put(doc_name, content)
 
 
-def update_knowledge_base(docs: list, knowledge_base: str):
+def register_documents(directory: str, pattern: str = "*",
+                       root: str = None):
     """
-    Updates existing knowledge base with new document
+    Stores every file of a directory matching a glob pattern in the
+    document store, each named after its file name
 
     Parameters
     ----------
-    docs: list
-        Document embeddings to be updated to knowledge base
+    directory: str
+        Directory to read the files from, relative to `root` when given
+    pattern: str
+        Glob pattern file names must match
+    root: str
+        Directory files must be read from. Directories and files
+        resolving outside it are refused
+
+    Returns
+    -------
+    list
+        Name, content hash and size in bytes of each stored document
+    """
+    logger.info(f"register_documents(): {(directory, pattern, root)}")
+    if root is not None:
+        directory = os.path.join(root, directory)
+        if not document_stores.is_within(directory, root):
+            logger.error('Directory is outside the document import root')
+            raise Exception
+    if not os.path.isdir(directory):
+        logger.error('Directory does not exist')
+        raise Exception
+    return document_store.register_directory(directory, pattern, root=root)
+
+
+def list_documents():
+    """
+    Returns
+    -------
+    list
+        Name, content hash and size in bytes of every stored document
+    """
+    return document_store.infos()
+
+
+def delete_stored_document(doc_name: str):
+    """
+    Removes a document from the document store. Knowledge bases keep the
+    chunks already added from it
+
+    Parameters
+    ----------
+    doc_name: str
+        Name of document to remove
+    """
+    logger.info(f"delete_stored_document(): {doc_name}")
+    try:
+        document_store.delete(doc_name)
+    except KeyError:
+        logger.error('Document not in document store')
+        raise Exception
+
+
+def iter_document_chunks(doc_name: str, chunk_size: int = 1000,
+                         read_size: int = 1 << 20):
+    """
+    Splits a document from the document store into chunks as it is read,
+    `read_size` characters at a time, so the whole document is never held
+    in memory. Chunks are the same as those of langchain's
+    `CharacterTextSplitter` without overlap, except that text running
+    longer than `chunk_size` without a separator is cut into chunks of
+    `chunk_size` characters rather than kept whole
+
+    Parameters
+    ----------
+    doc_name: str
+        Name of document to split
+    chunk_size: int
+        Size of the chunks, in characters
+    read_size: int
+        Number of characters read at a time
+
+    Returns
+    -------
+    iterator
+        Chunks of the document, with the document name as `source`
+    """
+    from langchain.schema.document import Document
+
+    stream = open_document(doc_name)
+    metadata = {'source': doc_name}
+
+    def chunks():
+        with stream:
+            splits = _read_splits(stream, CHUNK_SEPARATOR, read_size,
+                                  chunk_size)
+            for text in _merge_splits(splits, CHUNK_SEPARATOR, chunk_size):
+                yield Document(page_content=text, metadata=metadata)
+    return chunks()
+
+
+def _read_splits(stream, separator: str, read_size: int, max_size: int):
+    """
+    Yields the non-empty pieces of a text stream between separators. Text
+    running longer than `max_size` characters without a separator is cut
+    into pieces of `max_size` characters as it is read, so at most
+    `max_size` plus `read_size` characters are held
+    """
+    # The characters a separator split across two reads may start with
+    keep = len(separator) - 1
+    tail = ""
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        pieces = (tail + block).split(separator)
+        tail = pieces.pop()
+        for piece in pieces:
+            yield from _cut(piece, max_size)
+        while len(tail) - keep > max_size:
+            yield tail[:max_size]
+            tail = tail[max_size:]
+    yield from _cut(tail, max_size)
+
+
+def _cut(text: str, size: int):
+    """Yields the non-empty pieces of `size` characters of a text"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def _merge_splits(splits, separator: str, chunk_size: int):
+    """
+    Joins consecutive pieces into chunks of at most `chunk_size`
+    characters, a piece longer than that making a chunk of its own
+    """
+    current, total = [], 0
+    for split in splits:
+        joined = len(separator) if current else 0
+        if current and total + len(split) + joined > chunk_size:
+            text = separator.join(current).strip()
+            if text:
+                yield text
+            current, total = [], 0
+        current.append(split)
+        total += len(split) + (len(separator) if len(current) > 1 else 0)
+    text = separator.join(current).strip()
+    if text:
+        yield text
+
+
+def add_documents_to_knowledge_base(doc_names: list, knowledge_base: str,
+                                    batch_size: int = 64, progress=None,
+                                    near_duplicate_distance: float = None):
+    """
+    Adds many documents to a knowledge base, creating it if it does not
+    exist. Chunks of all documents are streamed through embedding in
+    batches of `batch_size` and written once, as a single segment. Chunks
+    already in the knowledge base are skipped
+
+    Parameters
+    ----------
+    doc_names: list
+        Names of documents to be added to knowledge base
+    knowledge_base: str
+        Name of knowledge base to add documents to
+    batch_size: int
+        Number of chunks embedded per model call
+    progress: callable
+        Optional callback, called with the fraction of documents processed
+        after every batch
+    near_duplicate_distance: float
+        Also skip chunks within this distance of a stored chunk, defaults
+        to `default_near_duplicate_distance`
+
+    Returns
+    -------
+    dict
+        Outcome of each document under `documents`, counts of `added` and
+        `failed` documents, of `chunks` written and of `duplicates`
+        skipped, and ingest throughput in `docs_per_sec`
+    """
+    logger.info(f"add_documents_to_knowledge_base(): "
+                f"{(len(doc_names), knowledge_base, batch_size)}")
+    start = time.perf_counter()
+    outcomes, read = {}, []
+
+    def chunks():
+        for doc_name in doc_names:
+            try:
+                doc_chunks = iter_document_chunks(doc_name)
+            except Exception:
+                outcomes[doc_name] = "Document not in document store"
+            else:
+                outcomes[doc_name] = "added"
+                yield from doc_chunks
+            read.append(doc_name)
+
+    def report():
+        progress(len(read) / len(doc_names))
+
+    try:
+        written = _ingest(chunks(), knowledge_base, batch_size=batch_size,
+                          progress=report if progress else None,
+                          near_duplicate_distance=near_duplicate_distance)
+    except Exception:
+        logger.error("add_documents_to_knowledge_base(): "
+                     "Cannot add documents to knowledge base")
+        raise Exception
+
+    elapsed = time.perf_counter() - start
+    added = sum(outcome == "added" for outcome in outcomes.values())
+    return {"documents": outcomes, "added": added,
+            "failed": len(outcomes) - added, **written,
+            "seconds": elapsed,
+            "docs_per_sec": added / elapsed if elapsed else 0.0}
+
+
+def _new_chunk_batches(chunks, knowledge_base: str, batch_size: int,
+                       seen: set, counts: dict):
+    """
+    Yields batches of `batch_size` chunks, the last one possibly shorter,
+    dropping by text hash the chunks already in the knowledge base or in
+    `seen`. Hashes of the chunks kept are added to `seen` and dropped
+    chunks are counted in `counts["exact"]`
+    """
+    from app.embeddings import text_hash
+
+    stored = load_knowledge_base(knowledge_base) \
+        if storage.exists(knowledge_base) else []
+    pending = []
+    while True:
+        with metrics.stage("split"):
+            batch = list(itertools.islice(chunks, batch_size))
+        if not batch:
+            break
+        hashes = [text_hash(doc.page_content) for doc in batch]
+        found = set()
+        for segment in stored:
+            found.update(segment.existing_hashes(hashes))
+        for doc, key in zip(batch, hashes):
+            if key in found or key in seen:
+                counts["exact"] += 1
+                continue
+            seen.add(key)
+            pending.append(doc)
+        while len(pending) >= batch_size:
+            yield pending[:batch_size]
+            pending = pending[batch_size:]
+    if pending:
+        yield pending
+
+
+def _embedded_batches(batches):
+    """
+    Yields each batch of chunks with its vectors. Batches are embedded on
+    a worker thread, so the next batch is chunked while the model embeds
+    the current one
+    """
+    embeddings = get_embeddings()
+    stages = metrics.current_profile()
+
+    def embed(batch):
+        with metrics.bind_profile(stages), metrics.stage("embed"):
+            return np.array(embeddings.embed_documents(
+                [doc.page_content for doc in batch]), dtype=np.float32)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = None
+        for batch in batches:
+            future = pool.submit(embed, batch)
+            if pending is not None:
+                yield pending[0], pending[1].result()
+            pending = batch, future
+        if pending is not None:
+            yield pending[0], pending[1].result()
+
+
+def _drop_near_duplicates(docs: list, vectors, knowledge_base: str,
+                          max_distance: float, accepted):
+    """
+    Drops chunks within `max_distance` of a vector in the knowledge base
+    or in `accepted`, the index of the vectors kept so far. Vectors kept
+    are added to `accepted`
+
+    Returns
+    -------
+    tuple
+        Remaining chunks, their vectors and the number of chunks dropped
+    """
+    nearest = np.full(len(vectors), np.inf, dtype=np.float32)
+    if storage.exists(knowledge_base):
+        for segment in load_knowledge_base(knowledge_base):
+            distances, _ = segment.search(vectors, 1)
+            nearest = np.minimum(nearest, distances[:, 0])
+    keep = np.zeros(len(vectors), dtype=bool)
+    for i in np.flatnonzero(nearest > max_distance):
+        if accepted.ntotal:
+            distances, _ = accepted.search(vectors[i:i + 1], 1)
+            if distances[0][0] <= max_distance:
+                continue
+        accepted.add(vectors[i:i + 1])
+        keep[i] = True
+    docs = [doc for doc, kept in zip(docs, keep) if kept]
+    return docs, vectors[keep], len(keep) - len(docs)
+
+
+def _ingest(chunks, knowledge_base: str, index: dict = None,
+            batch_size: int = 64, progress=None,
+            near_duplicate_distance: float = None):
+    """
+    Embeds the chunks missing from a knowledge base and appends them as a
+    new segment. Chunks are consumed lazily and each embedded batch is
+    written straight to a staged segment, so memory holds a few batches
+    whatever the size of `chunks`. The write lock is only taken to publish
+    the segment. Exact duplicates are dropped by text hash before any
+    model call, and again under the write lock in case a concurrent write
+    added them. Near-duplicates are dropped when `near_duplicate_distance`,
+    or `default_near_duplicate_distance`, is set
+
+    Parameters
+    ----------
+    chunks: iterable
+        Chunks to add
+    knowledge_base: str
+        Knowledge base to add the chunks to
+    index: dict
+        Index configuration used if the knowledge base is created
+    batch_size: int
+        Number of chunks embedded per model call
+    progress: callable
+        Optional callback, called without arguments after every batch
+    near_duplicate_distance: float
+        Distance under which a chunk counts as a near-duplicate
+
+    Returns
+    -------
+    dict
+        Number of `chunks` written and of `exact` and `near` `duplicates`
+        skipped
+    """
+    import faiss
+    from app import segments
+
+    if near_duplicate_distance is None:
+        near_duplicate_distance = default_near_duplicate_distance
+    counts = {"exact": 0, "near": 0}
+    seen = set()
+    segment_id = storage.new_segment_id()
+    writer, accepted = None, None
+    try:
+        batches = _new_chunk_batches(iter(chunks), knowledge_base,
+                                     batch_size, seen, counts)
+        for batch, vectors in _embedded_batches(batches):
+            if near_duplicate_distance is not None:
+                if accepted is None:
+                    accepted = faiss.IndexFlatL2(vectors.shape[1])
+                batch, vectors, near = _drop_near_duplicates(
+                    batch, vectors, knowledge_base, near_duplicate_distance,
+                    accepted)
+                counts["near"] += near
+            with metrics.stage("save"):
+                if writer is None:
+                    writer = segments.SegmentWriter(
+                        storage.staging_path(knowledge_base, segment_id))
+                writer.add([(str(uuid.uuid4()), doc) for doc in batch],
+                           vectors)
+            if progress:
+                progress()
+        if writer is not None and not writer.ntotal:
+            writer.abort()
+            writer = None
+        if writer is not None:
+            with metrics.stage("save"):
+                writer.close()
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    written = 0
+    if writer is not None:
+        written, raced = _publish_staged(knowledge_base, segment_id,
+                                         list(seen), index=index)
+        counts["exact"] += raced
+    logger.info(f"_ingest(): {knowledge_base}: {written} chunks written, "
+                f"{counts['exact']} exact and {counts['near']} near "
+                f"duplicates")
+    return {"chunks": written, "duplicates": counts}
+
+
+def _publish_staged(knowledge_base: str, segment_id: str, hashes: list,
+                    index: dict = None):
+    """
+    Publishes a staged segment. Chunks whose text hash, among `hashes`, a
+    concurrent write added to the knowledge base since the segment was
+    staged are dropped first, by rewriting the segment
+
+    Returns
+    -------
+    tuple
+        Number of chunks published and of chunks dropped
+    """
+    from app import segments
+
+    with storage.write_lock(knowledge_base):
+        stored = set()
+        if storage.exists(knowledge_base):
+            for segment in load_knowledge_base(knowledge_base):
+                stored.update(segment.existing_hashes(hashes))
+        storage.adopt_staged_segment(knowledge_base, segment_id)
+        segment = segments.Segment(storage.segment_path(knowledge_base,
+                                                        segment_id))
+        raced = segment.ids_of_hashes(list(stored)) if stored else []
+        if not raced:
+            _publish_segment(knowledge_base, segment_id,
+                             segment.document_names(), segment.ntotal,
+                             index=index)
+            return segment.ntotal, 0
+
+        storage.remove_segments(knowledge_base, [segment_id])
+        if len(raced) == segment.ntotal:
+            return 0, len(raced)
+        keep = np.ones(segment.ntotal, dtype=bool)
+        keep[raced] = False
+        vectors = np.asarray(segment.vectors)[keep]
+        chunks = [chunk for chunk, kept in zip(segment.iter_chunks(), keep)
+                  if kept]
+        segment_id, names = _write_segment(knowledge_base, vectors, chunks)
+        _publish_segment(knowledge_base, segment_id, names, len(vectors),
+                         index=index)
+        return len(vectors), len(raced)
+
+
+def _publish_segment(knowledge_base: str, segment_id: str, names: list,
+                     count: int, index: dict = None):
+    """
+    Publishes a written segment of a knowledge base, creating the
+    knowledge base with the `index` configuration if it has no segments
+    yet. Schedules a compaction once the knowledge base has too many
+    delta segments, or once it holds enough vectors to build its
+    configured index
+    """
+    from app import indexes
+
+    with storage.write_lock(knowledge_base), \
+            storage.document_list(knowledge_base) as documents:
+        if storage.exists(knowledge_base):
+            manifest = storage.read_manifest(knowledge_base)
+        else:
+            manifest = storage.new_manifest(indexes.index_config(index))
+        manifest["segments"].append(segment_id)
+        manifest["document_count"] += documents.executemany(
+            "INSERT OR IGNORE INTO documents VALUES (?)",
+            [(name,) for name in names]).rowcount
+        manifest["vector_counts"][segment_id] = count
+        manifest = storage.publish_manifest(knowledge_base, manifest)
+        if len(manifest["segments"]) > max_delta_segments + 1 or \
+                manifest["base_index"] != \
+                indexes.index_name(_target_index(manifest)):
+            schedule_compaction(knowledge_base)
+
+
+def update_knowledge_base(docs, knowledge_base: str,
+                          near_duplicate_distance: float = None):
+    """
+    Updates existing knowledge base with new document. Only the new
+    vectors are written, as a delta segment. Delta segments are folded
+    into the base segment once there are more than `max_delta_segments`
+
+    Parameters
+    ----------
+    docs: iterable
+        Chunks to be added to knowledge base
     knowledge_base: str
         Name of knowledge base to update
+    near_duplicate_distance: float
+        Also skip chunks within this distance of a stored chunk
+
+    Returns
+    -------
+    dict
+        Number of `chunks` written and of `duplicates` skipped
     """
-    new_db = FAISS.from_documents(docs, embeddings)
-    db = FAISS.load_local(knowledge_base, embeddings)
-    db.merge_from(new_db)
-    db.save_local(knowledge_base)
+    return _ingest(docs, knowledge_base,
+                   near_duplicate_distance=near_duplicate_distance)
 
 
-def find_similar_document(query_doc: str, knowledge_base: str):
+def find_similar_document(query_doc: str, knowledge_base: str,
+                          nprobe: int = None, ef_search: int = None,
+                          k: int = 4, max_distance: float = None,
+                          where: dict = None, rerank: int = None):
     """
     Retrieve similar documents from a knowledge base given a query document
 
@@ -126,46 +1172,404 @@ def find_similar_document(query_doc: str, knowledge_base: str):
         Query document name
     knowledge_base: str
         Knowledge base to query
+    nprobe: int
+        Number of inverted lists visited on IVF knowledge bases
+    ef_search: int
+        Size of the candidate list explored on HNSW knowledge bases
+    k: int
+        Number of similar documents to return
+    max_distance: float
+        Drop similar documents further than this distance
+    where: dict
+        Metadata values similar documents must have, e.g. their source
+    rerank: int
+        Re-ranking factor on quantized or approximate knowledge bases,
+        defaults to the knowledge base setting
 
     Returns
     -------
     list
         A list of similar documents
     """
-    logger.info(f"find_similar_document(): {(query_doc, knowledge_base)}")
-    query_text = documents_store.get(query_doc)
+    logger.info(f"find_similar_document(): "
+                f"{(query_doc, knowledge_base, k, max_distance, where)}")
+    query_text = document_store.get(query_doc)
+    key = _result_key(knowledge_base, query_text, k, nprobe, ef_search,
+                      max_distance, where, rerank)
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return list(cached)
     try:
-        db = FAISS.load_local(knowledge_base, embeddings)
-        query_result = db.similarity_search_with_score(query_text)
+        with metrics.stage("embed"):
+            vector = np.array([get_embeddings().embed_query(query_text)],
+                              dtype=np.float32)
+        query_result = search_knowledge_base(
+            knowledge_base, vector, k, nprobe=nprobe, ef_search=ef_search,
+            max_distance=max_distance, where=where, rerank=rerank)[0]
     except Exception:
         logger.error("find_similar_document(): Error occurred while "
                      "getting similar documents")
         raise Exception
+    if key is not None:
+        result_cache.put(key, tuple(query_result))
     return query_result
 
 
-def store_to_dataframe(store):
+def _result_key(knowledge_base: str, query_text: str, *params):
     """
-    Load Vector db store into DataFrame
+    Key of a query in `result_cache`, None when the query cannot be
+    cached
+    """
+    from app.embeddings import text_hash
+
+    if query_text is None:
+        return None
+    try:
+        version = storage.manifest_version(knowledge_base)
+        params = json.dumps(params, sort_keys=True)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (os.path.normpath(knowledge_base), version,
+            text_hash(query_text), params)
+
+
+def find_similar_documents(query_docs: list, knowledge_base: str,
+                           k: int = 4, nprobe: int = None,
+                           ef_search: int = None,
+                           max_distance: float = None, where: dict = None,
+                           rerank: int = None):
+    """
+    Retrieve similar documents from a knowledge base for many query
+    documents at once. Query documents are embedded in a single model call
+    and searched with a single batched index search
 
     Parameters
     ----------
-    store: Any
-        Vector db to load into DataFrame
+    query_docs: list
+        Query document names
+    knowledge_base: str
+        Knowledge base to query
+    k: int
+        Number of similar documents to return per query document
+    nprobe: int
+        Number of inverted lists visited on IVF knowledge bases
+    ef_search: int
+        Size of the candidate list explored on HNSW knowledge bases
+    max_distance: float
+        Drop similar documents further than this distance
+    where: dict
+        Metadata values similar documents must have, e.g. their source
+    rerank: int
+        Re-ranking factor on quantized or approximate knowledge bases,
+        defaults to the knowledge base setting
 
     Returns
     -------
-    DataFrame
-        Panda dataframe holding data from vector db
+    list
+        A list of similar documents for each query document, in the order
+        of `query_docs`
+    """
+    logger.info(f"find_similar_documents(): "
+                f"{(len(query_docs), knowledge_base, k)}")
+    query_texts = [document_store.get(query_doc) for query_doc in query_docs]
+    if not query_docs or None in query_texts:
+        logger.error('Query document not in document store')
+        raise Exception
+    try:
+        with metrics.stage("embed"):
+            vectors = np.array(
+                get_embeddings().embed_documents(query_texts),
+                dtype=np.float32)
+        query_results = search_knowledge_base(
+            knowledge_base, vectors, k, nprobe=nprobe, ef_search=ef_search,
+            max_distance=max_distance, where=where, rerank=rerank)
+    except Exception:
+        logger.error("find_similar_documents(): Error occurred while "
+                     "getting similar documents")
+        raise Exception
+    return query_results
+
+
+def _get_search_pool():
+    global _search_pool
+    if _search_pool is None:
+        with _search_pool_lock:
+            if _search_pool is None:
+                _search_pool = ThreadPoolExecutor(
+                    max_workers=federated_search_workers,
+                    thread_name_prefix="search")
+    return _search_pool
+
+
+def find_similar_document_federated(query_doc: str, knowledge_bases: list,
+                                    k: int = 4, nprobe: int = None,
+                                    ef_search: int = None,
+                                    max_distance: float = None,
+                                    where: dict = None, rerank: int = None,
+                                    budget: float = None):
     """
-    rows = []
-    store_dict = store.docstore._dict
-    for key in store_dict.keys():
-        name = store_dict[key].metadata['source'].split('/')[-1]
-        content = store_dict[key].page_content
-        rows.append({"chunk_id": key, "document": name, "content": content})
-    store_dataframe = pd.DataFrame(rows)
-    return store_dataframe
+    Retrieve similar documents from many knowledge bases given a query
+    document. The query is embedded once and the knowledge bases are
+    searched concurrently, `federated_search_workers` at a time, before
+    their hits are merged into a global top-k
+
+    Parameters
+    ----------
+    query_doc: str
+        Query document name
+    knowledge_bases: list
+        Knowledge bases to query
+    k: int
+        Number of similar documents to return
+    nprobe: int
+        Number of inverted lists visited on IVF knowledge bases
+    ef_search: int
+        Size of the candidate list explored on HNSW knowledge bases
+    max_distance: float
+        Drop similar documents further than this distance
+    where: dict
+        Metadata values similar documents must have, e.g. their source
+    rerank: int
+        Re-ranking factor, defaults to each knowledge base's setting
+    budget: float
+        Seconds each knowledge base may search for. Hits of a knowledge
+        base that runs over are left out, the others are still returned
+
+    Returns
+    -------
+    tuple
+        Top-k (knowledge base, document, distance) hits, closest first,
+        and the `status` ("ok", "timeout" or "error"), `seconds` and
+        number of `hits` of each knowledge base
+    """
+    logger.info(f"find_similar_document_federated(): "
+                f"{(query_doc, len(knowledge_bases), k, budget)}")
+    knowledge_bases = list(dict.fromkeys(knowledge_bases))
+    query_text = document_store.get(query_doc)
+    try:
+        if not knowledge_bases or k < 1:
+            raise ValueError("Nothing to search")
+        if where:
+            _check_filter(where)
+        with metrics.stage("embed"):
+            vector = np.array([get_embeddings().embed_query(query_text)],
+                              dtype=np.float32)
+    except Exception:
+        logger.error("find_similar_document_federated(): Error occurred "
+                     "while embedding the query document")
+        raise Exception
+
+    stages = metrics.current_profile()
+    started = {}
+
+    def search(knowledge_base):
+        start = started[knowledge_base] = time.perf_counter()
+        try:
+            with metrics.bind_profile(stages):
+                hits = search_knowledge_base(
+                    knowledge_base, vector, k, nprobe=nprobe,
+                    ef_search=ef_search, max_distance=max_distance,
+                    where=where, rerank=rerank)[0]
+            return "ok", hits, time.perf_counter() - start
+        except Exception as e:
+            logger.error(f"find_similar_document_federated(): "
+                         f"{knowledge_base}: {e!r}")
+            return "error", [], time.perf_counter() - start
+
+    pool = _get_search_pool()
+    futures = {pool.submit(search, knowledge_base): knowledge_base
+               for knowledge_base in knowledge_bases}
+    results, status = {}, {}
+    pending = set(futures)
+    while pending:
+        timeout = None
+        if budget is not None:
+            now = time.perf_counter()
+            for future in list(pending):
+                knowledge_base = futures[future]
+                if not future.done() and knowledge_base in started and \
+                        now - started[knowledge_base] >= budget:
+                    # A running search cannot be interrupted, its result
+                    # is dropped when it completes
+                    pending.discard(future)
+                    status[knowledge_base] = {
+                        "status": "timeout",
+                        "seconds": now - started[knowledge_base],
+                        "hits": 0}
+            deadlines = [started[futures[future]] + budget
+                         for future in pending if futures[future] in started]
+            timeout = max(0.0, min(deadlines) - now) if deadlines \
+                else budget
+        done, _ = wait(pending, timeout=timeout,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            knowledge_base = futures[future]
+            state, hits, seconds = future.result()
+            results[knowledge_base] = hits
+            status[knowledge_base] = {"status": state, "seconds": seconds,
+                                      "hits": len(hits)}
+
+    merged = storage.merge_results(
+        [[[((knowledge_base, doc), score) for doc, score in hits]]
+         for knowledge_base, hits in results.items()], k)
+    hits = [(knowledge_base, doc, score)
+            for (knowledge_base, doc), score in (merged[0] if merged else [])]
+    return hits, {knowledge_base: status[knowledge_base]
+                  for knowledge_base in knowledge_bases}
+
+
+def get_knowledge_base_stats(knowledge_base: str):
+    """
+    Stats of a knowledge base, read from its manifest and its document
+    list without loading any segment
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to describe
+
+    Returns
+    -------
+    dict
+        Version, documents, vector count, dimensions, index, bytes on
+        disk and last modification time of the knowledge base
+    """
+    logger.info(f"get_knowledge_base_stats(): {knowledge_base}")
+    try:
+        stats = storage.knowledge_base_stats(knowledge_base)
+        stats["documents"] = storage.document_names(knowledge_base)
+        return stats
+    except (OSError, ValueError, KeyError):
+        logger.error("get_knowledge_base_stats(): knowledge base does not "
+                     "exist or its manifest cannot be read")
+        raise Exception
+
+
+def knowledge_base_documents(knowledge_base: str):
+    """
+    Names of the documents of a knowledge base, read from its document
+    list without loading any segment
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to list
+
+    Returns
+    -------
+    list
+        Sorted document names
+    """
+    return storage.document_names(knowledge_base)
+
+
+def list_knowledge_bases(root: str = store_path, prefix: str = ""):
+    """
+    Stats of every knowledge base saved under `root`, read from their
+    manifests alone
+
+    Parameters
+    ----------
+    root: str
+        Directory holding the knowledge bases
+    prefix: str
+        Only knowledge bases whose name starts with it are listed
+
+    Returns
+    -------
+    list
+        Stats of each knowledge base without its document names, with
+        its `name` relative to `root`, sorted by name
+    """
+    logger.info(f"list_knowledge_bases(): {(root, prefix)}")
+    listed = []
+    for name in storage.list_knowledge_bases(root, prefix):
+        try:
+            stats = storage.knowledge_base_stats(os.path.join(root, name))
+        except (OSError, ValueError, KeyError):
+            # Deleted, or not published yet, since the directory was read
+            continue
+        listed.append({"name": name, **stats})
+    return listed
+
+
+def measure_recall(knowledge_base: str, k: int = 10, queries: int = 100,
+                   nprobe: int = None, ef_search: int = None,
+                   rerank: int = None, seed: int = 0):
+    """
+    Measures the recall of a knowledge base's searches against exact
+    search. Queries are sampled from the knowledge base's own vectors and
+    their exact top-k is found by brute force over the full-precision
+    vectors of every segment
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to measure
+    k: int
+        Number of hits per query
+    queries: int
+        Number of vectors sampled as queries
+    nprobe: int
+        Number of inverted lists visited in IVF segments
+    ef_search: int
+        Size of the candidate list explored in HNSW segments
+    rerank: int
+        Re-ranking factor, defaults to the knowledge base setting
+    seed: int
+        Seed of the sampled queries
+
+    Returns
+    -------
+    dict
+        Mean `recall` at `k` over the sampled queries, the settings it was
+        measured with, and the bytes the indexes store per vector
+        against full precision
+    """
+    from app import indexes
+
+    logger.info(f"measure_recall(): {(knowledge_base, k, queries)}")
+    manifest, segments = _load_knowledge_base(knowledge_base)
+    if rerank is None:
+        rerank = manifest["index"].get("rerank")
+    total = sum(segment.ntotal for segment in segments)
+    if k < 1 or queries < 1 or not total:
+        logger.error("measure_recall(): Nothing to measure")
+        raise Exception
+    picks = np.random.default_rng(seed).choice(
+        total, min(queries, total), replace=False)
+    offsets = np.cumsum([0] + [segment.ntotal for segment in segments])
+    vectors = np.array([segments[position].vectors[pick - offsets[position]]
+                        for pick, position in zip(
+                            picks, np.searchsorted(offsets, picks, "right")
+                            - 1)], dtype=np.float32)
+
+    exact, approximate = [], []
+    index_bytes = full_bytes = 0
+    with metrics.stage("search"):
+        for position, segment in enumerate(segments):
+            if not segment.ntotal:
+                continue
+            exact.append(_hits(position, *segment.exact_search(vectors, k)))
+            approximate.append(_hits(position, *segment.search(
+                vectors, k, nprobe, ef_search, rerank=rerank)))
+            dimension = segment.vectors.shape[1]
+            full_bytes += segment.ntotal * dimension * 4
+            index_bytes += segment.ntotal * (
+                dimension * 4 if segment.index is None
+                else indexes.code_size(segment.index))
+    exact = storage.merge_results(exact, k)
+    approximate = storage.merge_results(approximate, k)
+    recall = np.mean([
+        len({key for key, _ in found} & {key for key, _ in expected}) /
+        len(expected) for found, expected in zip(approximate, exact)])
+    return {"recall": float(recall), "k": k, "queries": len(vectors),
+            "index": manifest["base_index"], "rerank": rerank or 0,
+            "nprobe": nprobe, "ef_search": ef_search,
+            "index_bytes_per_vector": index_bytes / total,
+            "full_precision_bytes_per_vector": full_bytes / total}
 
 
 def delete_document_from_knowledge_base(document, knowledge_base):
@@ -185,14 +1589,50 @@ def delete_document_from_knowledge_base(document, knowledge_base):
         A list of similar documents
     """
     logger.info(f"delete_document(): {(document, knowledge_base)}")
-    try:
-        db = FAISS.load_local(knowledge_base, embeddings)
-        store_df = store_to_dataframe(db)
-        chunks_list = store_df.loc[store_df["document"] ==
-                                   document]["chunk_id"].tolist()
-        db.delete(chunks_list)
-    except Exception:
-        logger.error("delete_document_from_knowledge_base(): Cannot delete "
-                     "document from knowledge base")
-        raise Exception
-    db.save_local(knowledge_base)
+    with storage.write_lock(knowledge_base):
+        try:
+            manifest = storage.read_manifest(knowledge_base)
+            loaded, segments = _load_knowledge_base(knowledge_base)
+            tombstones = manifest["tombstones"]
+            # Emptied segments and superseded tombstone files
+            retired = []
+            found = False
+            for segment_id, segment in zip(loaded["segments"], segments):
+                faiss_ids = [faiss_id for faiss_id, _
+                             in segment.chunks_of(document)]
+                if not faiss_ids:
+                    continue
+                found = True
+                deleted = np.union1d(segment.deleted, faiss_ids)
+                if len(deleted) == segment.ntotal:
+                    tombstones.pop(segment_id, None)
+                    retired.append(segment_id)
+                    continue
+                if segment_id in tombstones:
+                    retired.append(
+                        f"{segment_id}/{tombstones[segment_id]['file']}")
+                tombstones[segment_id] = {
+                    "file": storage.write_tombstones(knowledge_base,
+                                                     segment_id, deleted),
+                    "count": len(deleted)}
+        except Exception:
+            logger.error("delete_document_from_knowledge_base(): Cannot "
+                         "delete document from knowledge base")
+            raise Exception
+        if found:
+            if manifest["segments"][0] in retired:
+                # Deltas are flat, so the next base has to be built again
+                manifest["base_index"] = "flat"
+            manifest["segments"] = [segment_id for segment_id
+                                    in manifest["segments"]
+                                    if segment_id not in retired]
+            manifest["document_count"] -= 1
+            with storage.document_list(knowledge_base) as documents:
+                documents.execute("DELETE FROM documents WHERE name = ?",
+                                  (document,))
+                manifest = storage.publish_manifest(
+                    knowledge_base, manifest, retired=retired)
+            invalidate_knowledge_base(knowledge_base)
+            if storage.live_vectors(manifest) < (1 - max_deleted_ratio) * \
+                    sum(manifest["vector_counts"].values()):
+                schedule_compaction(knowledge_base)
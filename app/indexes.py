@@ -0,0 +1,218 @@
+import faiss
+import numpy as np
+
+# Index types a knowledge base can be created with, and the settings each
+# one accepts with their defaults
+INDEX_DEFAULTS = {
+    "flat": {},
+    "ivf": {"nlist": 100, "nprobe": 8},
+    "hnsw": {"m": 32, "ef_construction": 40, "ef_search": 64},
+    "ivfpq": {"nlist": 100, "nprobe": 8, "pq_m": 8, "pq_bits": 8},
+}
+
+# Scalar quantizations vectors can be stored with in flat, ivf and hnsw
+# indexes. fp16 halves index memory and int8 quarters it
+QUANTIZATIONS = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+# FAISS warns when k-means gets fewer training points than this per
+# centroid
+TRAINING_POINTS_PER_LIST = 39
+
+
+def index_config(config: dict = None):
+    """
+    Validates an index configuration and fills in its defaults
+
+    Parameters
+    ----------
+    config: dict
+        Index `type` and its settings, flat when None
+
+    Returns
+    -------
+    dict
+        Complete index configuration
+    """
+    config = dict(config or {"type": "flat"})
+    index_type = config.pop("type", "flat")
+    if index_type not in INDEX_DEFAULTS:
+        raise ValueError(f"Unknown index type {index_type}")
+    defaults = INDEX_DEFAULTS[index_type]
+    unknown = set(config) - set(defaults) - {"min_train_vectors", "rerank",
+                                             "quantization"}
+    if unknown:
+        raise ValueError(f"Unknown {index_type} index settings {unknown}")
+    complete = {"type": index_type, **defaults}
+    if "quantization" in config:
+        quantization = config.pop("quantization")
+        if quantization not in QUANTIZATIONS or index_type == "ivfpq":
+            raise ValueError(f"Unknown {index_type} index quantization "
+                             f"{quantization}")
+        complete["quantization"] = quantization
+    for key, value in config.items():
+        if not isinstance(value, int) or isinstance(value, bool) \
+                or value < 1:
+            raise ValueError(f"Index setting {key} must be a positive int")
+        complete[key] = value
+    return complete
+
+
+def index_name(config: dict):
+    """
+    Name of the index a configuration builds, its type followed by its
+    quantization if any, e.g. "hnsw+int8"
+    """
+    if config.get("quantization"):
+        return f"{config['type']}+{config['quantization']}"
+    return config["type"]
+
+
+def min_train_vectors(config: dict):
+    """
+    Number of vectors a knowledge base needs before its configured index
+    can be built. Until then its segments stay flat
+    """
+    if config["type"] in ("ivf", "ivfpq"):
+        default = max(TRAINING_POINTS_PER_LIST * config["nlist"],
+                      2 ** config.get("pq_bits", 0))
+        return config.get("min_train_vectors", default)
+    return 0
+
+
+def build_index(config: dict, vectors: np.ndarray):
+    """
+    Builds, trains when needed, and fills the configured index
+
+    Parameters
+    ----------
+    config: dict
+        Complete index configuration
+    vectors: np.ndarray
+        Vectors to add to the index
+
+    Returns
+    -------
+    faiss.Index
+        The built index
+    """
+    dimension = vectors.shape[1]
+    index_type = config["type"]
+    quantization = config.get("quantization")
+    if index_type == "ivf":
+        codes = {"fp16": "SQfp16", "int8": "SQ8"}.get(quantization, "Flat")
+        index = faiss.index_factory(dimension,
+                                    f"IVF{config['nlist']},{codes}")
+    elif index_type == "ivfpq":
+        index = faiss.index_factory(
+            dimension,
+            f"IVF{config['nlist']},PQ{config['pq_m']}x{config['pq_bits']}")
+    elif index_type == "hnsw":
+        if quantization:
+            index = faiss.IndexHNSWSQ(dimension,
+                                      QUANTIZATIONS[quantization],
+                                      config["m"])
+        else:
+            index = faiss.IndexHNSWFlat(dimension, config["m"])
+        index.hnsw.efConstruction = config["ef_construction"]
+        index.hnsw.efSearch = config["ef_search"]
+    elif quantization:
+        index = faiss.IndexScalarQuantizer(dimension,
+                                           QUANTIZATIONS[quantization])
+    else:
+        index = faiss.IndexFlatL2(dimension)
+    if not index.is_trained:
+        index.train(vectors)
+    if index_type in ("ivf", "ivfpq"):
+        index.nprobe = config["nprobe"]
+    index.add(vectors)
+    return index
+
+
+def index_type(index):
+    """
+    Name of the index type of a FAISS index, followed by its quantization
+    if any, as in `index_name`
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        name = "hnsw"
+    elif isinstance(index, faiss.IndexIVFPQ):
+        return "ivfpq"
+    elif isinstance(index, faiss.IndexIVF):
+        name = "ivf"
+    else:
+        name = "flat"
+    quantization = _quantization(index)
+    return f"{name}+{quantization}" if quantization else name
+
+
+def _storage(index):
+    """Index holding the codes of an index's vectors"""
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.downcast_index(index.storage)
+    return index
+
+
+def _quantization(index):
+    storage = _storage(index)
+    if isinstance(storage, (faiss.IndexScalarQuantizer,
+                            faiss.IndexIVFScalarQuantizer)):
+        for name, qtype in QUANTIZATIONS.items():
+            if storage.sq.qtype == qtype:
+                return name
+    return None
+
+
+def code_size(index):
+    """Bytes an index stores per vector, not counting graph links"""
+    storage = _storage(index)
+    return getattr(storage, "code_size", storage.d * 4)
+
+
+def search_parameters(index, nprobe: int = None, ef_search: int = None,
+                      selector=None):
+    """
+    Per-query search parameters for an index, so query-time knobs do not
+    change the shared index
+
+    Parameters
+    ----------
+    index: faiss.Index
+        Index to search
+    nprobe: int
+        Number of inverted lists visited, IVF indexes only
+    ef_search: int
+        Size of the candidate list explored, HNSW indexes only
+    selector: faiss.IDSelector
+        Restricts the search to the FAISS ids it selects
+
+    Returns
+    -------
+    faiss.SearchParameters
+        Parameters to pass to `index.search`, None to use the index's own
+    """
+    if isinstance(index, faiss.IndexIVF):
+        if nprobe or selector is not None:
+            params = faiss.SearchParametersIVF(nprobe=nprobe or index.nprobe)
+            params.sel = selector
+            return params
+    elif isinstance(index, faiss.IndexHNSW):
+        if ef_search or selector is not None:
+            params = faiss.SearchParametersHNSW(
+                efSearch=ef_search or index.hnsw.efSearch)
+            params.sel = selector
+            return params
+    elif selector is not None:
+        params = faiss.SearchParameters()
+        params.sel = selector
+        return params
+    return None
+
+
+def reconstruct_vectors(index):
+    """Full vectors of a flat index, in FAISS id order"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
@@ -0,0 +1,269 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from app import logger, store_path
+
+# Seconds between two saves of a running job's progress
+PROGRESS_SAVE_INTERVAL = 1.0
+
+
+class Job:
+    """
+    A background operation on a knowledge base and its progress
+
+    Parameters
+    ----------
+    kind: str
+        Name of the operation, e.g. "add_document"
+    knowledge_base: str
+        Knowledge base the operation writes to
+    """
+
+    def __init__(self, kind: str, knowledge_base: str, store=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.knowledge_base = knowledge_base
+        self.state = "queued"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.store = store
+        self._saved_at = 0.0
+        self._done = threading.Event()
+
+    def set_progress(self, progress: float):
+        self.progress = min(max(progress, 0.0), 1.0)
+        if time.time() - self._saved_at >= PROGRESS_SAVE_INTERVAL:
+            self.save()
+
+    def wait(self, timeout: float = None):
+        """
+        Blocks until a job of this process finished, or `timeout` seconds
+        passed
+
+        Returns
+        -------
+        bool
+            Whether the job finished
+        """
+        return self._done.wait(timeout)
+
+    def save(self):
+        """Writes the job's state to its store, if it has one"""
+        if self.store is None:
+            return
+        self._saved_at = time.time()
+        try:
+            self.store.save(self)
+        except sqlite3.Error as e:
+            logger.error(f"Job.save(): cannot save job {self.id}: {e}")
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Job read back from a `to_dict`, e.g. one another process ran"""
+        job = cls(data["kind"], data["knowledge_base"])
+        for key in ("id", "state", "progress", "result", "error",
+                    "submitted_at", "started_at", "finished_at", "worker"):
+            setattr(job, key, data[key])
+        return job
+
+    def to_dict(self):
+        now = time.time()
+        started = self.started_at or now
+        return {"id": self.id, "kind": self.kind,
+                "knowledge_base": self.knowledge_base, "state": self.state,
+                "progress": self.progress, "result": self.result,
+                "error": self.error, "submitted_at": self.submitted_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at, "worker": self.worker,
+                "queued_seconds": started - self.submitted_at,
+                "run_seconds": (self.finished_at or now) - self.started_at
+                if self.started_at else None}
+
+
+class JobStore:
+    """
+    Job states kept in a SQLite file, so every worker process sharing it
+    can report the jobs any of them runs
+
+    Parameters
+    ----------
+    path: str
+        SQLite file holding the jobs
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id TEXT PRIMARY KEY, finished_at REAL, "
+                         "job TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at "
+                         "ON jobs (finished_at)")
+            self._local.conn = conn
+        return conn
+
+    def save(self, job: Job):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                         (job.id, job.finished_at,
+                          json.dumps(job.to_dict(), default=str)))
+
+    def get(self, job_id: str):
+        """Saved job, None when no process saved it"""
+        row = self._connection().execute(
+            "SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else Job.from_dict(json.loads(row[0]))
+
+    def trim(self, max_finished: int):
+        """Drops all but the `max_finished` most recently finished jobs"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE "
+                "finished_at IS NOT NULL ORDER BY finished_at DESC "
+                "LIMIT -1 OFFSET ?)", (max_finished,))
+
+
+class JobQueue:
+    """
+    Runs knowledge base operations on a bounded thread pool. Jobs on the
+    same knowledge base run one at a time in submission order, jobs on
+    different knowledge bases run in parallel
+
+    Parameters
+    ----------
+    max_workers: int
+        Number of jobs that can run at the same time
+    max_finished: int
+        Number of finished jobs kept for status lookups
+    store: JobStore
+        Optional store job states are saved to, so jobs can be looked up
+        from other processes
+    """
+
+    def __init__(self, max_workers: int = 4, max_finished: int = 1000,
+                 store: JobStore = None):
+        self.max_finished = max_finished
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, knowledge_base: str, func, *args,
+               track_progress: bool = False, **kwargs):
+        """
+        Queues `func(*args, **kwargs)` as a job
+
+        Parameters
+        ----------
+        kind: str
+            Name of the operation
+        knowledge_base: str
+            Knowledge base the operation writes to, jobs are serialized
+            per knowledge base
+        func: callable
+            Operation to run
+        track_progress: bool
+            Pass the job's `set_progress` to `func` as `progress`
+
+        Returns
+        -------
+        Job
+            The queued job
+        """
+        knowledge_base = os.path.normpath(knowledge_base)
+        job = Job(kind, knowledge_base, store=self.store)
+        if track_progress:
+            kwargs["progress"] = job.set_progress
+        job.save()
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            pending = self._pending.setdefault(knowledge_base, deque())
+            pending.append((job, func, args, kwargs))
+            if len(pending) == 1:
+                self._executor.submit(self._drain, knowledge_base)
+        logger.info(f"JobQueue.submit(): {(job.id, kind, knowledge_base)}")
+        return job
+
+    def get(self, job_id: str):
+        """
+        Job of this process or, failing that, saved by another process
+        sharing the store. None when no process knows the job
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            try:
+                job = self.store.get(job_id)
+            except sqlite3.Error as e:
+                logger.error(f"JobQueue.get(): cannot read job store: {e}")
+        return job
+
+    def _drain(self, knowledge_base: str):
+        while True:
+            with self._lock:
+                job, func, args, kwargs = self._pending[knowledge_base][0]
+            self._run(job, func, args, kwargs)
+            with self._lock:
+                pending = self._pending[knowledge_base]
+                pending.popleft()
+                if not pending:
+                    del self._pending[knowledge_base]
+                    return
+
+    def _run(self, job: Job, func, args, kwargs):
+        job.state = "running"
+        job.started_at = time.time()
+        job.save()
+        try:
+            job.result = func(*args, **kwargs)
+            job.state = "succeeded"
+            job.progress = 1.0
+        except Exception as e:
+            logger.error(f"JobQueue._run(): job {job.id} failed: {e!r}")
+            job.error = str(e) or "Job failed, check logs"
+            job.state = "failed"
+        finally:
+            job.finished_at = time.time()
+            job.save()
+            job._done.set()
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.finished_at is not None]
+        for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self._jobs[job_id]
+        if finished and self.store is not None:
+            try:
+                self.store.trim(self.max_finished)
+            except sqlite3.Error as e:
+                logger.error(f"JobQueue._trim(): cannot trim job store: "
+                             f"{e}")
+
+
+job_queue = JobQueue(max_workers=int(os.environ.get("JOB_WORKERS", 4)),
+                     store=JobStore(os.path.join(store_path, "jobs.sqlite")))
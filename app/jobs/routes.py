@@ -0,0 +1,12 @@
+from app.jobs import bp
+from app import logger
+from app.job_queue import job_queue
+
+
+@bp.get('/jobs/<job_id>')
+def get_job(job_id):
+    logger.info(f"get_job(): {job_id}")
+    job = job_queue.get(job_id)
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return job.to_dict(), 200
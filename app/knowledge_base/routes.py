@@ -1,6 +1,7 @@
 from app.knowledge_base import bp
 from flask import request
 from app import helper, logger, store_path
+from app.job_queue import job_queue
 
 
 @bp.post('/knowledge_base')
@@ -9,12 +10,22 @@ def create_knowledge_base():
     logger.info(f"create_knowledge_base(): {(request_data)}")
     knowledge_base = request_data.get("knowledge_base")
     document = request_data.get("document")
+    index = request_data.get("index")
     try:
-        helper.create_knowledge_base(document, store_path+knowledge_base)
+        if request_data.get("async"):
+            job = job_queue.submit("create_knowledge_base",
+                                   store_path+knowledge_base,
+                                   helper.create_knowledge_base,
+                                   document, store_path+knowledge_base,
+                                   index=index)
+            return {"job_id": job.id}, 202
+        duplicates = helper.create_knowledge_base(
+            document, store_path+knowledge_base, index=index)
     except Exception:
         return {"message": "Cannot create knowledge base, "
                 "check request data and logs"}, 400
-    return {"message": "Knowledge base created"}, 201
+    return {"message": "Knowledge base created",
+            "duplicates": duplicates}, 201
 
 
 @bp.delete('/knowledge_base')
@@ -23,8 +34,74 @@ def delete_knowledge_base():
     logger.info(f"delete_knowledge_base() {request_data}")
     knowledge_base = request_data.get("knowledge_base")
     try:
+        if request_data.get("async"):
+            job = job_queue.submit("delete_knowledge_base",
+                                   store_path+knowledge_base,
+                                   helper.delete_knowledge_base,
+                                   store_path+knowledge_base)
+            return {"job_id": job.id}, 202
         helper.delete_knowledge_base(store_path+knowledge_base)
     except Exception:
         return {"message": "Cannot delete knowledge base, "
                 "check request data and logs"}, 400
     return {"message": "Knowledge base deleted"}, 200
+
+
+@bp.post('/knowledge_base/compact')
+def compact_knowledge_base():
+    request_data = request.get_json()
+    logger.info(f"compact_knowledge_base() {request_data}")
+    knowledge_base = request_data.get("knowledge_base")
+    try:
+        if request_data.get("async"):
+            job = job_queue.submit("compact_knowledge_base",
+                                   store_path+knowledge_base,
+                                   helper.compact_knowledge_base,
+                                   store_path+knowledge_base)
+            return {"job_id": job.id}, 202
+        helper.compact_knowledge_base(store_path+knowledge_base)
+    except Exception:
+        return {"message": "Cannot compact knowledge base, "
+                "check request data and logs"}, 400
+    return {"message": "Knowledge base compacted"}, 200
+
+
+@bp.get('/knowledge_base/recall')
+def measure_recall():
+    logger.info(f"measure_recall(): {request.args}")
+    knowledge_base = request.args.get('knowledge_base')
+    try:
+        report = helper.measure_recall(
+            store_path+knowledge_base,
+            k=request.args.get('k', default=10, type=int),
+            queries=request.args.get('queries', default=100, type=int),
+            nprobe=request.args.get('nprobe', type=int),
+            ef_search=request.args.get('ef_search', type=int),
+            rerank=request.args.get('rerank', type=int))
+    except Exception:
+        return {"message": "Cannot measure recall, "
+                "check query params and logs"}, 400
+    return report, 200
+
+
+@bp.get('/knowledge_bases')
+def list_knowledge_bases():
+    logger.info(f"list_knowledge_bases(): {request.args}")
+    try:
+        knowledge_bases = helper.list_knowledge_bases(
+            store_path, request.args.get('prefix', default=""))
+    except Exception:
+        return {"message": "Cannot list knowledge bases, "
+                "check query params and logs"}, 400
+    return {"knowledge_bases": knowledge_bases}, 200
+
+
+@bp.get('/knowledge_base/<path:knowledge_base>/stats')
+def get_knowledge_base_stats(knowledge_base):
+    logger.info(f"get_knowledge_base_stats(): {knowledge_base}")
+    try:
+        stats = helper.get_knowledge_base_stats(store_path+knowledge_base)
+    except Exception:
+        return {"message": "Cannot get knowledge base stats, "
+                "check knowledge base name and logs"}, 400
+    return {"name": knowledge_base, **stats}, 200
@@ -1,6 +1,24 @@
 from app.main import bp
+from app import helper, logger, metrics
 
 
 @bp.get('/')
 def home():
     return {"data": "Home page"}
+
+
+@bp.get('/ready')
+def ready():
+    logger.info("ready()")
+    try:
+        timings = helper.warm_up()
+    except Exception:
+        return {"ready": False, "error": "Cannot load embedding model, "
+                "check logs"}, 503
+    return {"ready": True, "startup_timings": timings}, 200
+
+
+@bp.get('/metrics')
+def get_metrics():
+    return metrics.render(), 200, \
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
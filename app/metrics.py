@@ -0,0 +1,319 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from app import store_path
+
+# Latency bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request header opting a request into profiling. Its response then
+# carries the time spent in each stage in a Server-Timing header
+PROFILE_HEADER = "X-Profile"
+
+
+def _labels(names: tuple, values: tuple):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+class Counter:
+    """
+    Prometheus counter
+
+    Parameters
+    ----------
+    name: str
+        Metric name
+    documentation: str
+        Metric help text
+    labels: tuple
+        Label names
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, values)} "
+                             f"{value}")
+        return lines
+
+
+class Histogram:
+    """
+    Prometheus histogram
+
+    Parameters
+    ----------
+    name: str
+        Metric name
+    documentation: str
+        Metric help text
+    labels: tuple
+        Label names
+    buckets: tuple
+        Bucket upper bounds, in increasing order
+    """
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *values):
+        with self._lock:
+            entry = self._values.get(values)
+            if entry is None:
+                entry = self._values[values] = [[0] * len(self.buckets),
+                                                0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self._lock:
+            for values, (counts, total, count) in \
+                    sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets + ("+Inf",),
+                                         counts + [count]):
+                    lines.append(f"{self.name}_bucket"
+                                 f"{_labels(names, values + (bound,))} "
+                                 f"{bucket}")
+                lines.append(f"{self.name}_sum"
+                             f"{_labels(self.labels, values)} {total}")
+                lines.append(f"{self.name}_count"
+                             f"{_labels(self.labels, values)} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "kb_stage_seconds",
+    "Seconds spent in each stage: split, embed, load, search, save and "
+    "serialize", ("stage",))
+request_seconds = Histogram(
+    "kb_request_seconds", "Seconds spent serving requests, by route",
+    ("method", "route"))
+requests_total = Counter(
+    "kb_requests_total", "Requests served, by route and status",
+    ("method", "route", "status"))
+
+_profile = threading.local()
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times a stage into `stage_seconds` and, when the current request is
+    profiled, into its stage breakdown
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, name)
+        stages = getattr(_profile, "stages", None)
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def start_profile():
+    """Starts collecting the stage breakdown of the current thread"""
+    _profile.stages = {}
+
+
+def end_profile():
+    """
+    Returns
+    -------
+    dict
+        Seconds spent in each stage since `start_profile`, None when the
+        thread was not profiling
+    """
+    stages = getattr(_profile, "stages", None)
+    _profile.stages = None
+    return stages
+
+
+def current_profile():
+    """Stage breakdown the current thread collects into, None if none"""
+    return getattr(_profile, "stages", None)
+
+
+@contextmanager
+def bind_profile(stages: dict):
+    """
+    Collects the stages timed on the current thread into `stages`, the
+    breakdown of another thread, so work handed to a worker thread is
+    still profiled with the request that started it
+    """
+    previous = getattr(_profile, "stages", None)
+    _profile.stages = stages
+    try:
+        yield
+    finally:
+        _profile.stages = previous
+
+
+def server_timing(stages: dict, total: float):
+    """Server-Timing header value of a stage breakdown, in milliseconds"""
+    entries = [f"{name};dur={seconds * 1000:.3f}"
+               for name, seconds in stages.items()]
+    entries.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(entries)
+
+
+def init_app(app):
+    """Registers the request hooks that count and time every request"""
+    from flask import g, request
+    from app import logger
+
+    @app.before_request
+    def _start_request():
+        g.metrics_start = time.perf_counter()
+        if request.headers.get(PROFILE_HEADER):
+            start_profile()
+
+    @app.after_request
+    def _end_request(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        request_seconds.observe(elapsed, request.method, route)
+        requests_total.inc(request.method, route,
+                           str(response.status_code))
+        stages = end_profile()
+        if stages is not None:
+            response.headers["Server-Timing"] = server_timing(stages,
+                                                              elapsed)
+            logger.info(f"profile: {request.method} {request.full_path} "
+                        f"{response.status_code} {elapsed:.4f}s {stages}")
+        return response
+
+
+def _knowledge_base_vectors():
+    """
+    Vector count of every knowledge base under `store_path`, from the
+    stats cached per manifest version, so a scrape only parses the
+    manifests written since the previous one
+    """
+    from app import storage
+
+    counts = {}
+    for name in storage.list_knowledge_bases(store_path):
+        knowledge_base = os.path.join(store_path, name)
+        # Knowledge bases in the layout before manifests are left out
+        # rather than migrated by a scrape
+        if not os.path.exists(storage.manifest_path(knowledge_base)):
+            continue
+        try:
+            counts[name] = storage.knowledge_base_stats(
+                knowledge_base)["vectors"]
+        except (OSError, ValueError, KeyError):
+            continue
+    return counts
+
+
+def _resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _samples(name: str, documentation: str, samples: list,
+             kind: str = "gauge", labels: tuple = ()):
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for values, value in samples:
+        lines.append(f"{name}{_labels(labels, values)} {value}")
+    return lines
+
+
+def render():
+    """
+    Returns
+    -------
+    str
+        Every metric in the Prometheus text exposition format
+    """
+    import resource
+    from app import helper
+
+    lines = stage_seconds.collect() + request_seconds.collect() + \
+        requests_total.collect()
+
+    caches = [("knowledge_base", helper.knowledge_base_cache.stats()),
+              ("result", helper.result_cache.stats())]
+    embeddings = helper._embeddings
+    if embeddings is not None and hasattr(embeddings, "cache"):
+        caches.append(("embedding", embeddings.cache.stats()))
+    for name, key, documentation, kind in (
+            ("kb_cache_hits_total", "hits", "Cache hits", "counter"),
+            ("kb_cache_misses_total", "misses", "Cache misses", "counter"),
+            ("kb_cache_hit_ratio", "hit_ratio", "Cache hit ratio",
+             "gauge")):
+        lines += _samples(name, documentation,
+                          [((cache,), stats[key]) for cache, stats in caches],
+                          kind, ("cache",))
+    lines += _samples("kb_cache_entries", "Entries held by each cache",
+                      [((cache,), stats["entries"])
+                       for cache, stats in caches if "entries" in stats],
+                      labels=("cache",))
+
+    batcher = getattr(embeddings, "model", None)
+    if hasattr(batcher, "stats"):
+        stats = batcher.stats()
+        lines += _samples("kb_embedding_batches_total",
+                          "Embedding model calls", [((), stats["batches"])],
+                          "counter")
+        lines += _samples("kb_embedding_texts_total",
+                          "Texts embedded by the model",
+                          [((), stats["texts"])], "counter")
+
+    lines += _samples("kb_vectors", "Vectors held by each knowledge base",
+                      [((name,), count) for name, count
+                       in sorted(_knowledge_base_vectors().items())],
+                      labels=("knowledge_base",))
+
+    memory = _resident_memory_bytes()
+    if memory is not None:
+        lines += _samples("process_resident_memory_bytes",
+                          "Resident memory size in bytes", [((), memory)])
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    lines += _samples("process_peak_resident_memory_bytes",
+                      "Peak resident memory size in bytes", [((), peak)])
+    return "\n".join(lines) + "\n"
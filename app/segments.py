@@ -0,0 +1,466 @@
+import copy
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import faiss
+import numpy as np
+from langchain.schema.document import Document
+from app import logger
+from app.embeddings import text_hash
+
+# Files of a segment directory:
+#
+#   vectors.npy      full float32 vectors in FAISS id order, memory-mapped
+#                    read-only so the page cache shares them between
+#                    processes. Flat segments are searched on them directly
+#   index.faiss      approximate or quantized index of segments not
+#                    searched flat, read with IO_FLAG_MMAP so inverted lists
+#                    stay on disk
+#   docstore.sqlite  chunk id, document name, text, text hash and metadata
+#                    of every vector, read only for the hits of a search
+#   deleted-*.npy    sorted FAISS ids of the vectors of deleted documents,
+#                    one file per delete, the manifest names the current
+#                    one. Searches leave them out until compaction
+VECTORS = "vectors.npy"
+INDEX = "index.faiss"
+DOCSTORE = "docstore.sqlite"
+
+
+class Segment:
+    """
+    Read-only view of a segment directory, leaving out the vectors of
+    deleted documents once `with_deleted` gave their FAISS ids
+
+    Parameters
+    ----------
+    path: str
+        Segment directory
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, VECTORS), mmap_mode="r")
+        index_path = os.path.join(path, INDEX)
+        self.index = None
+        if os.path.exists(index_path):
+            self.index = faiss.read_index(
+                index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        self.deleted = np.zeros(0, dtype=np.int64)
+        self._excluded = None
+        self._local = threading.local()
+
+    def with_deleted(self, deleted):
+        """
+        View of the segment leaving out the vectors whose FAISS ids are in
+        `deleted`, sharing the vectors, index and docstore of the segment
+        """
+        view = copy.copy(self)
+        view.deleted = np.asarray(deleted, dtype=np.int64)
+        view._excluded = None
+        if len(view.deleted):
+            # IDSelectorNot does not keep the selector it negates alive
+            batch = faiss.IDSelectorBatch(view.deleted)
+            view._excluded = batch, faiss.IDSelectorNot(batch)
+        return view
+
+    @property
+    def ntotal(self):
+        """Number of stored vectors, deleted ones included"""
+        return len(self.vectors)
+
+    def _live(self, faiss_ids):
+        """Mask of the given FAISS ids that are not deleted"""
+        return ~np.isin(faiss_ids, self.deleted)
+
+    def live_vectors(self):
+        """Vectors that are not deleted, in FAISS id order"""
+        if not len(self.deleted):
+            return np.asarray(self.vectors)
+        return self.vectors[self._live(np.arange(self.ntotal))]
+
+    @property
+    def index_type(self):
+        from app import indexes
+
+        return "flat" if self.index is None \
+            else indexes.index_type(self.index)
+
+    def memory_bytes(self):
+        """
+        Approximate private memory held by the segment. Memory-mapped
+        vectors and inverted lists live in the shared page cache and are
+        not counted
+        """
+        from app import indexes
+
+        if self.index is None or isinstance(self.index, faiss.IndexIVF):
+            return 0
+        return self.ntotal * indexes.code_size(self.index)
+
+    def search(self, vectors, k: int, nprobe: int = None,
+               ef_search: int = None, faiss_ids=None, rerank: int = None):
+        """
+        Parameters
+        ----------
+        vectors: np.ndarray
+            Query vectors, one row per query
+        k: int
+            Number of hits per query
+        nprobe: int
+            Number of inverted lists visited, IVF segments only
+        ef_search: int
+            Size of the candidate list explored, HNSW segments only
+        faiss_ids: np.ndarray
+            Only search these vectors, when given. They must not be
+            deleted, as the ids `matching_ids` returns
+        rerank: int
+            Fetch `rerank` times `k` candidates from the approximate index
+            and re-score them against the full-precision vectors. Ignored
+            by segments without an index, whose distances are already
+            exact
+
+        Returns
+        -------
+        tuple
+            Distances and FAISS ids of the `k` nearest vectors of each
+            query, ids are -1 past the end of the segment
+        """
+        from app import indexes
+
+        if self.index is None:
+            return self.exact_search(vectors, k, faiss_ids)
+        selector = None
+        if faiss_ids is not None:
+            selector = faiss.IDSelectorBatch(faiss_ids)
+        elif self._excluded is not None:
+            selector = self._excluded[1]
+        params = indexes.search_parameters(self.index, nprobe, ef_search,
+                                           selector)
+        if not rerank:
+            return self.index.search(vectors, k, params=params)
+        _, candidates = self.index.search(vectors, k * rerank,
+                                          params=params)
+        return self._rerank(vectors, candidates, k)
+
+    def exact_search(self, vectors, k: int, faiss_ids=None):
+        """
+        Exact search on the full-precision vectors, see `search`. Deleted
+        vectors are left out by fetching more neighbours than `k`, doubling
+        the count until every query has `k` live ones
+        """
+        if faiss_ids is not None:
+            distances, positions = faiss.knn(
+                vectors, np.ascontiguousarray(self.vectors[faiss_ids]), k)
+            return distances, np.where(positions == -1, -1,
+                                       faiss_ids[positions])
+        if not len(self.deleted):
+            return faiss.knn(vectors, self.vectors, k)
+        fetch = min(2 * k, k + len(self.deleted))
+        while True:
+            distances, faiss_ids = faiss.knn(vectors, self.vectors, fetch)
+            live = self._live(faiss_ids)
+            if fetch == k + len(self.deleted) or \
+                    (live.sum(axis=1) >= k).all():
+                break
+            fetch = min(2 * fetch, k + len(self.deleted))
+        # Live neighbours first, each query keeping its distance order
+        order = np.argsort(~live, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        faiss_ids = np.take_along_axis(faiss_ids, order, axis=1)
+        live = np.take_along_axis(live, order, axis=1)
+        return (np.where(live, distances, np.finfo(np.float32).max),
+                np.where(live, faiss_ids, -1))
+
+    def _rerank(self, vectors, candidates, k: int):
+        """Exact top-k of each query among its candidate FAISS ids"""
+        distances = np.full((len(vectors), k), np.finfo(np.float32).max,
+                            dtype=np.float32)
+        faiss_ids = np.full((len(vectors), k), -1, dtype=np.int64)
+        for row, ids in enumerate(candidates):
+            # Sorted ids read the memory-mapped vectors in file order
+            ids = np.unique(ids[ids != -1])
+            exact = ((self.vectors[ids] - vectors[row]) ** 2).sum(axis=1)
+            top = np.argsort(exact, kind="stable")[:k]
+            distances[row, :len(top)] = exact[top]
+            faiss_ids[row, :len(top)] = ids[top]
+        return distances, faiss_ids
+
+    def matching_ids(self, where: dict):
+        """
+        Returns
+        -------
+        np.ndarray
+            FAISS ids of the chunks whose metadata has every key of
+            `where` set to its value
+        """
+        clauses = " AND ".join("json_extract(metadata, ?) = ?"
+                               for _ in where)
+        params = []
+        for key, value in where.items():
+            params.extend((f'$."{key}"', value))
+        rows = self._connection().execute(
+            f"SELECT faiss_id FROM chunks WHERE {clauses} ORDER BY faiss_id",
+            params).fetchall()
+        faiss_ids = np.array([faiss_id for faiss_id, in rows],
+                             dtype=np.int64)
+        return faiss_ids[self._live(faiss_ids)]
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{os.path.join(self.path, DOCSTORE)}?mode=ro",
+                uri=True)
+            self._local.conn = conn
+        return conn
+
+    def get_documents(self, faiss_ids: list):
+        """
+        Returns
+        -------
+        dict
+            Chunk of each of the given FAISS ids
+        """
+        documents = {}
+        faiss_ids = sorted(set(int(faiss_id) for faiss_id in faiss_ids))
+        for start in range(0, len(faiss_ids), 500):
+            batch = faiss_ids[start:start + 500]
+            rows = self._connection().execute(
+                f"SELECT faiss_id, content, metadata FROM chunks WHERE "
+                f"faiss_id IN ({','.join('?' * len(batch))})", batch)
+            for faiss_id, content, metadata in rows:
+                documents[faiss_id] = Document(
+                    page_content=content, metadata=json.loads(metadata))
+        return documents
+
+    def chunks_of(self, document: str):
+        """
+        Returns
+        -------
+        list
+            FAISS id and chunk id of every chunk of a document
+        """
+        rows = self._connection().execute(
+            "SELECT faiss_id, chunk_id FROM chunks WHERE document = ? "
+            "ORDER BY faiss_id", (document,)).fetchall()
+        if not len(self.deleted):
+            return rows
+        live = self._live([faiss_id for faiss_id, _ in rows])
+        return [row for row, kept in zip(rows, live) if kept]
+
+    def document_names(self):
+        return self._live_documents(self._connection().execute(
+            "SELECT document, MIN(faiss_id) FROM chunks GROUP BY document"))
+
+    def _live_documents(self, rows):
+        """
+        Names among (document, FAISS id of one of its chunks) rows whose
+        document is not deleted. Deletes leave out every chunk of a
+        document, so one chunk tells whether the document is deleted
+        """
+        rows = list(rows)
+        live = self._live([faiss_id for _, faiss_id in rows])
+        return [name for (name, _), kept in zip(rows, live) if kept]
+
+    def existing_hashes(self, hashes: list):
+        """
+        Returns
+        -------
+        set
+            Those of the given text hashes held by the segment
+        """
+        return {key for key, _ in self._hash_rows(hashes)}
+
+    def _hash_rows(self, hashes: list):
+        """Text hash and FAISS id of the live chunks hashing to `hashes`"""
+        rows = []
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            rows.extend(self._connection().execute(
+                f"SELECT hash, faiss_id FROM chunks WHERE "
+                f"hash IN ({','.join('?' * len(batch))})", batch))
+        live = self._live([faiss_id for _, faiss_id in rows])
+        return [row for row, kept in zip(rows, live) if kept]
+
+    def ids_of_hashes(self, hashes: list):
+        """
+        Returns
+        -------
+        list
+            FAISS ids of the chunks whose text hash is one of `hashes`
+        """
+        return sorted(faiss_id for _, faiss_id in self._hash_rows(hashes))
+
+    def iter_chunks(self):
+        """
+        Yields the chunk id and chunk of every live vector in FAISS id
+        order
+        """
+        deleted = set(self.deleted.tolist())
+        rows = self._connection().execute(
+            "SELECT faiss_id, chunk_id, content, metadata "
+            "FROM chunks ORDER BY faiss_id")
+        for faiss_id, chunk_id, content, metadata in rows:
+            if faiss_id not in deleted:
+                yield chunk_id, Document(page_content=content,
+                                         metadata=json.loads(metadata))
+
+    def writable_index(self):
+        """In-memory copy of the segment's index, None for flat segments"""
+        if self.index is None:
+            return None
+        return faiss.read_index(os.path.join(self.path, INDEX))
+
+
+def document_name(doc: Document):
+    return doc.metadata['source'].split('/')[-1]
+
+
+class SegmentWriter:
+    """
+    Writes a segment directory batch by batch, so the vectors and chunks
+    of a segment never have to be held in memory at once. Vectors are
+    appended to a raw file that becomes vectors.npy on `close`
+
+    Parameters
+    ----------
+    path: str
+        Segment directory to create
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ntotal = 0
+        self.dimension = None
+        os.makedirs(path)
+        self._raw = open(os.path.join(path, VECTORS + ".raw"), "wb")
+        self._conn = _create_docstore(path)
+
+    def add(self, chunks: list, vectors):
+        """
+        Appends a batch
+
+        Parameters
+        ----------
+        chunks: list
+            Chunk id and chunk of each vector
+        vectors: np.ndarray
+            Vectors of the batch, one row per chunk
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(chunks) != len(vectors):
+            raise ValueError("Expected one vector per chunk")
+        if not len(vectors):
+            return
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+        self._raw.write(vectors.tobytes())
+        _insert_chunks(self._conn, self.ntotal, chunks)
+        self.ntotal += len(vectors)
+
+    def close(self, index=None):
+        """
+        Finishes the segment
+
+        Parameters
+        ----------
+        index: faiss.Index
+            Approximate index over the vectors, None for a flat segment
+        """
+        self._raw.close()
+        raw_path = os.path.join(self.path, VECTORS + ".raw")
+        with open(os.path.join(self.path, VECTORS), "wb") as out:
+            np.lib.format.write_array_header_1_0(out, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                "fortran_order": False,
+                "shape": (self.ntotal, self.dimension or 0)})
+            with open(raw_path, "rb") as raw:
+                shutil.copyfileobj(raw, out, 1 << 20)
+        os.remove(raw_path)
+        _index_docstore(self._conn)
+        self._conn.close()
+        if index is not None:
+            faiss.write_index(index, os.path.join(self.path, INDEX))
+
+    def abort(self):
+        """Drops the partially written segment"""
+        self._raw.close()
+        self._conn.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def write_segment(path: str, vectors, chunks, index=None):
+    """
+    Writes a segment directory
+
+    Parameters
+    ----------
+    path: str
+        Segment directory to create
+    vectors: np.ndarray
+        Full vectors of the segment
+    chunks: iterable
+        Chunk id and chunk of each vector, in vector order
+    index: faiss.Index
+        Approximate index over `vectors`, None for a flat segment
+    """
+    writer = SegmentWriter(path)
+    writer.add(list(chunks), vectors)
+    writer.close(index=index)
+
+
+def _create_docstore(path: str):
+    conn = sqlite3.connect(os.path.join(path, DOCSTORE))
+    conn.execute("CREATE TABLE chunks (faiss_id INTEGER PRIMARY KEY, "
+                 "chunk_id TEXT NOT NULL, document TEXT NOT NULL, "
+                 "content TEXT NOT NULL, metadata TEXT NOT NULL, "
+                 "hash TEXT NOT NULL)")
+    return conn
+
+
+def _insert_chunks(conn, start: int, chunks):
+    conn.executemany(
+        "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?)",
+        ((faiss_id, chunk_id, document_name(doc), doc.page_content,
+          json.dumps(doc.metadata), text_hash(doc.page_content))
+         for faiss_id, (chunk_id, doc) in enumerate(chunks, start)))
+
+
+def _index_docstore(conn):
+    conn.execute("CREATE INDEX chunks_document ON chunks (document)")
+    conn.execute("CREATE INDEX chunks_hash ON chunks (hash)")
+    conn.commit()
+
+
+def _write_docstore(path: str, chunks):
+    conn = _create_docstore(path)
+    try:
+        _insert_chunks(conn, 0, chunks)
+        _index_docstore(conn)
+    finally:
+        conn.close()
+
+
+def convert_langchain_segment(path: str):
+    """
+    Converts, in place, a segment saved with langchain's `save_local`
+    (index.faiss and a pickled docstore) to the memory-mappable layout
+    """
+    logger.info(f"convert_langchain_segment(): {path}")
+    from app import indexes
+
+    index = faiss.read_index(os.path.join(path, INDEX))
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    if not os.path.exists(os.path.join(path, VECTORS)):
+        np.save(os.path.join(path, VECTORS),
+                indexes.reconstruct_vectors(index))
+    _write_docstore(path, ((index_to_docstore_id[i],
+                            docstore.search(index_to_docstore_id[i]))
+                           for i in range(index.ntotal)))
+    if indexes.index_type(index) == "flat":
+        os.remove(os.path.join(path, INDEX))
+    os.remove(os.path.join(path, "index.pkl"))
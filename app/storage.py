@@ -0,0 +1,613 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from app import logger, store_path
+
+# A knowledge base directory holds a manifest listing its segments in
+# order, the first one being the base segment and the rest append-only
+# deltas, the vector count of each segment, the number of documents, the
+# size on disk of each segment, the vector dimensions, the time of the
+# last write and the index type the knowledge base was created with. The
+# manifest stays small whatever the number of documents: document names
+# are kept in a SQLite document list beside it, which writes update in
+# place, and the documents of a segment in its docstore. Deleting a document
+# records the FAISS ids of its vectors in a tombstone file of each
+# segment holding it, named with its count in the manifest, until
+# compaction purges them:
+#
+#   <knowledge_base>/manifest.json
+#   <knowledge_base>/documents.sqlite
+#   <knowledge_base>/segments/<segment_id>/vectors.npy, docstore.sqlite
+#   <knowledge_base>/segments/<segment_id>/index.faiss
+#   <knowledge_base>/segments/<segment_id>/deleted-<id>.npy
+#   <knowledge_base>/staging/<segment_id>/
+#
+# Streaming ingest writes a segment under staging/ without holding the
+# write lock, and moves it under segments/ once it is complete.
+# See app/segments.py for the files of a segment. Segments are never
+# modified once written, a delete only adds a tombstone file. Writes hold
+# the knowledge base's write lock, add new segment directories and then
+# publish a new manifest with an atomic rename, so readers never wait and
+# always see a complete snapshot.
+# Segments and tombstone files dropped from the manifest are retired and
+# only deleted once `retention_seconds` have passed, so readers still
+# holding the previous manifest can open them
+MANIFEST = "manifest.json"
+DOCUMENTS = "documents.sqlite"
+SEGMENTS = "segments"
+STAGING = "staging"
+TOMBSTONES = "deleted-"
+# Seconds after which a staged segment nobody writes to any more is
+# considered abandoned
+STAGING_TTL = 24 * 60 * 60
+# Version of the segment layout, recorded in manifests
+FORMAT = 1
+LOCKS = ".locks"
+COMPACTION = ".compaction"
+
+# Seconds a segment dropped from the manifest is kept on disk for readers
+# of an older manifest
+retention_seconds = int(os.environ.get("KB_SEGMENT_RETENTION_SECONDS", 300))
+
+_held_locks = threading.local()
+
+# Manifest of each knowledge base read by `cached_manifest`, keyed by
+# manifest path, with the identity of the file it was read from
+_manifests = {}
+
+# Stats of each knowledge base read by `knowledge_base_stats`, keyed by
+# manifest path, with the identity of the file they were read from
+_stats = {}
+
+
+def manifest_path(knowledge_base: str):
+    return os.path.join(knowledge_base, MANIFEST)
+
+
+def documents_path(knowledge_base: str):
+    return os.path.join(knowledge_base, DOCUMENTS)
+
+
+@contextmanager
+def document_list(knowledge_base: str):
+    """
+    Connection to the document list of a knowledge base, one row per
+    document name. Changes are committed when the block exits without
+    error, so writers holding the write lock update it in the block that
+    publishes their manifest
+    """
+    os.makedirs(knowledge_base, exist_ok=True)
+    conn = sqlite3.connect(documents_path(knowledge_base))
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                     "(name TEXT PRIMARY KEY)")
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def document_names(knowledge_base: str):
+    """
+    Returns
+    -------
+    list
+        Sorted names of the documents of a knowledge base, read from its
+        document list
+    """
+    path = documents_path(knowledge_base)
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return [name for name, in conn.execute(
+            "SELECT name FROM documents ORDER BY name")]
+    finally:
+        conn.close()
+
+
+def segment_path(knowledge_base: str, segment_id: str):
+    return os.path.join(knowledge_base, SEGMENTS, segment_id)
+
+
+def staging_path(knowledge_base: str, segment_id: str):
+    return os.path.join(knowledge_base, STAGING, segment_id)
+
+
+def tombstone_path(knowledge_base: str, segment_id: str, name: str):
+    return os.path.join(segment_path(knowledge_base, segment_id), name)
+
+
+def write_tombstones(knowledge_base: str, segment_id: str, faiss_ids):
+    """
+    Writes the sorted FAISS ids of the deleted vectors of a segment to a
+    new tombstone file, unpublished. Must be called with the knowledge
+    base's write lock held
+
+    Returns
+    -------
+    str
+        Name of the tombstone file
+    """
+    import numpy as np
+
+    name = f"{TOMBSTONES}{uuid.uuid4().hex}.npy"
+    np.save(tombstone_path(knowledge_base, segment_id, name),
+            np.asarray(faiss_ids, dtype=np.int64))
+    return name
+
+
+def read_tombstones(knowledge_base: str, segment_id: str, manifest: dict):
+    """FAISS ids of the deleted vectors of a published segment"""
+    import numpy as np
+
+    tombstones = manifest["tombstones"].get(segment_id)
+    if tombstones is None:
+        return np.zeros(0, dtype=np.int64)
+    return np.load(tombstone_path(knowledge_base, segment_id,
+                                  tombstones["file"]))
+
+
+def live_vectors(manifest: dict):
+    """Number of vectors of a knowledge base that are not deleted"""
+    return sum(manifest["vector_counts"].values()) - sum(
+        tombstones["count"] for tombstones in manifest["tombstones"].values())
+
+
+def adopt_staged_segment(knowledge_base: str, segment_id: str):
+    """
+    Moves a complete staged segment under segments/, unpublished. Must be
+    called with the knowledge base's write lock held
+    """
+    os.makedirs(os.path.join(knowledge_base, SEGMENTS), exist_ok=True)
+    os.replace(staging_path(knowledge_base, segment_id),
+               segment_path(knowledge_base, segment_id))
+
+
+def new_segment_id():
+    return uuid.uuid4().hex
+
+
+def read_manifest(knowledge_base: str):
+    """
+    Reads the manifest of a knowledge base. Knowledge bases saved before
+    segments were introduced are migrated to a single base segment, under
+    the knowledge base's write lock
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to read the manifest of
+
+    Returns
+    -------
+    dict
+        Manifest with the knowledge base `version`, its `segments`, its
+        `document_count`, the `vector_counts` and `segment_bytes` of its
+        segments, the `dimensions` of its vectors,
+        the time it was `modified`, its configured `index` and the index
+        type its base segment was built with as `base_index`, the
+        `tombstones` file and count of the segments with deleted vectors,
+        and the time each `retired` segment or tombstone file, keyed
+        `<segment_id>/<file>`, was dropped
+    """
+    path = manifest_path(knowledge_base)
+    if not os.path.exists(path) and \
+            os.path.exists(os.path.join(knowledge_base, "index.faiss")):
+        with write_lock(knowledge_base):
+            if not os.path.exists(path):
+                _migrate_unsegmented(knowledge_base)
+    with open(path) as f:
+        return json.load(f)
+
+
+def _identity(path: str):
+    """Identity of a file, which changes whenever the file is replaced"""
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def cached_manifest(knowledge_base: str):
+    """
+    Manifest of a knowledge base, only parsed again once the manifest file
+    changed. The manifest is shared between callers and must not be
+    modified, writers use `read_manifest`
+
+    Returns
+    -------
+    tuple
+        Identity of the manifest file, which every publish replaces, and
+        the manifest
+
+    Raises
+    ------
+    OSError
+        When the knowledge base has not been saved
+    """
+    path = manifest_path(knowledge_base)
+    if not os.path.exists(path):
+        read_manifest(knowledge_base)
+    # The file is identified before it is read, so a publish in between
+    # only costs one more parse on the next call
+    identity = _identity(path)
+    cached = _manifests.get(path)
+    if cached is not None and cached[0] == identity:
+        return cached
+    cached = identity, read_manifest(knowledge_base)
+    _manifests[path] = cached
+    return cached
+
+
+def manifest_version(knowledge_base: str):
+    """
+    Version of a knowledge base, without parsing its manifest unless the
+    manifest file changed since the last call
+
+    Returns
+    -------
+    tuple
+        Manifest `version` followed by the identity of the manifest file,
+        so the tuple changes on every write even when a deleted knowledge
+        base is created again
+
+    Raises
+    ------
+    OSError
+        When the knowledge base has not been saved
+    """
+    identity, manifest = cached_manifest(knowledge_base)
+    return (manifest.get("version", 0),) + identity
+
+
+def knowledge_base_stats(knowledge_base: str):
+    """
+    Stats of a knowledge base, read from its manifest alone and only
+    parsed again once the manifest file changed
+
+    Returns
+    -------
+    dict
+        `version`, `document_count`, `vectors`, `dimensions`, `segments`
+        count, configured `index`, `base_index`, `bytes` on disk and
+        `modified` time of the knowledge base
+
+    Raises
+    ------
+    OSError
+        When the knowledge base has not been saved
+    """
+    path = manifest_path(knowledge_base)
+    identity, manifest = cached_manifest(knowledge_base)
+    cached = _stats.get(path)
+    if cached is not None and cached[0] == identity:
+        return dict(cached[1])
+    segment_bytes = _segment_bytes(knowledge_base, manifest)
+    stats = {"version": manifest.get("version", 0),
+             "document_count": manifest["document_count"],
+             "vectors": live_vectors(manifest),
+             "dimensions": manifest.get("dimensions",
+                                        _dimensions(knowledge_base,
+                                                    manifest)),
+             "segments": len(manifest["segments"]),
+             "index": manifest["index"],
+             "base_index": manifest["base_index"],
+             "bytes": sum(segment_bytes.values()) + identity[2],
+             "modified": manifest.get("modified",
+                                      os.path.getmtime(path))}
+    _stats[path] = (identity, stats)
+    return dict(stats)
+
+
+def _disk_bytes(path: str):
+    """Summed size of the files under a directory"""
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _segment_bytes(knowledge_base: str, manifest: dict):
+    """
+    Size on disk of each segment of a manifest. Segments are never
+    modified, so sizes recorded in the manifest are reused and only new
+    segments are measured
+    """
+    recorded = manifest.get("segment_bytes", {})
+    return {segment_id: recorded[segment_id] if segment_id in recorded
+            else _disk_bytes(segment_path(knowledge_base, segment_id))
+            for segment_id in manifest["segments"]}
+
+
+def _dimensions(knowledge_base: str, manifest: dict):
+    """
+    Dimensions of the vectors of a knowledge base, read from the header
+    of its base segment's vectors, None while it has no segments
+    """
+    import numpy as np
+
+    if manifest.get("dimensions") is not None or not manifest["segments"]:
+        return manifest.get("dimensions")
+    path = os.path.join(segment_path(knowledge_base, manifest["segments"][0]),
+                        "vectors.npy")
+    try:
+        return int(np.load(path, mmap_mode="r").shape[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def exists(knowledge_base: str):
+    """Whether a knowledge base has been saved, in any layout"""
+    return os.path.exists(manifest_path(knowledge_base)) or \
+        os.path.exists(os.path.join(knowledge_base, "index.faiss"))
+
+
+def list_knowledge_bases(root: str, prefix: str = ""):
+    """
+    Returns
+    -------
+    list
+        Names, relative to `root`, of the knowledge bases saved under
+        `root` whose name starts with `prefix`, sorted
+    """
+    names = []
+    for path, dirs, files in os.walk(root):
+        name = os.path.relpath(path, root).replace(os.sep, "/")
+        if name != "." and exists(path):
+            if name.startswith(prefix):
+                names.append(name)
+            dirs[:] = []
+            continue
+        base = "" if name == "." else name + "/"
+        dirs[:] = sorted(
+            directory for directory in dirs
+            if not directory.startswith(".") and
+            (base + directory).startswith(prefix[:len(base + directory)]))
+    return sorted(names)
+
+
+def new_manifest(index: dict):
+    """
+    Manifest of a knowledge base without segments
+
+    Parameters
+    ----------
+    index: dict
+        Index configuration of the knowledge base
+    """
+    return {"version": 0, "format": FORMAT, "segments": [],
+            "document_count": 0, "vector_counts": {}, "index": index,
+            "base_index": "flat", "tombstones": {}, "retired": {}}
+
+
+def lock_path(knowledge_base: str):
+    """
+    Lock file of a knowledge base. Lock files live outside knowledge base
+    directories so a knowledge base can be locked before it exists and
+    after it is deleted
+    """
+    key = os.path.abspath(knowledge_base).encode("utf-8")
+    return os.path.join(store_path, LOCKS,
+                        f"{hashlib.sha1(key).hexdigest()}.lock")
+
+
+@contextmanager
+def write_lock(knowledge_base: str):
+    """
+    Holds the write lock of a knowledge base, blocking until every other
+    writer, in this or any other process, has released it. Reentrant
+    within a thread, readers never take it
+    """
+    path = lock_path(knowledge_base)
+    held = _held_locks.__dict__.setdefault("paths", set())
+    if path in held:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        held.add(path)
+        try:
+            yield
+        finally:
+            held.discard(path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def compaction_lock(knowledge_base: str):
+    """
+    Held by compactions of a knowledge base so they run one at a time, in
+    this or any other process. Writers do not take it
+    """
+    with write_lock(os.path.join(knowledge_base, COMPACTION)):
+        yield
+
+
+def write_manifest(knowledge_base: str, manifest: dict):
+    """
+    Publishes a manifest. The file is written aside and renamed over the
+    previous one so readers see either the old or the new manifest
+    """
+    path = manifest_path(knowledge_base)
+    os.makedirs(knowledge_base, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def publish_manifest(knowledge_base: str, manifest: dict,
+                     retired: list = ()):
+    """
+    Publishes an updated manifest under the next version, with the size
+    of new segments, the vector dimensions and the time of the write
+    recorded. Counts and tombstones of unpublished segments are dropped.
+    Must be called with the knowledge base's write lock held. Segments and
+    tombstone files retired longer than `retention_seconds` ago, and those
+    left behind by failed writes, are deleted once the manifest is out
+
+    Parameters
+    ----------
+    knowledge_base: str
+        Knowledge base to update
+    manifest: dict
+        Manifest read from the knowledge base, or a `new_manifest`, with
+        its segments and document count updated
+    retired: list
+        Segments, and `<segment_id>/<file>` tombstone files, the update
+        drops from the knowledge base
+
+    Returns
+    -------
+    dict
+        The published manifest
+    """
+    manifest = dict(manifest)
+    manifest["version"] = manifest.get("version", 0) + 1
+    manifest["vector_counts"] = {
+        segment_id: manifest["vector_counts"][segment_id]
+        for segment_id in manifest["segments"]}
+    manifest["tombstones"] = {
+        segment_id: tombstones for segment_id, tombstones
+        in manifest.get("tombstones", {}).items()
+        if segment_id in manifest["segments"]}
+    manifest["segment_bytes"] = _segment_bytes(knowledge_base, manifest)
+    manifest["dimensions"] = _dimensions(knowledge_base, manifest)
+    now = time.time()
+    manifest["modified"] = now
+    retired = {**manifest.get("retired", {}),
+               **{segment_id: now for segment_id in retired}}
+    expired = [segment_id for segment_id, retired_at in retired.items()
+               if now - retired_at >= retention_seconds]
+    manifest["retired"] = {segment_id: retired_at for segment_id, retired_at
+                           in retired.items() if segment_id not in expired}
+    write_manifest(knowledge_base, manifest)
+    remove_segments(knowledge_base, expired + _orphans(knowledge_base,
+                                                       manifest))
+    _remove_abandoned_staging(knowledge_base)
+    return manifest
+
+
+def remove_segments(knowledge_base: str, segment_ids: list):
+    """
+    Deletes segment directories, and `<segment_id>/<file>` tombstone
+    files, that are no longer published
+    """
+    for segment_id in segment_ids:
+        path = segment_path(knowledge_base, segment_id)
+        if "/" not in segment_id:
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _orphans(knowledge_base: str, manifest: dict):
+    """
+    Segment directories and tombstone files neither published nor retired,
+    left behind by writes that failed before publishing their manifest
+    """
+    directory = os.path.join(knowledge_base, SEGMENTS)
+    if not os.path.isdir(directory):
+        return []
+    known = set(manifest["segments"]) | set(manifest["retired"]) | {
+        f"{segment_id}/{tombstones['file']}" for segment_id, tombstones
+        in manifest.get("tombstones", {}).items()}
+    orphans = [segment_id for segment_id in os.listdir(directory)
+               if segment_id not in known]
+    for segment_id in manifest["segments"]:
+        try:
+            names = os.listdir(segment_path(knowledge_base, segment_id))
+        except FileNotFoundError:
+            continue
+        orphans.extend(f"{segment_id}/{name}" for name in names
+                       if name.startswith(TOMBSTONES) and
+                       f"{segment_id}/{name}" not in known)
+    return orphans
+
+
+def _remove_abandoned_staging(knowledge_base: str):
+    directory = os.path.join(knowledge_base, STAGING)
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    for segment_id in os.listdir(directory):
+        path = os.path.join(directory, segment_id)
+        try:
+            modified = max([os.path.getmtime(path)] + [
+                os.path.getmtime(os.path.join(path, name))
+                for name in os.listdir(path)])
+        except OSError:
+            continue
+        if now - modified > STAGING_TTL:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def merge_results(results: list, k: int):
+    """
+    Merges per-segment search results into a global top-k
+
+    Parameters
+    ----------
+    results: list
+        For each segment, a list holding (document, distance) hits of every
+        query
+    k: int
+        Number of hits to keep per query
+
+    Returns
+    -------
+    list
+        Top-k (document, distance) hits of every query, closest first
+    """
+    if not results:
+        return []
+    merged = []
+    for query_hits in zip(*results):
+        hits = [hit for segment_hits in query_hits for hit in segment_hits]
+        hits.sort(key=lambda hit: hit[1])
+        merged.append(hits[:k])
+    return merged
+
+
+def _migrate_unsegmented(knowledge_base: str):
+    """
+    Moves a knowledge base saved with langchain's `save_local` into a
+    single base segment in the memory-mappable layout, and writes its
+    document list and manifest
+    """
+    from app import segments
+
+    logger.info(f"_migrate_unsegmented(): {knowledge_base}")
+    segment_id = new_segment_id()
+    path = segment_path(knowledge_base, segment_id)
+    os.makedirs(path)
+    for name in ("index.faiss", "index.pkl"):
+        os.replace(os.path.join(knowledge_base, name),
+                   os.path.join(path, name))
+    segments.convert_langchain_segment(path)
+    segment = segments.Segment(path)
+    documents = segment.document_names()
+    manifest = new_manifest({"type": "flat"})
+    manifest["segments"] = [segment_id]
+    manifest["vector_counts"] = {segment_id: segment.ntotal}
+    manifest["document_count"] = len(documents)
+    with document_list(knowledge_base) as conn:
+        conn.executemany("INSERT INTO documents VALUES (?)",
+                         [(name,) for name in documents])
+        publish_manifest(knowledge_base, manifest)
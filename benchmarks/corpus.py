@@ -0,0 +1,91 @@
+import hashlib
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+
+# Synthetic chunks are drawn from topic-specific and shared vocabularies,
+# so chunks of a topic land close together in the stub embedding space
+# the way real documents cluster
+COMMON_WORDS = 500
+WORDS_PER_TOPIC = 50
+
+
+def generate_corpus(size: int, seed: int = 0, topics: int = 100,
+                    words_per_chunk: int = 40, block_size: int = 10000):
+    """
+    Generates a reproducible synthetic corpus of single-chunk documents
+
+    Parameters
+    ----------
+    size: int
+        Number of documents to generate
+    seed: int
+        Random seed, the same seed always gives the same corpus
+    topics: int
+        Number of topics documents are spread over
+    words_per_chunk: int
+        Number of words in each document
+    block_size: int
+        Number of documents generated at a time
+
+    Yields
+    ------
+    dict
+        Text of each document by document name, `block_size` documents at
+        a time
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, size, block_size):
+        count = min(block_size, size - start)
+        doc_topics = rng.integers(0, topics, count)
+        topical = rng.random((count, words_per_chunk)) < 0.7
+        topic_words = rng.integers(0, WORDS_PER_TOPIC,
+                                   (count, words_per_chunk))
+        common_words = rng.integers(0, COMMON_WORDS,
+                                    (count, words_per_chunk))
+        block = {}
+        for i in range(count):
+            words = [f"t{doc_topics[i]}w{topic_words[i][j]}" if topical[i][j]
+                     else f"w{common_words[i][j]}"
+                     for j in range(words_per_chunk)]
+            # A unique word keeps every chunk distinct for deduplication
+            words.append(f"doc{start + i}")
+            block[f"doc{start + i}.txt"] = " ".join(words)
+        yield block
+
+
+class StubEmbeddings(Embeddings):
+    """
+    Offline embedding model for benchmarks. A text's vector is the
+    normalized mean of pseudo-random word vectors seeded by each word, so
+    it is deterministic and costs far less than a real model
+
+    Parameters
+    ----------
+    dimension: int
+        Size of the vectors, 384 like the default model
+    """
+
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+        self._words = {}
+
+    def _word(self, word: str):
+        vector = self._words.get(word)
+        if vector is None:
+            seed = int(hashlib.sha256(word.encode("utf-8")).hexdigest()[:16],
+                       16)
+            vector = np.random.default_rng(seed).standard_normal(
+                self.dimension).astype(np.float32)
+            self._words[word] = vector
+        return vector
+
+    def _embed(self, text: str):
+        vector = np.mean([self._word(word) for word in text.split()],
+                         axis=0)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def embed_documents(self, texts: list):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str):
+        return self._embed(text)
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+import numpy as np
+
+DEFAULT_OUTPUT = "benchmark-results.json"
+
+
+def _percentiles(samples: list):
+    samples = np.array(samples) * 1000
+    return {"count": len(samples),
+            "mean_ms": float(samples.mean()) if len(samples) else None,
+            "p50_ms": float(np.percentile(samples, 50))
+            if len(samples) else None,
+            "p99_ms": float(np.percentile(samples, 99))
+            if len(samples) else None}
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def benchmark(size: int, index: dict = None, model: str = "stub",
+              queries: int = 200, deletes: int = 20,
+              block_size: int = 10000, batch_size: int = 64,
+              seed: int = 0):
+    """
+    Ingests a synthetic corpus into a fresh knowledge base and measures
+    ingest throughput, cold load time, query latency, recall against
+    exact search and delete time
+
+    Parameters
+    ----------
+    size: int
+        Number of chunks to ingest
+    index: dict
+        Index configuration of the knowledge base, flat when None
+    model: str
+        "stub" for the offline stub embeddings, "real" for the configured
+        model
+    queries: int
+        Number of single document queries to time
+    deletes: int
+        Number of document deletes to time
+    block_size: int
+        Number of documents ingested per bulk add
+    batch_size: int
+        Number of chunks embedded per model call
+    seed: int
+        Seed of the synthetic corpus and of the sampled queries
+
+    Returns
+    -------
+    dict
+        Measurements of the run
+    """
+    from app import helper, store_path
+    from app.embeddings import LazyEmbeddings
+    from benchmarks.corpus import StubEmbeddings, generate_corpus
+
+    if model == "stub":
+        helper._embeddings = StubEmbeddings()
+    else:
+        # Without the shared embedding cache, so every run embeds its
+        # corpus and leaves no entries behind
+        helper._embeddings = LazyEmbeddings(helper._load_model)
+    knowledge_base = os.path.join(store_path, "benchmarks",
+                                  uuid.uuid4().hex)
+    rng = np.random.default_rng(seed)
+    sampled = set(f"doc{i}.txt" for i in rng.choice(
+        size, min(size, queries + deletes), replace=False))
+    stored = set()
+    try:
+        ingest_seconds, chunks = 0.0, 0
+        for block in generate_corpus(size, seed=seed,
+                                     block_size=block_size):
+            for name, text in block.items():
+                helper.document_store.put(name, text)
+            stored.update(block)
+            start = time.perf_counter()
+            if not chunks:
+                helper.create_knowledge_base(next(iter(block)),
+                                             knowledge_base, index=index)
+                chunks += 1
+            report = helper.add_documents_to_knowledge_base(
+                list(block), knowledge_base, batch_size=batch_size)
+            ingest_seconds += time.perf_counter() - start
+            chunks += report["chunks"]
+            for name in block:
+                if name not in sampled:
+                    helper.document_store.delete(name)
+                    stored.discard(name)
+
+        start = time.perf_counter()
+        helper.compact_knowledge_base(knowledge_base)
+        compact_seconds = time.perf_counter() - start
+
+        recall = helper.measure_recall(knowledge_base, k=10,
+                                       queries=max(queries, 1), seed=seed)
+
+        helper.knowledge_base_cache.clear()
+        start = time.perf_counter()
+        helper.load_knowledge_base(knowledge_base)
+        load_seconds = time.perf_counter() - start
+
+        sampled = sorted(sampled)
+        query_docs, delete_docs = sampled[:queries], sampled[queries:]
+        latencies = []
+        for query_doc in query_docs:
+            start = time.perf_counter()
+            helper.find_similar_document(query_doc, knowledge_base)
+            latencies.append(time.perf_counter() - start)
+
+        delete_times = []
+        for document in delete_docs:
+            start = time.perf_counter()
+            helper.delete_document_from_knowledge_base(document,
+                                                       knowledge_base)
+            delete_times.append(time.perf_counter() - start)
+
+        return {"size": size, "index": index or {"type": "flat"},
+                "model": model,
+                "ingest": {"chunks": chunks, "seconds": ingest_seconds,
+                           "docs_per_sec": size / ingest_seconds
+                           if ingest_seconds else None},
+                "compact_seconds": compact_seconds,
+                "load_seconds": load_seconds,
+                "query": _percentiles(latencies),
+                "recall": recall["recall"],
+                "index_bytes_per_vector":
+                    recall["index_bytes_per_vector"],
+                "delete": _percentiles(delete_times),
+                "peak_rss_mb": _peak_rss_mb()}
+    finally:
+        for name in stored:
+            helper.document_store.delete(name)
+        shutil.rmtree(knowledge_base, ignore_errors=True)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Relative change of the main measurements against a baseline run, per
+    corpus size. Positive is slower, or lower throughput or recall
+
+    Returns
+    -------
+    dict
+        Relative changes by corpus size
+    """
+    metrics = {"docs_per_sec": lambda r: r["ingest"]["docs_per_sec"],
+               "query_p50_ms": lambda r: r["query"]["p50_ms"],
+               "query_p99_ms": lambda r: r["query"]["p99_ms"],
+               "load_seconds": lambda r: r["load_seconds"],
+               "delete_mean_ms": lambda r: r["delete"]["mean_ms"],
+               "peak_rss_mb": lambda r: r["peak_rss_mb"],
+               "recall": lambda r: r.get("recall")}
+    previous = {run["size"]: run for run in baseline["results"]}
+    changes = {}
+    for run in results["results"]:
+        if run["size"] not in previous:
+            continue
+        changes[run["size"]] = {}
+        for name, value in metrics.items():
+            new, old = value(run), value(previous[run["size"]])
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            changes[run["size"]][name] = -change \
+                if name in ("docs_per_sec", "recall") else change
+    return changes
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks ingest, load, query and delete on "
+                    "synthetic corpora")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000],
+                        help="corpus sizes, in chunks, e.g. 1000 100000 "
+                             "1000000")
+    parser.add_argument("--index", type=json.loads, default=None,
+                        help='index configuration, e.g. \'{"type": "ivf"}\'')
+    parser.add_argument("--model", choices=["stub", "real"],
+                        default="stub",
+                        help="stub runs offline, real loads the model")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--deletes", type=int, default=20)
+    parser.add_argument("--block-size", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="JSON file the results are written to")
+    parser.add_argument("--baseline",
+                        help="results of an earlier run to compare with")
+    parser.add_argument("--single", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    options = {"index": args.index, "model": args.model,
+               "queries": args.queries, "deletes": args.deletes,
+               "block_size": args.block_size,
+               "batch_size": args.batch_size, "seed": args.seed}
+    if args.single:
+        json.dump(benchmark(args.sizes[0], **options), sys.stdout)
+        return
+
+    results = {"commit": _git_commit(), "timestamp": time.time(),
+               "python": platform.python_version(),
+               "platform": platform.platform(), "options": options,
+               "results": []}
+    for size in args.sizes:
+        # Each size runs in its own process so peak RSS is its own
+        command = [sys.executable, "-m", "benchmarks.run", "--single",
+                   "--sizes", str(size), "--model", args.model,
+                   "--queries", str(args.queries),
+                   "--deletes", str(args.deletes),
+                   "--block-size", str(args.block_size),
+                   "--batch-size", str(args.batch_size),
+                   "--seed", str(args.seed)]
+        if args.index:
+            command += ["--index", json.dumps(args.index)]
+        run = subprocess.run(command, capture_output=True, text=True,
+                             check=True)
+        results["results"].append(json.loads(run.stdout))
+        print(json.dumps(results["results"][-1]), file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["changes"] = compare(results, json.load(f))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
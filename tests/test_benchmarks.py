@@ -0,0 +1,57 @@
+import shutil
+import unittest
+import numpy as np
+from app import document_stores, helper
+from benchmarks.corpus import StubEmbeddings, generate_corpus
+from benchmarks.run import benchmark, compare
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.embeddings = helper._embeddings
+        self.documents_store = dict(helper.documents_store)
+
+    def tearDown(self):
+        helper._embeddings = self.embeddings
+        helper.documents_store.clear()
+        helper.documents_store.update(self.documents_store)
+        helper.knowledge_base_cache.clear()
+
+    def test_generate_corpus_reproducible(self):
+        first = [block for block in generate_corpus(25, block_size=10)]
+        second = [block for block in generate_corpus(25, block_size=10)]
+        self.assertEqual(first, second)
+        self.assertEqual([len(block) for block in first], [10, 10, 5])
+
+    def test_stub_embeddings_deterministic(self):
+        vectors = StubEmbeddings(dimension=8).embed_documents(["a b", "c"])
+        again = StubEmbeddings(dimension=8).embed_documents(["a b", "c"])
+        np.testing.assert_array_equal(vectors, again)
+        self.assertAlmostEqual(float(np.linalg.norm(vectors[0])), 1.0,
+                               places=5)
+
+    def test_benchmark_reports_measurements(self):
+        result = benchmark(60, queries=5, deletes=2, block_size=25)
+        self.assertEqual(result["ingest"]["chunks"], 60)
+        self.assertEqual(result["query"]["count"], 5)
+        self.assertEqual(result["delete"]["count"], 2)
+        self.assertGreater(result["peak_rss_mb"], 0)
+        self.assertEqual(result["recall"], 1.0)
+        changes = compare({"results": [result]}, {"results": [result]})
+        self.assertEqual(changes[60]["query_p50_ms"], 0.0)
+
+    def test_benchmark_with_disk_document_store(self):
+        directory = "vector_store/app_test_benchmark_documents"
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.addCleanup(setattr, helper, "document_store",
+                        helper.document_store)
+        helper.document_store = document_stores.DiskDocumentStore(directory)
+        result = benchmark(30, queries=3, deletes=2, block_size=10)
+        self.assertEqual(result["ingest"]["chunks"], 30)
+        self.assertEqual(result["query"]["count"], 3)
+        # The corpus is removed from the store once measured
+        self.assertEqual(helper.document_store.names(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
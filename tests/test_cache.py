@@ -0,0 +1,54 @@
+import time
+import unittest
+from app.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        cache = LRUCache(maxsize=2)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_evicts_by_size(self):
+        cache = LRUCache(maxsize=10, max_bytes=10, sizeof=len)
+        cache.put("a", "x" * 6)
+        cache.put("b", "x" * 6)
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.stats()["bytes"], 6)
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(ttl=0.05)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_drops_nested_keys(self):
+        cache = LRUCache()
+        cache.put("vector_store/kb", 1)
+        cache.put("vector_store/kb/sub", 2)
+        cache.put("vector_store/kb2", 3)
+        cache.invalidate("vector_store/kb")
+        self.assertEqual(len(cache), 1)
+        self.assertIn("vector_store/kb2", cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import io
+import os
+import shutil
+import unittest
+from app import document_stores, helper, storage
+
+
+class DocumentStoreTestCase(unittest.TestCase):
+    path = "vector_store/app_test_document_store"
+
+    def setUp(self):
+        self.store = document_stores.DiskDocumentStore(
+            os.path.join(self.path, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_put_and_open(self):
+        info = self.store.put("a.txt", "Hold my beer!")
+        self.assertEqual(info["size"], 13)
+        self.assertEqual(self.store.info("a.txt"), info)
+        with self.store.open("a.txt") as f:
+            self.assertEqual(f.read(5), "Hold ")
+        self.assertEqual(self.store.get("missing.txt"), None)
+        with self.assertRaises(KeyError):
+            self.store.open("missing.txt")
+
+    def test_same_content_stored_once(self):
+        first = self.store.put("a.txt", io.BytesIO(b"same text"))
+        self.store.put("b.txt", "same text")
+        self.assertEqual(self.store.infos()[1]["hash"], first["hash"])
+        self.store.delete("a.txt")
+        self.assertEqual(self.store.get("b.txt"), "same text")
+        self.store.put("b.txt", "new text")
+        objects = [name for _, _, files in os.walk(
+            os.path.join(self.store.path, document_stores.OBJECTS))
+            for name in files]
+        self.assertEqual(objects, [self.store.info("b.txt")["hash"]])
+        with self.assertRaises(KeyError):
+            self.store.delete("a.txt")
+
+    def test_register_directory(self):
+        directory = os.path.join(self.path, "corpus")
+        os.makedirs(os.path.join(directory, "nested"))
+        for name, text in (("a.txt", "first"), ("b.txt", "second"),
+                           ("c.pdf", "third")):
+            with open(os.path.join(directory, name), "w") as f:
+                f.write(text)
+        stored = self.store.register_directory(directory, "*.txt")
+        self.assertEqual([info["name"] for info in stored],
+                         ["a.txt", "b.txt"])
+        self.assertEqual(self.store.names(), ["a.txt", "b.txt"])
+        self.assertEqual(len(self.store), 2)
+
+    def test_memory_store_shows_dict_changes(self):
+        documents = {}
+        store = document_stores.MemoryDocumentStore(documents)
+        documents["a.txt"] = "text"
+        self.assertIn("a.txt", store)
+        store.put("b.txt", io.StringIO("more"))
+        self.assertEqual(documents["b.txt"], "more")
+
+    def test_incomplete_store_cannot_be_created(self):
+        class ReadOnlyStore(document_stores.DocumentStore):
+            def open(self, name):
+                raise KeyError(name)
+
+        with self.assertRaises(TypeError):
+            ReadOnlyStore()
+
+    def test_knowledge_base_built_from_disk_store(self):
+        knowledge_base = os.path.join(self.path, "kb")
+        self.store.put("large.txt", "\n\n".join(
+            f"paragraph {i} " + "text " * 50 for i in range(50)))
+        self.store.put("beer.pdf", "Hold my beer!")
+        default = helper.document_store
+        helper.document_store = self.store
+        try:
+            helper.add_document_to_knowledge_base("large.txt",
+                                                  knowledge_base)
+            result = helper.find_similar_document("beer.pdf",
+                                                  knowledge_base, k=1)
+        finally:
+            helper.document_store = default
+        manifest = storage.read_manifest(knowledge_base)
+        self.assertEqual(sum(manifest["vector_counts"].values()), 17)
+        self.assertEqual(result[0][0].metadata["source"], "large.txt")
@@ -1,7 +1,9 @@
 import json
+import os
 import shutil
+import time
 import unittest
-from app import create_app
+from app import create_app, helper
 
 
 class DocumentsTestCase(unittest.TestCase):
@@ -28,6 +30,7 @@ class DocumentsTestCase(unittest.TestCase):
         response = json.loads(response.get_data(as_text=True))
         self.assertEqual(response["message"], "Document added to "
                          "knowledge base")
+        self.assertEqual(set(response["duplicates"]), {"exact", "near"})
 
     def test_add_document_knowledge_base_invalid_document(self):
         req = {"knowledge_base": self.test_knowledge_base,
@@ -36,6 +39,42 @@ class DocumentsTestCase(unittest.TestCase):
                                     content_type="application/json")
         self.assertEqual(response.status_code, 400)
 
+    def test_add_documents_knowledge_base(self):
+        req = {"knowledge_base": "app_test/bulk",
+               "documents": ["railway.txt", "invalid.txt", "beer.pdf"],
+               "batch_size": 1}
+        response = self.client.post("/documents", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(response["added"], 2)
+        self.assertEqual(response["failed"], 1)
+        self.assertEqual(response["documents"]["railway.txt"], "added")
+        self.assertIn("docs_per_sec", response)
+
+    def test_add_document_knowledge_base_async(self):
+        req = {"knowledge_base": "app_test/async",
+               "document": "hello.txt", "async": True}
+        response = self.client.post("/document", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.get_data(as_text=True))["job_id"]
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            response = self.client.get(f"/jobs/{job_id}")
+            job = json.loads(response.get_data(as_text=True))
+            if job["state"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.05)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(job["state"], "succeeded")
+        self.assertEqual(job["kind"], "add_document")
+        self.assertEqual(job["result"], {"exact": 0, "near": 0})
+
+    def test_get_job_not_found(self):
+        response = self.client.get("/jobs/invalid")
+        self.assertEqual(response.status_code, 404)
+
     def test_delete_document_from_knowledge_base(self):
         req = {"knowledge_base": self.test_knowledge_base,
                "document": "hello.txt"}
@@ -75,6 +114,126 @@ class DocumentsTestCase(unittest.TestCase):
         self.assertEqual(response["error"], "Cannot get similar documents, "
                          "check query params")
 
+    def test_search_similar_documents_batch(self):
+        self.test_add_document_knowledge_base()
+        req = {"knowledge_base": self.test_knowledge_base,
+               "query_docs": ["hello.txt", "greetings.pdf"], "k": 1}
+        response = self.client.post("/documents/search", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(response["results"]), 2)
+        self.assertEqual(response["results"][1]["query_doc"],
+                         "greetings.pdf")
+        self.assertEqual(len(response["results"][0]["documents"]), 1)
+
+    def test_get_similar_documents_filtered_without_content(self):
+        req = {"knowledge_base": "app_test/filter",
+               "documents": ["hello.txt", "beer.pdf", "greetings.pdf"]}
+        self.client.post("/documents", json=req,
+                         content_type="application/json")
+        query_string = "knowledge_base=app_test/filter&query_doc=hello.txt" \
+            "&k=2&source=beer.pdf&include_content=false"
+        response = self.client.get(f"/documents?{query_string}")
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(response["documents"][0]["document"], "beer.pdf")
+        self.assertEqual(len(response["documents"]), 1)
+        self.assertNotIn("content", response["documents"][0])
+        query_string = "knowledge_base=app_test/filter&query_doc=hello.txt" \
+            "&filter=not-json"
+        response = self.client.get(f"/documents?{query_string}")
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_similar_documents_federated(self):
+        for name, document in (("app_test/federated/a", "beer.pdf"),
+                               ("app_test/federated/b", "greetings.pdf")):
+            self.client.post("/document", json={"knowledge_base": name,
+                                                "document": document})
+        response = self.client.get(
+            "/documents/federated?query_doc=beer.pdf&k=2"
+            "&prefix=app_test/federated/&include_content=false")
+        self.assertEqual(response.status_code, 200)
+        response = response.get_json()
+        self.assertEqual([(hit["knowledge_base"], hit["document"])
+                          for hit in response["documents"]],
+                         [("app_test/federated/a", "beer.pdf"),
+                          ("app_test/federated/b", "greetings.pdf")])
+        self.assertEqual(sorted(response["knowledge_bases"]),
+                         ["app_test/federated/a", "app_test/federated/b"])
+        response = self.client.get(
+            "/documents/federated?query_doc=beer.pdf"
+            "&knowledge_bases=app_test/federated/b,app_test/none")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["knowledge_bases"]
+                         ["app_test/none"]["status"], "error")
+        response = self.client.get("/documents/federated?query_doc=beer.pdf"
+                                   "&prefix=app_test/missing/")
+        self.assertEqual(response.status_code, 400)
+
+    def test_store_and_delete_document(self):
+        response = self.client.put("/document_store/stored.txt",
+                                   data=b"A stored document about beer")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["size"], 28)
+        names = [info["name"] for info in self.client.get(
+            "/document_store").get_json()["documents"]]
+        self.assertIn("stored.txt", names)
+        req = {"knowledge_base": "app_test/store",
+               "document": "stored.txt"}
+        response = self.client.post("/document", json=req)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.delete("/document_store/stored.txt")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.delete("/document_store/stored.txt")
+        self.assertEqual(response.status_code, 400)
+
+    def test_register_documents_invalid_directory(self):
+        response = self.client.post("/document_store/register",
+                                    json={"directory": "missing"})
+        self.assertEqual(response.status_code, 403)
+        root = helper.document_import_root
+        helper.document_import_root = "vector_store/app_test/import"
+        try:
+            response = self.client.post("/document_store/register",
+                                        json={"directory": "missing"})
+            self.assertEqual(response.status_code, 400)
+        finally:
+            helper.document_import_root = root
+
+    def test_register_documents_confined_to_import_root(self):
+        root = "vector_store/app_test/import"
+        os.makedirs(os.path.join(root, "corpus"), exist_ok=True)
+        with open(os.path.join(root, "corpus", "imported.txt"), "w") as f:
+            f.write("An imported document")
+        os.symlink(os.path.abspath("README.md"),
+                   os.path.join(root, "corpus", "readme.txt"))
+        previous = helper.document_import_root
+        helper.document_import_root = root
+        try:
+            for directory in ("/etc", "../..", "corpus/../.."):
+                response = self.client.post("/document_store/register",
+                                            json={"directory": directory})
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post("/document_store/register",
+                                        json={"directory": "corpus"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([info["name"] for info
+                              in response.get_json()["documents"]],
+                             ["imported.txt"])
+        finally:
+            helper.document_import_root = previous
+            helper.document_store.delete("imported.txt")
+
+    def test_search_similar_documents_batch_invalid_knowledge_base(self):
+        req = {"knowledge_base": "invalid", "query_docs": ["hello.txt"]}
+        response = self.client.post("/documents/search", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(response["error"], "Cannot get similar documents, "
+                         "check request data")
+
 
 if __name__ == "__main__":
     unittest.main()
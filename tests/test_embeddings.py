@@ -0,0 +1,137 @@
+import os
+import shutil
+import sqlite3
+import threading
+import unittest
+from langchain.schema.embeddings import Embeddings
+from app.embeddings import (BatchingEmbeddings, CachedEmbeddings,
+                            EmbeddingCache)
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.embedded = []
+        self.calls = []
+
+    def embed_documents(self, texts):
+        if "fail" in texts:
+            raise ValueError("cannot embed")
+        self.embedded.extend(texts)
+        self.calls.append(len(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class CachedEmbeddingsTestCase(unittest.TestCase):
+    cache_dir = "vector_store/app_test_embeddings"
+
+    def setUp(self):
+        self.model = CountingEmbeddings()
+        self.cache = EmbeddingCache(
+            os.path.join(self.cache_dir, "cache.sqlite"), max_entries=2)
+        self.embeddings = CachedEmbeddings(self.model, "counting",
+                                           self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_identical_text_embedded_once(self):
+        first = self.embeddings.embed_documents(["abc", "abc"])
+        second = self.embeddings.embed_query("abc")
+        self.assertEqual(self.model.embedded, ["abc"])
+        self.assertEqual(first, [[3.0, 1.0], [3.0, 1.0]])
+        self.assertEqual(second, [3.0, 1.0])
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_cache_keyed_by_model_name(self):
+        self.embeddings.embed_query("abc")
+        other = CachedEmbeddings(self.model, "other", self.cache)
+        other.embed_query("abc")
+        self.assertEqual(self.model.embedded, ["abc", "abc"])
+
+    def test_least_recently_used_vectors_evicted(self):
+        for text in ["a", "bb", "ccc"]:
+            self.embeddings.embed_query(text)
+        self.embeddings.embed_query("ccc")
+        self.assertEqual(self.model.embedded, ["a", "bb", "ccc"])
+        self.embeddings.embed_query("a")
+        self.assertEqual(self.model.embedded, ["a", "bb", "ccc", "a"])
+
+    def last_used(self):
+        conn = sqlite3.connect(self.cache.path)
+        try:
+            return dict(conn.execute("SELECT hash, last_used FROM embeddings"))
+        finally:
+            conn.close()
+
+    def test_recent_hits_not_rewritten(self):
+        self.cache.put_many("counting", {"a": [1.0]})
+        stored = self.last_used()
+        self.assertEqual(self.cache.get_many("counting", ["a"]),
+                         {"a": [1.0]})
+        self.assertEqual(self.last_used(), stored)
+        self.cache.touch_interval = 0
+        self.cache.get_many("counting", ["a"])
+        self.assertGreater(self.last_used()["a"], stored["a"])
+
+    def test_vectors_stored_elsewhere_counted_on_recount(self):
+        self.cache.recount_interval = 3
+        self.cache.put_many("counting", {"a": [1.0]})
+        other = EmbeddingCache(self.cache.path, max_entries=10)
+        other.put_many("counting", {"b": [1.0]})
+        # The in-memory count does not know of "b" until the next recount
+        self.cache.put_many("counting", {"c": [1.0]})
+        self.assertEqual(len(self.last_used()), 3)
+        self.cache.put_many("counting", {"d": [1.0]})
+        self.assertEqual(sorted(self.last_used()), ["c", "d"])
+
+class BatchingEmbeddingsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model = CountingEmbeddings()
+        self.embeddings = BatchingEmbeddings(self.model, max_batch_size=4,
+                                             max_wait=5)
+
+    def embed_concurrently(self, calls):
+        results = [None] * len(calls)
+
+        def embed(i):
+            results[i] = self.embeddings.embed_documents(calls[i])
+
+        threads = [threading.Thread(target=embed, args=(i,))
+                   for i in range(len(calls))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_embedded_in_one_batch(self):
+        results = self.embed_concurrently([["a"], ["bb", "a"], ["ccc"]])
+        self.assertEqual(results, [[[1.0, 1.0]],
+                                   [[2.0, 1.0], [1.0, 1.0]],
+                                   [[3.0, 1.0]]])
+        self.assertEqual(self.model.calls, [3])
+        self.assertEqual(self.embeddings.stats()["batches"], 1)
+
+    def test_batch_closes_after_max_wait(self):
+        self.embeddings.max_wait = 0.01
+        self.assertEqual(self.embeddings.embed_query("a"), [1.0, 1.0])
+        self.assertEqual(self.embeddings.embed_documents([]), [])
+        self.assertEqual(self.model.calls, [1])
+
+    def test_large_call_embedded_alone(self):
+        texts = ["x" * length for length in range(1, 7)]
+        self.assertEqual(len(self.embeddings.embed_documents(texts)), 6)
+        self.assertEqual(self.model.calls, [6])
+
+    def test_error_raised_in_calling_thread(self):
+        self.embeddings.max_wait = 0.01
+        with self.assertRaises(ValueError):
+            self.embeddings.embed_documents(["fail"])
+        self.assertEqual(self.embeddings.embed_query("a"), [1.0, 1.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
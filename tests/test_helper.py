@@ -1,7 +1,10 @@
+import random
 import shutil
+import threading
+import time
 import unittest
 import os
-from app import helper
+from app import helper, storage
 
 
 class HelperTestCase(unittest.TestCase):
@@ -10,13 +13,15 @@ class HelperTestCase(unittest.TestCase):
     knowledge_base = "vector_store/app_test/test"
 
     def tearDown(self):
+        for job in list(helper.compaction_jobs.values()):
+            job.wait(10)
         if os.path.isdir("vector_store/app_test"):
             shutil.rmtree("vector_store/app_test")
 
     def test_create_knowledge_base(self):
         result = helper.create_knowledge_base(self.valid_document,
                                               self.knowledge_base)
-        self.assertIsNone(result)
+        self.assertEqual(result, {"exact": 0, "near": 0})
         self.assertTrue(os.path.isdir(self.knowledge_base))
 
     def test_create_knowledge_base_already_exist(self):
@@ -42,14 +47,16 @@ class HelperTestCase(unittest.TestCase):
                                      self.knowledge_base)
         result = helper.add_document_to_knowledge_base(self.valid_document,
                                                        self.knowledge_base)
-        self.assertIsNone(result)
+        # Every chunk of the document is already stored
+        chunks = list(helper.iter_document_chunks(self.valid_document))
+        self.assertEqual(result, {"exact": len(chunks), "near": 0})
         self.assertTrue(os.path.isdir(self.knowledge_base))
 
     def test_add_document_to_new_knowledge_base_creates_knowledge_base(self):
         new_knowledge_base = "vector_store/app_test/test"
         result = helper.add_document_to_knowledge_base(self.valid_document,
                                                        new_knowledge_base)
-        self.assertIsNone(result)
+        self.assertEqual(result, {"exact": 0, "near": 0})
         self.assertTrue(os.path.isdir(new_knowledge_base))
 
     def test_add_document_invalid_document(self):
@@ -97,3 +104,557 @@ class HelperTestCase(unittest.TestCase):
         self.assertIsNotNone(result)
         self.assertEqual(type(result), list)
         self.assertEqual(len(result), 0)
+
+    def test_find_similar_documents_reuses_loaded_knowledge_base(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        helper.find_similar_document("stephen.txt", self.knowledge_base)
+        hits = helper.knowledge_base_cache.stats()["hits"]
+        helper.result_cache.clear()
+        helper.find_similar_document("stephen.txt", self.knowledge_base)
+        self.assertEqual(helper.knowledge_base_cache.stats()["hits"],
+                         hits + 1)
+
+    def test_knowledge_base_cache_invalidated_on_write(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        helper.find_similar_document("stephen.txt", self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        result = helper.find_similar_document("stephen.txt",
+                                              self.knowledge_base)
+        self.assertEqual(len(result), 2)
+
+    def test_knowledge_base_cache_holds_one_entry_per_knowledge_base(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.knowledge_base_cache.clear()
+        first = helper.load_knowledge_base(self.knowledge_base)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(helper.knowledge_base_cache), 1)
+        helper.add_document_to_knowledge_base("beer.pdf",
+                                              self.knowledge_base)
+        loaded = helper.load_knowledge_base(self.knowledge_base)
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(len(helper.knowledge_base_cache), 1)
+        # Segments kept by the write are not opened again
+        self.assertIs(loaded[0], first[0])
+        self.assertIs(loaded[1], first[1])
+
+    def test_find_similar_document_result_cached_until_write(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        first = helper.find_similar_document("stephen.txt",
+                                             self.knowledge_base)
+        hits = helper.result_cache.stats()["hits"]
+        lookups = helper.knowledge_base_cache.stats()
+        self.assertEqual(helper.find_similar_document(
+            "stephen.txt", self.knowledge_base), first)
+        self.assertEqual(helper.result_cache.stats()["hits"], hits + 1)
+        self.assertEqual(helper.knowledge_base_cache.stats()["hits"],
+                         lookups["hits"])
+        self.assertEqual(len(helper.find_similar_document(
+            "stephen.txt", self.knowledge_base, k=1)), 1)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        self.assertEqual(len(helper.find_similar_document(
+            "stephen.txt", self.knowledge_base)), 2)
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        self.assertEqual(helper.find_similar_document(
+            "stephen.txt", self.knowledge_base), first)
+        self.assertEqual(helper.result_cache.stats()["hits"], hits + 1)
+
+    def test_find_similar_documents_batch(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        result = helper.find_similar_documents(
+            ["stephen.txt", "greetings.pdf"], self.knowledge_base, k=1)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(len(result[0]), 1)
+        self.assertEqual(result[0][0][0].metadata["source"],
+                         self.valid_document)
+        single = helper.find_similar_document("stephen.txt",
+                                              self.knowledge_base)
+        self.assertAlmostEqual(result[0][0][1], float(single[0][1]),
+                               places=5)
+
+    def test_find_similar_documents_batch_invalid_query_document(self):
+        helper.add_document_to_knowledge_base(self.valid_document,
+                                              self.knowledge_base)
+        with self.assertRaises(Exception):
+            helper.find_similar_documents(["stephen.txt", "invalid.txt"],
+                                          self.knowledge_base)
+
+    def test_add_document_writes_delta_segment(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 2)
+        self.assertEqual(manifest["version"], 2)
+
+    def test_compact_knowledge_base(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        before = helper.find_similar_document("stephen.txt",
+                                              self.knowledge_base)
+        helper.compact_knowledge_base(self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 1)
+        after = helper.find_similar_document("stephen.txt",
+                                             self.knowledge_base)
+        self.assertEqual([doc.metadata["source"] for doc, _ in before],
+                         [doc.metadata["source"] for doc, _ in after])
+
+    def test_delete_document_only_rewrites_its_segments(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        base = storage.read_manifest(self.knowledge_base)["segments"][0]
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["segments"], [base])
+
+    def test_delete_document_keeps_other_documents_searchable(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("beer.pdf",
+                                              self.knowledge_base)
+        helper.compact_knowledge_base(self.knowledge_base)
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            ["beer.pdf", self.valid_document])
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["document_count"], 2)
+        result = helper.find_similar_document("beer.pdf",
+                                              self.knowledge_base)
+        self.assertEqual(sorted(doc.metadata["source"] for doc, _ in result),
+                         ["beer.pdf", self.valid_document])
+        self.assertEqual(result[0][0].metadata["source"], "beer.pdf")
+        self.assertAlmostEqual(result[0][1], 0.0, places=5)
+
+    def test_stats_list_documents_without_loading_segments(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.delete_document_from_knowledge_base(self.valid_document,
+                                                   self.knowledge_base)
+        helper.knowledge_base_cache.clear()
+        stats = helper.get_knowledge_base_stats(self.knowledge_base)
+        self.assertEqual(stats["documents"], ["hello.txt"])
+        self.assertEqual(stats["document_count"], 1)
+        self.assertEqual(len(helper.knowledge_base_cache), 0)
+
+    def test_delete_document_tombstones_its_vectors(self):
+        ratio = helper.max_deleted_ratio
+        self.addCleanup(setattr, helper, "max_deleted_ratio", ratio)
+        helper.max_deleted_ratio = 1
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.compact_knowledge_base(self.knowledge_base)
+        segment_ids = storage.read_manifest(self.knowledge_base)["segments"]
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["segments"], segment_ids)
+        deleted = manifest["tombstones"][segment_ids[0]]["count"]
+        self.assertGreater(deleted, 0)
+        self.assertEqual(
+            storage.knowledge_base_stats(self.knowledge_base)["vectors"],
+            manifest["vector_counts"][segment_ids[0]] - deleted)
+        result = helper.find_similar_document("hello.txt",
+                                              self.knowledge_base)
+        self.assertEqual({doc.metadata["source"] for doc, _ in result},
+                         {self.valid_document})
+        # The deleted chunks no longer count as duplicates
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        result = helper.find_similar_document("hello.txt",
+                                              self.knowledge_base, k=1)
+        self.assertEqual(result[0][0].metadata["source"], "hello.txt")
+        helper.compact_knowledge_base(self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["tombstones"], {})
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            ["hello.txt", self.valid_document])
+        self.assertEqual(sum(manifest["vector_counts"].values()),
+                         storage.knowledge_base_stats(
+                             self.knowledge_base)["vectors"])
+
+    def test_add_documents_to_knowledge_base_writes_one_segment(self):
+        report = helper.add_documents_to_knowledge_base(
+            ["railway.txt", "hello.txt", "beer.pdf", "invalid.txt"],
+            self.knowledge_base, batch_size=2)
+        self.assertEqual(report["added"], 3)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["chunks"], 3)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 1)
+        self.assertEqual(manifest["document_count"], 3)
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            ["beer.pdf", "hello.txt", "railway.txt"])
+        result = helper.find_similar_document("beer.pdf",
+                                              self.knowledge_base)
+        self.assertEqual(result[0][0].metadata["source"], "beer.pdf")
+
+    def test_create_knowledge_base_with_index_type(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base,
+                                     index={"type": "hnsw", "m": 8})
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["index"]["type"], "hnsw")
+        self.assertEqual(manifest["base_index"], "hnsw")
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        result = helper.find_similar_document("stephen.txt",
+                                              self.knowledge_base,
+                                              ef_search=16)
+        self.assertEqual(result[0][0].metadata["source"],
+                         self.valid_document)
+
+    def test_ivf_index_built_once_enough_vectors(self):
+        helper.create_knowledge_base(
+            self.valid_document, self.knowledge_base,
+            index={"type": "ivf", "nlist": 1, "min_train_vectors": 3})
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["base_index"], "flat")
+        helper.add_document_to_knowledge_base("beer.pdf",
+                                              self.knowledge_base)
+        # The add only schedules the compaction building the index
+        job = helper.compaction_jobs[os.path.normpath(self.knowledge_base)]
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, "succeeded")
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["base_index"], "ivf")
+        self.assertEqual(len(manifest["segments"]), 1)
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        result = helper.find_similar_document("beer.pdf",
+                                              self.knowledge_base, nprobe=1)
+        self.assertEqual([doc.metadata["source"] for doc, _ in result],
+                         ["beer.pdf", self.valid_document])
+
+    def test_trained_index_kept_below_min_train_vectors(self):
+        helper.create_knowledge_base(
+            self.valid_document, self.knowledge_base,
+            index={"type": "ivf", "nlist": 1, "min_train_vectors": 3})
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("beer.pdf",
+                                              self.knowledge_base)
+        helper.compaction_jobs[
+            os.path.normpath(self.knowledge_base)].wait(10)
+        helper.compact_knowledge_base(self.knowledge_base)
+        self.assertEqual(helper.load_knowledge_base(
+            self.knowledge_base)[0].index_type, "ivf")
+        helper.delete_document_from_knowledge_base("hello.txt",
+                                                   self.knowledge_base)
+        self.assertLess(
+            storage.knowledge_base_stats(self.knowledge_base)["vectors"], 3)
+        helper.compact_knowledge_base(self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["base_index"], "ivf")
+        self.assertEqual(manifest["tombstones"], {})
+        (segment,) = helper.load_knowledge_base(self.knowledge_base)
+        self.assertEqual(segment.index_type, "ivf")
+        result = helper.find_similar_document("beer.pdf",
+                                              self.knowledge_base, nprobe=1)
+        self.assertEqual([doc.metadata["source"] for doc, _ in result],
+                         ["beer.pdf", self.valid_document])
+
+    def test_compaction_keeps_writes_made_while_it_builds(self):
+        from app import indexes
+
+        ratio = helper.max_deleted_ratio
+        self.addCleanup(setattr, helper, "max_deleted_ratio", ratio)
+        helper.max_deleted_ratio = 1
+        build_index = indexes.build_index
+        self.addCleanup(setattr, indexes, "build_index", build_index)
+        helper.create_knowledge_base(
+            self.valid_document, self.knowledge_base,
+            index={"type": "flat", "quantization": "int8"})
+        helper.compaction_jobs[
+            os.path.normpath(self.knowledge_base)].wait(10)
+        helper.add_document_to_knowledge_base("hello.txt",
+                                              self.knowledge_base)
+
+        def build_while_writing(config, vectors):
+            helper.add_document_to_knowledge_base("beer.pdf",
+                                                  self.knowledge_base)
+            helper.delete_document_from_knowledge_base(
+                "hello.txt", self.knowledge_base)
+            return build_index(config, vectors)
+
+        indexes.build_index = build_while_writing
+        helper.compact_knowledge_base(self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 2)
+        merged = manifest["segments"][0]
+        self.assertEqual(list(manifest["tombstones"]), [merged])
+        self.assertEqual(manifest["document_count"], 2)
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            ["beer.pdf", self.valid_document])
+        result = helper.find_similar_document("hello.txt",
+                                              self.knowledge_base)
+        self.assertEqual(sorted(doc.metadata["source"] for doc, _ in result),
+                         ["beer.pdf", self.valid_document])
+
+    def test_schedule_compaction_queues_one_job(self):
+        from app.job_queue import job_queue
+
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        release = threading.Event()
+        blocker = job_queue.submit("test", self.knowledge_base,
+                                   release.wait, 10)
+        self.addCleanup(blocker.wait, 10)
+        self.addCleanup(release.set)
+        job = helper.schedule_compaction(self.knowledge_base)
+        self.assertIs(helper.schedule_compaction(self.knowledge_base), job)
+        self.assertEqual(job.state, "queued")
+        release.set()
+        self.assertTrue(job.wait(10))
+        self.assertEqual(job.state, "succeeded")
+        self.assertIsNot(helper.schedule_compaction(self.knowledge_base),
+                         job)
+
+    def test_find_similar_document_filter_and_max_distance(self):
+        helper.add_documents_to_knowledge_base(
+            ["railway.txt", "hello.txt", "beer.pdf", "greetings.pdf"],
+            self.knowledge_base)
+        helper.add_document_to_knowledge_base("stephen.txt",
+                                              self.knowledge_base)
+        result = helper.find_similar_document(
+            "hello.txt", self.knowledge_base, k=1,
+            where={"source": "greetings.pdf"})
+        self.assertEqual([doc.metadata["source"] for doc, _ in result],
+                         ["greetings.pdf"])
+        result = helper.find_similar_document(
+            "beer.pdf", self.knowledge_base, k=5, max_distance=1e-6)
+        self.assertEqual([doc.metadata["source"] for doc, _ in result],
+                         ["beer.pdf"])
+        self.assertEqual(helper.find_similar_document(
+            "beer.pdf", self.knowledge_base, where={"source": "none.txt"}),
+            [])
+        with self.assertRaises(Exception):
+            helper.find_similar_document("beer.pdf", self.knowledge_base,
+                                         where={"source": ["a"]})
+
+    def test_duplicate_chunks_skipped(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        report = helper.add_documents_to_knowledge_base(
+            [self.valid_document, "hello.txt", "hello.txt"],
+            self.knowledge_base)
+        self.assertEqual(report["chunks"], 1)
+        self.assertEqual(report["duplicates"], {"exact": 2, "near": 0})
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(sum(manifest["vector_counts"].values()), 2)
+        result = helper.update_knowledge_base(
+            helper.iter_document_chunks("hello.txt"), self.knowledge_base)
+        self.assertEqual(result["duplicates"]["exact"], 1)
+
+    def test_near_duplicate_chunks_skipped(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        docs = list(helper.iter_document_chunks(self.valid_document))
+        docs[0].page_content += " "
+        report = helper.update_knowledge_base(
+            docs + list(helper.iter_document_chunks("beer.pdf")),
+            self.knowledge_base, near_duplicate_distance=0.01)
+        self.assertEqual(report, {"chunks": 1,
+                                  "duplicates": {"exact": 0, "near": 1}})
+
+    def test_concurrent_adds_keep_every_document(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+        names = ["hello.txt", "beer.pdf", "promo.pdf", "greetings.pdf"]
+        threads = [threading.Thread(
+            target=helper.add_document_to_knowledge_base,
+            args=(name, self.knowledge_base)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["document_count"], len(names) + 1)
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            sorted(names + [self.valid_document]))
+        self.assertEqual(manifest["version"], 5)
+
+    def test_iter_document_chunks_matches_character_text_splitter(self):
+        from langchain.text_splitter import CharacterTextSplitter
+
+        rng = random.Random(0)
+        splitter = CharacterTextSplitter(chunk_size=40, chunk_overlap=0)
+
+        def paragraph():
+            # No longer than a chunk, even after a separator's extra "\n"
+            words = "".join(rng.choice(["a", "b c", " ", "\n", "word"])
+                            for _ in range(rng.randint(0, 20)))
+            return words[:39]
+
+        try:
+            for i in range(50):
+                text = paragraph()
+                for _ in range(rng.randint(0, 10)):
+                    text += rng.choice(["\n\n", "\n\n\n"]) + paragraph()
+                helper.documents_store["random.txt"] = text
+                for read_size in (1, 3, 1000):
+                    chunks = helper.iter_document_chunks(
+                        "random.txt", chunk_size=40, read_size=read_size)
+                    self.assertEqual([doc.page_content for doc in chunks],
+                                     splitter.split_text(text))
+        finally:
+            helper.documents_store.pop("random.txt", None)
+
+    def test_document_without_separators_cut_as_read(self):
+        text = "".join(f"line {i}\n" for i in range(500))
+        helper.documents_store["log.txt"] = text
+        try:
+            for read_size in (7, 1000, 1 << 20):
+                chunks = [doc.page_content for doc in
+                          helper.iter_document_chunks(
+                              "log.txt", chunk_size=100,
+                              read_size=read_size)]
+                self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+                # Chunks are stripped, like CharacterTextSplitter ones
+                self.assertEqual("".join("".join(chunks).split()),
+                                 "".join(text.split()))
+                self.assertEqual(len(chunks), -(-len(text) // 100))
+        finally:
+            helper.documents_store.pop("log.txt")
+
+    def test_large_document_streamed_in_batches(self):
+        helper.documents_store["large.txt"] = "\n\n".join(
+            f"paragraph {i} " + "text " * 50 for i in range(200))
+        progress = []
+        try:
+            report = helper.add_documents_to_knowledge_base(
+                ["large.txt", "hello.txt"], self.knowledge_base,
+                batch_size=8, progress=progress.append)
+            chunks = list(helper.iter_document_chunks("large.txt"))
+            self.assertEqual(report["chunks"], len(chunks) + 1)
+        finally:
+            helper.documents_store.pop("large.txt")
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 1.0)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 1)
+        self.assertEqual(os.listdir(os.path.join(self.knowledge_base,
+                                                 storage.STAGING)), [])
+        result = helper.find_similar_document("hello.txt",
+                                              self.knowledge_base, k=1)
+        self.assertEqual(result[0][0].metadata["source"], "hello.txt")
+
+    def test_staged_chunks_added_concurrently_dropped(self):
+        helper.create_knowledge_base(self.valid_document,
+                                     self.knowledge_base)
+
+        def chunks():
+            yield from list(helper.iter_document_chunks("hello.txt"))
+            yield from list(helper.iter_document_chunks("beer.pdf"))
+            helper.add_document_to_knowledge_base("hello.txt",
+                                                  self.knowledge_base)
+
+        report = helper.update_knowledge_base(chunks(), self.knowledge_base)
+        self.assertEqual(report, {"chunks": 1,
+                                  "duplicates": {"exact": 1, "near": 0}})
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(sum(manifest["vector_counts"].values()), 3)
+        self.assertEqual(manifest["document_count"], 3)
+        self.assertEqual(
+            helper.knowledge_base_documents(self.knowledge_base),
+            ["beer.pdf", "hello.txt", self.valid_document])
+
+    def test_quantized_knowledge_base_recall(self):
+        helper.create_knowledge_base(
+            self.valid_document, self.knowledge_base,
+            index={"type": "flat", "quantization": "int8", "rerank": 4})
+        helper.add_documents_to_knowledge_base(
+            ["hello.txt", "beer.pdf", "stephen.txt", "promo.pdf"],
+            self.knowledge_base)
+        helper.compact_knowledge_base(self.knowledge_base)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(manifest["base_index"], "flat+int8")
+        result = helper.find_similar_document("beer.pdf",
+                                              self.knowledge_base, k=1)
+        self.assertEqual(result[0][0].metadata["source"], "beer.pdf")
+        self.assertAlmostEqual(result[0][1], 0.0, places=5)
+        report = helper.measure_recall(self.knowledge_base, k=2)
+        self.assertEqual(report["recall"], 1.0)
+        self.assertEqual(report["rerank"], 4)
+        self.assertEqual(report["index_bytes_per_vector"] * 4,
+                         report["full_precision_bytes_per_vector"])
+
+    def test_find_similar_document_federated(self):
+        other = "vector_store/app_test/other"
+        helper.add_documents_to_knowledge_base(
+            ["beer.pdf", "hello.txt"], self.knowledge_base)
+        helper.add_documents_to_knowledge_base(
+            ["greetings.pdf", "railway.txt"], other)
+        hits, status = helper.find_similar_document_federated(
+            "beer.pdf", [self.knowledge_base, other, "vector_store/none"],
+            k=3)
+        self.assertEqual([(knowledge_base, doc.metadata["source"])
+                          for knowledge_base, doc, _ in hits[:2]],
+                         [(self.knowledge_base, "beer.pdf"),
+                          (other, "greetings.pdf")])
+        self.assertEqual(len(hits), 3)
+        self.assertEqual([status[name]["status"] for name in status],
+                         ["ok", "ok", "error"])
+
+    def test_find_similar_document_federated_budget(self):
+        slow = "vector_store/app_test/slow"
+        helper.add_document_to_knowledge_base("beer.pdf",
+                                              self.knowledge_base)
+        helper.add_document_to_knowledge_base("beer.pdf", slow)
+        search = helper.search_knowledge_base
+
+        def slow_search(knowledge_base, *args, **kwargs):
+            if knowledge_base == slow:
+                time.sleep(0.5)
+            return search(knowledge_base, *args, **kwargs)
+
+        helper.search_knowledge_base = slow_search
+        try:
+            hits, status = helper.find_similar_document_federated(
+                "beer.pdf", [slow, self.knowledge_base], budget=0.1)
+        finally:
+            helper.search_knowledge_base = search
+        self.assertEqual(status[slow]["status"], "timeout")
+        self.assertEqual(status[self.knowledge_base]["hits"], 1)
+        self.assertEqual([knowledge_base for knowledge_base, _, _ in hits],
+                         [self.knowledge_base])
+
+    def test_create_knowledge_base_invalid_index_type(self):
+        with self.assertRaises(Exception):
+            helper.create_knowledge_base(self.valid_document,
+                                         self.knowledge_base,
+                                         index={"type": "invalid"})
+        self.assertFalse(os.path.isdir(self.knowledge_base))
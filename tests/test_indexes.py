@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+from app import indexes
+
+
+class IndexesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.vectors = np.random.default_rng(0).random(
+            (500, 16), dtype=np.float32)
+
+    def test_index_config_fills_defaults(self):
+        config = indexes.index_config({"type": "ivf", "nlist": 4})
+        self.assertEqual(config, {"type": "ivf", "nlist": 4, "nprobe": 8})
+        self.assertEqual(indexes.index_config(None), {"type": "flat"})
+
+    def test_index_config_rejects_invalid_settings(self):
+        with self.assertRaises(ValueError):
+            indexes.index_config({"type": "lsh"})
+        with self.assertRaises(ValueError):
+            indexes.index_config({"type": "ivf", "ef_search": 4})
+        with self.assertRaises(ValueError):
+            indexes.index_config({"type": "hnsw", "m": 0})
+
+    def test_min_train_vectors(self):
+        self.assertEqual(indexes.min_train_vectors(
+            indexes.index_config({"type": "ivf", "nlist": 10})), 390)
+        self.assertEqual(indexes.min_train_vectors(
+            indexes.index_config({"type": "hnsw"})), 0)
+
+    def test_build_index_types(self):
+        for index_type, settings in [("flat", {}), ("ivf", {"nlist": 4}),
+                                     ("hnsw", {"m": 8}),
+                                     ("ivfpq", {"nlist": 2, "pq_m": 4,
+                                                "pq_bits": 4})]:
+            config = indexes.index_config({"type": index_type, **settings})
+            index = indexes.build_index(config, self.vectors)
+            self.assertEqual(indexes.index_type(index), index_type)
+            self.assertEqual(index.ntotal, len(self.vectors))
+            params = indexes.search_parameters(index, nprobe=4,
+                                               ef_search=16)
+            _, ids = index.search(self.vectors[:1], 1, params=params)
+            if index_type != "ivfpq":
+                self.assertEqual(ids[0][0], 0)
+
+    def test_quantized_indexes(self):
+        self.assertEqual(indexes.index_config(
+            {"type": "hnsw", "quantization": "int8", "rerank": 4}),
+            {"type": "hnsw", "m": 32, "ef_construction": 40,
+             "ef_search": 64, "quantization": "int8", "rerank": 4})
+        with self.assertRaises(ValueError):
+            indexes.index_config({"type": "flat", "quantization": "int4"})
+        with self.assertRaises(ValueError):
+            indexes.index_config({"type": "ivfpq", "quantization": "fp16"})
+        for index_type, settings in [("flat", {}), ("ivf", {"nlist": 4}),
+                                     ("hnsw", {"m": 8})]:
+            for quantization, code_size in (("fp16", 32), ("int8", 16)):
+                config = indexes.index_config({"type": index_type,
+                                               "quantization": quantization,
+                                               **settings})
+                index = indexes.build_index(config, self.vectors)
+                self.assertEqual(indexes.index_type(index),
+                                 indexes.index_name(config))
+                self.assertEqual(indexes.code_size(index), code_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
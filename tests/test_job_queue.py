@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+from app import job_queue
+from app.job_queue import JobQueue, JobStore
+
+
+def wait_for(job, timeout=5):
+    deadline = time.time() + timeout
+    while job.finished_at is None and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.queue = JobQueue(max_workers=2)
+
+    def test_job_succeeds_with_result(self):
+        job = self.queue.submit("add", "kb", lambda x: x * 2, 21)
+        wait_for(job)
+        self.assertEqual(job.state, "succeeded")
+        self.assertEqual(job.result, 42)
+        self.assertEqual(job.progress, 1.0)
+        self.assertIs(self.queue.get(job.id), job)
+
+    def test_failed_job_reports_error(self):
+        def fail():
+            raise Exception
+
+        job = wait_for(self.queue.submit("add", "kb", fail))
+        self.assertEqual(job.state, "failed")
+        self.assertIsNotNone(job.error)
+        self.assertIsNotNone(job.to_dict()["run_seconds"])
+
+    def test_jobs_on_same_knowledge_base_are_serialized(self):
+        order = []
+
+        def record(name):
+            order.append(f"start {name}")
+            time.sleep(0.05)
+            order.append(f"end {name}")
+
+        first = self.queue.submit("add", "kb", record, "first")
+        second = self.queue.submit("add", "kb", record, "second")
+        wait_for(first)
+        wait_for(second)
+        self.assertEqual(order, ["start first", "end first",
+                                 "start second", "end second"])
+
+    def test_jobs_on_different_knowledge_bases_run_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)
+        first = self.queue.submit("add", "kb1", barrier.wait)
+        second = self.queue.submit("add", "kb2", barrier.wait)
+        self.assertEqual(wait_for(first).state, "succeeded")
+        self.assertEqual(wait_for(second).state, "succeeded")
+
+    def test_progress_callback(self):
+        directory = "vector_store/app_test_job_progress"
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        interval = job_queue.PROGRESS_SAVE_INTERVAL
+        self.addCleanup(setattr, job_queue, "PROGRESS_SAVE_INTERVAL",
+                        interval)
+        job_queue.PROGRESS_SAVE_INTERVAL = 0
+        store = JobStore(os.path.join(directory, "jobs.sqlite"))
+        queue = JobQueue(max_workers=1, store=store)
+        reported, release = threading.Event(), threading.Event()
+
+        def work(progress):
+            progress(0.5)
+            reported.set()
+            release.wait(5)
+            return "done"
+
+        job = queue.submit("add", "kb", work, track_progress=True)
+        self.addCleanup(release.set)
+        self.assertTrue(reported.wait(5))
+        self.assertEqual(job.progress, 0.5)
+        self.assertEqual(store.get(job.id).progress, 0.5)
+        release.set()
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.result, "done")
+        self.assertEqual(store.get(job.id).progress, 1.0)
+
+    def test_jobs_visible_to_queues_sharing_a_store(self):
+        directory = "vector_store/app_test_jobs"
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        interval = job_queue.PROGRESS_SAVE_INTERVAL
+        self.addCleanup(setattr, job_queue, "PROGRESS_SAVE_INTERVAL",
+                        interval)
+        job_queue.PROGRESS_SAVE_INTERVAL = 0
+        path = os.path.join(directory, "jobs.sqlite")
+        queue = JobQueue(max_workers=1, max_finished=1,
+                         store=JobStore(path))
+        other = JobQueue(max_workers=1, store=JobStore(path))
+        started, release = threading.Event(), threading.Event()
+
+        def work(progress):
+            progress(0.5)
+            started.set()
+            release.wait(5)
+            return {"chunks": 3}
+
+        job = queue.submit("add", "kb", work, track_progress=True)
+        started.wait(5)
+        seen = other.get(job.id)
+        self.assertEqual((seen.state, seen.progress), ("running", 0.5))
+        release.set()
+        wait_for(job)
+        seen = other.get(job.id)
+        self.assertEqual(seen.to_dict()["result"], {"chunks": 3})
+        self.assertEqual(seen.state, "succeeded")
+        self.assertEqual(seen.worker, job.worker)
+        # Finished jobs past `max_finished` are trimmed on submit
+        wait_for(queue.submit("add", "kb", int))
+        queue.submit("add", "kb", int)
+        self.assertIsNone(other.get(job.id))
+        self.assertIsNone(other.get("missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
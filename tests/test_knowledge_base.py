@@ -1,5 +1,7 @@
 import json
 import shutil
+import subprocess
+import sys
 import unittest
 from app import create_app
 
@@ -25,6 +27,22 @@ class KnowledgeBaseTestCase(unittest.TestCase):
         response = json.loads(response.get_data(as_text=True))
         self.assertEqual(response["data"], "Home page")
 
+    def test_create_app_defers_heavy_imports(self):
+        code = ("import sys; from app import create_app; create_app(); "
+                "print(any(name.split('.')[0] in ('langchain', 'faiss', "
+                "'sentence_transformers') for name in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(output.stdout.strip(), "False")
+
+    def test_ready(self):
+        response = self.client.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertTrue(response["ready"])
+        self.assertIn("load_model", response["startup_timings"])
+        self.assertIn("create_app", response["startup_timings"])
+
     def test_create_knowledge_base(self):
         req = {"knowledge_base": self.test_knowledge_base,
                "document": "hello.txt"}
@@ -33,6 +51,7 @@ class KnowledgeBaseTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 201)
         response = json.loads(response.get_data(as_text=True))
         self.assertEqual(response["message"], "Knowledge base created")
+        self.assertEqual(set(response["duplicates"]), {"exact", "near"})
 
     def test_create_knowledge_base_invalid_document(self):
         req = {"knowledge_base": self.test_knowledge_base,
@@ -60,6 +79,61 @@ class KnowledgeBaseTestCase(unittest.TestCase):
         self.assertEqual(response["message"], "Cannot delete knowledge base, "
                          "check request data and logs")
 
+    def test_compact_knowledge_base(self):
+        req = {"knowledge_base": "app_test/compact",
+               "document": "hello.txt"}
+        self.client.post("/document", json=req,
+                         content_type="application/json")
+        self.client.post("/document", json=req,
+                         content_type="application/json")
+        response = self.client.post("/knowledge_base/compact", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(response["message"], "Knowledge base compacted")
+
+    def test_compact_knowledge_base_invalid_knowledge_base(self):
+        req = {"knowledge_base": "invalid"}
+        response = self.client.post("/knowledge_base/compact", json=req,
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_measure_recall(self):
+        req = {"knowledge_base": "app_test/recall",
+               "document": "hello.txt",
+               "index": {"type": "hnsw", "quantization": "fp16"}}
+        response = self.client.post("/knowledge_base", json=req)
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get("/knowledge_base/recall?"
+                                   "knowledge_base=app_test/recall&k=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["recall"], 1.0)
+        response = self.client.get("/knowledge_base/recall?"
+                                   "knowledge_base=invalid")
+        self.assertEqual(response.status_code, 400)
+
+    def test_knowledge_base_stats(self):
+        req = {"knowledge_base": "app_test/stats/a",
+               "document": "hello.txt"}
+        response = self.client.post("/knowledge_base", json=req)
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get("/knowledge_base/app_test/stats/a/stats")
+        self.assertEqual(response.status_code, 200)
+        stats = response.get_json()
+        self.assertEqual(stats["name"], "app_test/stats/a")
+        self.assertEqual(stats["documents"], ["hello.txt"])
+        self.assertEqual(stats["version"], 1)
+        self.assertGreater(stats["vectors"], 0)
+        self.assertGreater(stats["bytes"], 0)
+        response = self.client.get("/knowledge_bases?prefix=app_test/stats")
+        self.assertEqual(response.status_code, 200)
+        listed = response.get_json()["knowledge_bases"]
+        self.assertEqual([stats["name"] for stats in listed],
+                         ["app_test/stats/a"])
+        self.assertEqual(listed[0]["vectors"], stats["vectors"])
+        response = self.client.get("/knowledge_base/app_test/invalid/stats")
+        self.assertEqual(response.status_code, 400)
+
 
 if __name__ == "__main__":
     unittest.main()
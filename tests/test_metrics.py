@@ -0,0 +1,66 @@
+import shutil
+import unittest
+from app import create_app, metrics, storage
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test", ("stage",),
+                                      buckets=(0.1, 1.0))
+        histogram.observe(0.05, "a")
+        histogram.observe(0.5, "a")
+        lines = histogram.collect()
+        self.assertIn('test_seconds_bucket{stage="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="a",le="+Inf"} 2', lines)
+        self.assertIn('test_seconds_count{stage="a"} 2', lines)
+
+    def test_counter_escapes_labels(self):
+        counter = metrics.Counter("test_total", "Test", ("route",))
+        counter.inc('a"b')
+        counter.inc('a"b')
+        self.assertIn('test_total{route="a\\"b"} 2', counter.collect())
+
+    def test_stage_recorded_in_profile(self):
+        metrics.start_profile()
+        with metrics.stage("split"):
+            pass
+        with metrics.stage("split"):
+            pass
+        stages = metrics.end_profile()
+        self.assertEqual(list(stages), ["split"])
+        self.assertIsNone(metrics.end_profile())
+        header = metrics.server_timing(stages, 0.002)
+        self.assertTrue(header.startswith("split;dur="))
+        self.assertTrue(header.endswith("total;dur=2.000"))
+
+    def test_metrics_endpoint(self):
+        client = create_app().test_client()
+        response = client.get("/", headers={metrics.PROFILE_HEADER: "1"})
+        self.assertIn("total;dur=", response.headers["Server-Timing"])
+        self.assertNotIn("Server-Timing", client.get("/").headers)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.get_data(as_text=True)
+        self.assertIn('kb_requests_total{method="GET",route="/",'
+                      'status="200"}', text)
+        self.assertIn('kb_cache_hit_ratio{cache="knowledge_base"}', text)
+        self.assertIn("process_peak_resident_memory_bytes", text)
+
+    def test_knowledge_base_vectors_read_from_stats(self):
+        self.addCleanup(shutil.rmtree, "vector_store/app_test_metrics",
+                        ignore_errors=True)
+        manifest = storage.new_manifest({"type": "flat"})
+        manifest["segments"] = ["a"]
+        manifest["vector_counts"] = {"a": 3}
+        storage.publish_manifest("vector_store/app_test_metrics/kb",
+                                 manifest)
+        self.assertEqual(metrics._knowledge_base_vectors()
+                         ["app_test_metrics/kb"], 3)
+        self.assertIn('kb_vectors{knowledge_base="app_test_metrics/kb"} 3',
+                      metrics.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
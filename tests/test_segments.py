@@ -0,0 +1,160 @@
+import os
+import shutil
+import unittest
+import faiss
+import numpy as np
+from langchain.schema.document import Document
+from app import indexes, segments
+from app.embeddings import text_hash
+
+
+class SegmentTestCase(unittest.TestCase):
+    path = "vector_store/app_test_segments/segment"
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.random((40, 8), dtype=np.float32)
+        self.chunks = [(f"c{i}", Document(
+            page_content=f"chunk {i}",
+            metadata={"source": "even.txt" if i % 2 == 0 else "odd.txt"}))
+            for i in range(40)]
+
+    def tearDown(self):
+        shutil.rmtree("vector_store/app_test_segments", ignore_errors=True)
+
+    def test_flat_segment_searched_on_mapped_vectors(self):
+        segments.write_segment(self.path, self.vectors, self.chunks)
+        self.assertFalse(os.path.exists(os.path.join(self.path,
+                                                     segments.INDEX)))
+        segment = segments.Segment(self.path)
+        self.assertIsInstance(segment.vectors, np.memmap)
+        self.assertEqual(segment.index_type, "flat")
+        self.assertEqual(segment.memory_bytes(), 0)
+        distances, ids = segment.search(self.vectors[[3]], 2)
+        self.assertEqual(ids[0][0], 3)
+        self.assertAlmostEqual(float(distances[0][0]), 0.0, places=5)
+
+    def test_get_documents_reads_only_requested_chunks(self):
+        segments.write_segment(self.path, self.vectors, self.chunks)
+        segment = segments.Segment(self.path)
+        documents = segment.get_documents([5, 2])
+        self.assertEqual(sorted(documents), [2, 5])
+        self.assertEqual(documents[5].page_content, "chunk 5")
+        self.assertEqual(documents[2].metadata, {"source": "even.txt"})
+
+    def test_chunks_of_and_document_names(self):
+        segments.write_segment(self.path, self.vectors, self.chunks)
+        segment = segments.Segment(self.path)
+        self.assertEqual(segment.chunks_of("odd.txt")[:2],
+                         [(1, "c1"), (3, "c3")])
+        self.assertEqual(sorted(segment.document_names()),
+                         ["even.txt", "odd.txt"])
+        chunks = list(segment.iter_chunks())
+        self.assertEqual([chunk_id for chunk_id, _ in chunks[:2]],
+                         ["c0", "c1"])
+        self.assertEqual(len(chunks), 40)
+
+    def test_segment_writer_appends_batches(self):
+        writer = segments.SegmentWriter(self.path)
+        for start in range(0, 40, 16):
+            writer.add(self.chunks[start:start + 16],
+                       self.vectors[start:start + 16])
+        writer.close()
+        segment = segments.Segment(self.path)
+        np.testing.assert_array_equal(segment.vectors, self.vectors)
+        self.assertEqual(segment.get_documents([39])[39].page_content,
+                         "chunk 39")
+        self.assertEqual(segment.ids_of_hashes([text_hash("chunk 7")]), [7])
+
+    def test_segment_writer_abort_removes_segment(self):
+        writer = segments.SegmentWriter(self.path)
+        writer.add(self.chunks[:4], self.vectors[:4])
+        writer.abort()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_ivf_segment_index_memory_mapped(self):
+        index = indexes.build_index({"type": "ivf", "nlist": 1, "nprobe": 1},
+                                    self.vectors)
+        segments.write_segment(self.path, self.vectors, self.chunks,
+                               index=index)
+        segment = segments.Segment(self.path)
+        self.assertEqual(segment.index_type, "ivf")
+        self.assertEqual(segment.memory_bytes(), 0)
+        _, ids = segment.search(self.vectors[[7]], 1, nprobe=1)
+        self.assertEqual(ids.tolist(), [[7]])
+        writable = segment.writable_index()
+        writable.reset()
+        self.assertEqual(writable.ntotal, 0)
+        self.assertEqual(segment.index.ntotal, 40)
+
+    def test_search_restricted_to_matching_ids(self):
+        segments.write_segment(self.path, self.vectors, self.chunks)
+        segment = segments.Segment(self.path)
+        faiss_ids = segment.matching_ids({"source": "odd.txt"})
+        self.assertEqual(faiss_ids.tolist(), list(range(1, 40, 2)))
+        _, ids = segment.search(self.vectors[[4]], 3, faiss_ids=faiss_ids)
+        self.assertTrue(all(i % 2 == 1 for i in ids[0]))
+        self.assertEqual(segment.matching_ids({"source": "x"}).tolist(), [])
+
+    def test_deleted_vectors_left_out(self):
+        index = indexes.build_index(
+            indexes.index_config({"type": "flat", "quantization": "int8"}),
+            self.vectors)
+        segments.write_segment(self.path, self.vectors, self.chunks,
+                               index=index)
+        segments.write_segment(self.path + "-flat", self.vectors,
+                               self.chunks)
+        stored = segments.Segment(self.path)
+        odd = np.arange(1, 40, 2)
+        for segment in (stored.with_deleted(odd), segments.Segment(
+                self.path + "-flat").with_deleted(odd)):
+            _, ids = segment.search(self.vectors[[3, 4]], 5)
+            self.assertTrue(all(i % 2 == 0 for i in ids.ravel()))
+            _, ids = segment.exact_search(self.vectors[[3]], 25)
+            self.assertEqual(sorted(ids[0][:20]), list(range(0, 40, 2)))
+            self.assertEqual(ids[0][20:].tolist(), [-1] * 5)
+            self.assertEqual(segment.document_names(), ["even.txt"])
+            self.assertEqual(segment.chunks_of("odd.txt"), [])
+            self.assertEqual(len(list(segment.iter_chunks())), 20)
+            self.assertEqual(len(segment.live_vectors()), 20)
+            self.assertEqual(segment.matching_ids({"source": "odd.txt"})
+                             .tolist(), [])
+            self.assertEqual(segment.existing_hashes(
+                [text_hash("chunk 1"), text_hash("chunk 2")]),
+                {text_hash("chunk 2")})
+        self.assertEqual(len(stored.live_vectors()), 40)
+        self.assertEqual(sorted(stored.document_names()),
+                         ["even.txt", "odd.txt"])
+
+    def test_rerank_scores_candidates_exactly(self):
+        index = indexes.build_index(
+            indexes.index_config({"type": "flat", "quantization": "int8"}),
+            self.vectors)
+        segments.write_segment(self.path, self.vectors, self.chunks,
+                               index=index)
+        segment = segments.Segment(self.path)
+        self.assertEqual(segment.index_type, "flat+int8")
+        self.assertEqual(segment.memory_bytes(), 40 * 8)
+        distances, ids = segment.search(self.vectors[[3, 5]], 2, rerank=3)
+        exact_distances, exact_ids = faiss.knn(self.vectors[[3, 5]],
+                                               self.vectors, 2)
+        np.testing.assert_array_equal(ids, exact_ids)
+        np.testing.assert_allclose(distances, exact_distances, atol=1e-5)
+
+    def test_hnsw_segment(self):
+        index = indexes.build_index(
+            {"type": "hnsw", "m": 8, "ef_construction": 40,
+             "ef_search": 16}, self.vectors)
+        segments.write_segment(self.path, self.vectors, self.chunks,
+                               index=index)
+        segment = segments.Segment(self.path)
+        self.assertIsInstance(segment.index, faiss.IndexHNSW)
+        _, ids = segment.search(self.vectors[[9]], 1, ef_search=32)
+        self.assertEqual(ids.tolist(), [[9]])
+        _, ids = segment.search(self.vectors[[9]], 1, faiss_ids=np.array(
+            [2, 4], dtype=np.int64))
+        self.assertIn(ids[0][0], (2, 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import pickle
+import shutil
+import threading
+import time
+import unittest
+import faiss
+import numpy as np
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.schema.document import Document
+from app import storage
+from app.segments import Segment
+
+
+class StorageTestCase(unittest.TestCase):
+    knowledge_base = "vector_store/app_test_storage/test"
+
+    def tearDown(self):
+        shutil.rmtree("vector_store/app_test_storage", ignore_errors=True)
+
+    def test_publish_manifest_bumps_version(self):
+        manifest = storage.new_manifest({"type": "flat"})
+        manifest["segments"] = ["a"]
+        manifest["vector_counts"] = {"a": 1, "c": 3}
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        manifest["segments"].append("b")
+        manifest["vector_counts"]["b"] = 2
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertEqual(manifest["version"], 2)
+        self.assertEqual(manifest["vector_counts"], {"a": 1, "b": 2})
+        self.assertEqual(storage.read_manifest(self.knowledge_base),
+                         manifest)
+
+    def test_manifest_version_changes_on_publish(self):
+        with self.assertRaises(OSError):
+            storage.manifest_version(self.knowledge_base)
+        manifest = storage.publish_manifest(
+            self.knowledge_base, storage.new_manifest({"type": "flat"}))
+        version = storage.manifest_version(self.knowledge_base)
+        self.assertEqual(version[0], manifest["version"])
+        self.assertEqual(storage.manifest_version(self.knowledge_base),
+                         version)
+        storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertNotEqual(storage.manifest_version(self.knowledge_base),
+                            version)
+
+    def test_cached_manifest_parsed_once_per_publish(self):
+        manifest = storage.publish_manifest(
+            self.knowledge_base, storage.new_manifest({"type": "flat"}))
+        identity, cached = storage.cached_manifest(self.knowledge_base)
+        self.assertEqual(cached, manifest)
+        self.assertIs(storage.cached_manifest(self.knowledge_base)[1],
+                      cached)
+        storage.publish_manifest(self.knowledge_base, manifest)
+        new_identity, cached = storage.cached_manifest(self.knowledge_base)
+        self.assertNotEqual(new_identity, identity)
+        self.assertEqual(cached["version"], 2)
+
+    def test_unsegmented_knowledge_base_migrated(self):
+        os.makedirs(self.knowledge_base)
+        index = faiss.IndexFlatL2(2)
+        index.add(np.array([[0, 0], [1, 1]], dtype=np.float32))
+        faiss.write_index(index, os.path.join(self.knowledge_base,
+                                              "index.faiss"))
+        docstore = InMemoryDocstore({
+            "c1": Document(page_content="a", metadata={"source": "a.txt"}),
+            "c2": Document(page_content="b", metadata={"source": "b.txt"})})
+        with open(os.path.join(self.knowledge_base, "index.pkl"), "wb") as f:
+            pickle.dump((docstore, {0: "c1", 1: "c2"}), f)
+        manifest = storage.read_manifest(self.knowledge_base)
+        self.assertEqual(len(manifest["segments"]), 1)
+        segment_id = manifest["segments"][0]
+        path = storage.segment_path(self.knowledge_base, segment_id)
+        self.assertEqual(sorted(os.listdir(path)),
+                         ["docstore.sqlite", "vectors.npy"])
+        self.assertEqual(manifest["document_count"], 2)
+        self.assertNotIn("documents", manifest)
+        self.assertEqual(storage.document_names(self.knowledge_base),
+                         ["a.txt", "b.txt"])
+        self.assertEqual(manifest["vector_counts"], {segment_id: 2})
+        self.assertEqual(manifest["format"], storage.FORMAT)
+        segment = Segment(path)
+        self.assertEqual(segment.chunks_of("b.txt"), [(1, "c2")])
+        _, indices = segment.search(
+            np.array([[1, 1]], dtype=np.float32), 1)
+        self.assertEqual(indices.tolist(), [[1]])
+
+    def test_retired_segments_removed_after_retention(self):
+        retention = storage.retention_seconds
+        self.addCleanup(setattr, storage, "retention_seconds", retention)
+        for segment_id in ("a", "b", "orphan"):
+            os.makedirs(storage.segment_path(self.knowledge_base,
+                                             segment_id))
+        manifest = storage.new_manifest({"type": "flat"})
+        manifest["segments"] = ["a"]
+        manifest["vector_counts"] = {"a": 1, "b": 1}
+        storage.retention_seconds = 60
+        manifest = storage.publish_manifest(self.knowledge_base, manifest,
+                                            retired=["b"])
+        self.assertEqual(list(manifest["retired"]), ["b"])
+        segments_dir = os.path.join(self.knowledge_base, storage.SEGMENTS)
+        self.assertEqual(sorted(os.listdir(segments_dir)), ["a", "b"])
+        storage.retention_seconds = 0
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertEqual(manifest["retired"], {})
+        self.assertEqual(os.listdir(segments_dir), ["a"])
+
+    def test_tombstone_files_retired_and_orphans_removed(self):
+        retention = storage.retention_seconds
+        self.addCleanup(setattr, storage, "retention_seconds", retention)
+        path = storage.segment_path(self.knowledge_base, "a")
+        os.makedirs(path)
+        manifest = storage.new_manifest({"type": "flat"})
+        manifest["segments"] = ["a"]
+        manifest["vector_counts"] = {"a": 4}
+        first = storage.write_tombstones(self.knowledge_base, "a", [1])
+        manifest["tombstones"] = {"a": {"file": first, "count": 1}}
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        second = storage.write_tombstones(self.knowledge_base, "a", [1, 3])
+        manifest["tombstones"] = {"a": {"file": second, "count": 2}}
+        storage.retention_seconds = 60
+        manifest = storage.publish_manifest(self.knowledge_base, manifest,
+                                            retired=[f"a/{first}"])
+        self.assertEqual(storage.live_vectors(manifest), 2)
+        self.assertEqual(storage.read_tombstones(
+            self.knowledge_base, "a", manifest).tolist(), [1, 3])
+        self.assertEqual(sorted(os.listdir(path)), sorted([first, second]))
+        orphan = storage.write_tombstones(self.knowledge_base, "a", [0])
+        storage.retention_seconds = 0
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertEqual(os.listdir(path), [second])
+        self.assertNotIn(orphan, os.listdir(path))
+        self.assertEqual(manifest["retired"], {})
+
+    def test_write_lock_excludes_other_writers(self):
+        acquired = threading.Event()
+
+        def writer():
+            with storage.write_lock(self.knowledge_base):
+                acquired.set()
+
+        with storage.write_lock(self.knowledge_base):
+            with storage.write_lock(self.knowledge_base):
+                thread = threading.Thread(target=writer)
+                thread.start()
+                time.sleep(0.2)
+                self.assertFalse(acquired.is_set())
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_list_knowledge_bases(self):
+        root = "vector_store/app_test_storage"
+        for name in ("team/a", "team/b", "teams", "other"):
+            manifest = storage.new_manifest({"type": "flat"})
+            storage.publish_manifest(os.path.join(root, name), manifest)
+        self.assertEqual(storage.list_knowledge_bases(root),
+                         ["other", "team/a", "team/b", "teams"])
+        self.assertEqual(storage.list_knowledge_bases(root, "team/"),
+                         ["team/a", "team/b"])
+        self.assertEqual(storage.list_knowledge_bases(root, "team"),
+                         ["team/a", "team/b", "teams"])
+
+    def test_knowledge_base_stats_read_from_manifest(self):
+        segment_id = storage.new_segment_id()
+        path = storage.segment_path(self.knowledge_base, segment_id)
+        os.makedirs(path)
+        np.save(os.path.join(path, "vectors.npy"),
+                np.zeros((3, 4), dtype=np.float32))
+        manifest = storage.new_manifest({"type": "flat"})
+        manifest["segments"] = [segment_id]
+        manifest["document_count"] = 1
+        manifest["vector_counts"] = {segment_id: 3}
+        manifest = storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertEqual(manifest["dimensions"], 4)
+        self.assertEqual(manifest["segment_bytes"],
+                         {segment_id: os.path.getsize(
+                             os.path.join(path, "vectors.npy"))})
+        stats = storage.knowledge_base_stats(self.knowledge_base)
+        self.assertEqual(stats["version"], 1)
+        self.assertEqual(stats["document_count"], 1)
+        self.assertEqual((stats["vectors"], stats["dimensions"]), (3, 4))
+        self.assertGreater(stats["bytes"],
+                           manifest["segment_bytes"][segment_id])
+        self.assertEqual(stats["modified"], manifest["modified"])
+        # Segment files are not read again once their size is recorded
+        shutil.rmtree(path)
+        storage.publish_manifest(self.knowledge_base, manifest)
+        self.assertEqual(
+            storage.knowledge_base_stats(self.knowledge_base)["version"], 2)
+        with self.assertRaises(OSError):
+            storage.knowledge_base_stats("vector_store/app_test_storage/no")
+
+    def test_merge_results_keeps_closest_hits(self):
+        first = [[("a", 0.5), ("b", 2.0)], [("c", 1.0)]]
+        second = [[("d", 1.0)], []]
+        merged = storage.merge_results([first, second], k=2)
+        self.assertEqual(merged, [[("a", 0.5), ("d", 1.0)], [("c", 1.0)]])
+
+
+if __name__ == "__main__":
+    unittest.main()